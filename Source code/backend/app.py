@@ -1,83 +1,91 @@
-from datetime import datetime, timezone
-from psycopg2.extras import RealDictCursor
-
 from flask import Flask, jsonify, request, render_template
 from flask_cors import CORS
-from threading import Thread
-import time
 from flask import Flask, jsonify, request, render_template, session, redirect, url_for
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, render_template, jsonify, request, Response
 from flask_cors import CORS
 
 from config.db import get_db_connection
 from config.web_socket import socketio
-from config.mqtt import create_mqtt_client
+from config.mqtt import mqtt_gateway
 from controller.devices import on_message, process_device_command
+from controller.state_writer import state_writer
+from controller.liveness import liveness
+from controller.offline_detector import offline_detector
+from controller.device_cache import device_cache
+from controller.device_topics import device_topics, device_for_user
+from controller.push import delta_pusher
+from controller.event_log import event_log
+from controller.log_partitions import log_partitions
+from controller.usage import usage, usage_rollup, get_usage, DEFAULT_RANGE
+from controller.user_cache import user_cache
+from controller.repository import stats as repository_stats
+from controller.passwords import password_pool
+from controller.command_tracker import command_tracker, sync_wait_seconds, ACKED
+from controller.mqtt_decoder import dead_letters
+from config.logger import get_logger
+from config.metrics import (
+    instrument_socketio, stat_gauge, render as render_metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE,
+)
+from config.cluster import (
+    CLUSTER_MODE, SOCKETIO_MESSAGE_QUEUE, CACHE_MAX_AGE, LeaderElection, shared_topic, cluster_info
+)
 from time import sleep
-
-
-OFFLINE_THRESHOLD = 5  # giây
-
-from psycopg2.extras import RealDictCursor
-
-def offline_checker():
-    while True:
-        try:
-            print("Checking for offline devices...")
-
-            now = datetime.now(timezone.utc)   # MUST be timezone-aware
-
-            conn = get_db_connection()
-            cursor = conn.cursor(cursor_factory=RealDictCursor)
-
-            cursor.execute("SELECT device_name, last_online FROM devices")
-            devices = cursor.fetchall()
-
-            for device in devices:
-                last_online = device["last_online"]
-                
-                # print ra thời gian hiện tại và last_online để debug
-                print(f"Now: {now}, Last online of {device['device_name']}: {last_online}")
-                # print ra hiệu số thời gian để debug
-                print(f"Time difference (seconds): {(now - last_online).total_seconds() if last_online else 'N/A'}")
-
-                if last_online and (now - last_online).total_seconds() > OFFLINE_THRESHOLD:
-
-                    cursor.execute(
-                        "UPDATE devices SET is_on=FALSE WHERE device_name=%s",
-                        (device["device_name"],)
-                    )
-
-                    data = {
-                        "device_id": device["device_name"],
-                        "state": "offline",
-                        "brightness": None
-                    }
-
-                    print("⚠️ Device offline:", device["device_name"])
-                    socketio.emit("device_state_update", data)
-
-            conn.commit()
-            conn.close()
-
-        except Exception as e:
-            print("🔥 ERROR in offline_checker:", str(e))
-
-        time.sleep(5)
+import atexit
+
+log = get_logger("app")
+leader_election = None
+
+
+# --- Tác vụ chỉ 1 worker được chạy (leader) ---
+def start_leader_duties():
+    # Offline detection theo deadline (min-heap), chỉ tốn công cho device sắp hết hạn
+    offline_detector.seed_from_db()
+    offline_detector.start()
+    # Heartbeat giữ trong bộ nhớ, checkpoint last_online xuống DB theo chu kỳ
+    liveness.start()
+    # Tạo trước partition cho bảng logs, xoá partition hết hạn retention
+    log_partitions.start()
+    # Ghi rollup sử dụng (phút -> giờ -> ngày) mỗi ROLLUP_INTERVAL
+    usage_rollup.start()
+    # THÊM: Khởi chạy background scheduler thread (engine tạo trước để stop_leader_duties luôn thấy nó)
+    engine = create_schedule_engine(socketio, mqtt_client)
+    socketio.start_background_task(target=schedule_executor, engine=engine)
+
+
+def stop_leader_duties():
+    offline_detector.stop()
+    liveness.stop()
+    log_partitions.stop()
+    usage_rollup.stop()
+    if scheduler_module.schedule_engine is not None:
+        scheduler_module.schedule_engine.stop()
+        scheduler_module.schedule_engine = None
 
 
 # --- Bắt đầu thread khi server khởi chạy ---
 def start_background_tasks():
-    Thread(target=offline_checker, daemon=True).start()
+    global leader_election
+    if not CLUSTER_MODE:
+        start_leader_duties()
+        atexit.register(liveness.stop)
+        return
+    # Nhiều worker: chỉ worker giữ advisory lock chạy scheduler/offline/checkpoint
+    leader_election = LeaderElection(on_elected=start_leader_duties, on_demoted=stop_leader_duties)
+    leader_election.start()
+    atexit.register(leader_election.stop)
 # THÊM: import các hàm xử lý đăng nhập/đăng kí từ controller auth
 from controller.auth import register_user, login_user, get_user_by_id
-from config.db import get_db_connection
+from config.db import get_db_connection, get_pool_stats, pool as db_pool
 
 # Device controllers
-from controller.devices import on_message, process_device_command, get_all_devices
+from controller.devices import on_message, process_device_command, process_bulk_command, get_all_devices, get_device_logs
+from controller.devices import brightness_coalescer
 
 # THÊM: Scheduler controller
-from controller.scheduler import get_schedule, save_schedule, delete_schedule, schedule_executor
+from controller.scheduler import (
+    get_schedule, save_schedule, delete_schedule, schedule_executor, create_schedule_engine,
+)
+import controller.scheduler as scheduler_module
 
 # User controllers (login/register/logout)
 from controller.user_controller import (
@@ -95,15 +103,55 @@ CORS(app)
 # =========================================
 # INIT SOCKET.IO
 # =========================================
-socketio.init_app(app, cors_allowed_origins="*")
+# Có SMART_LIGHT_MESSAGE_QUEUE thì emit đi qua Redis, tới được client ở mọi worker
+socketio.init_app(app, cors_allowed_origins="*", message_queue=SOCKETIO_MESSAGE_QUEUE)
+instrument_socketio(socketio.server)
+
+# =========================================
+# INIT STATE WRITER (ghi trạng thái theo batch)
+# =========================================
+state_writer.start()
+atexit.register(state_writer.stop)
+# Nhật ký sự kiện (bảng logs) ghi theo batch bằng COPY; partition hôm nay / các ngày tới tạo trước khi
+# ghi dòng đầu tiên, không thì dòng rơi vào logs_default (retention của leader chạy sau)
+log_partitions.maintain(retention=False)
+event_log.start()
+atexit.register(event_log.stop)
+
+# Thread gửi trailing-edge cho brightness_change đã gộp
+brightness_coalescer.start()
+# Gửi thay đổi theo batch (delta mỗi PUSH_TICK) cho dashboard
+delta_pusher.start()
+
+# Nạp cache trạng thái thiết bị + chỉ mục device -> owner (phòng Socket.IO) trước khi nhận MQTT
+device_cache.warm()
+device_topics.load()
 
 # =========================================
 # INIT MQTT
 # =========================================
-mqtt_client = create_mqtt_client(on_message)
-mqtt_client.subscribe("home/+/+/state")
-mqtt_client.loop_start()
+# 1 kết nối dùng chung: connect bất đồng bộ, tự reconnect + subscribe lại, lệnh gửi qua hàng đợi
+mqtt_client = mqtt_gateway
+mqtt_client.set_on_message(on_message)
+# State chia giữa các worker ($share/...); heartbeat thì worker nào cũng nhận để leader
+# (có thể đổi bất kỳ lúc nào) luôn có bảng liveness đầy đủ
+mqtt_client.subscribe(shared_topic("home/+/+/state"))
 mqtt_client.subscribe("home/+/heartbeat")
+mqtt_client.start()
+atexit.register(mqtt_client.stop)
+# Chờ ack của lệnh, gửi lại qua hàng đợi MQTT khi quá hạn
+command_tracker.start(mqtt_client.publish)
+atexit.register(command_tracker.stop)
+
+# =========================================
+# METRICS (GET /metrics): gauge chỉ được đọc khi Prometheus scrape
+# =========================================
+stat_gauge("smart_light_db_pool_in_use", "Database connections checked out", get_pool_stats, "in_use")
+stat_gauge("smart_light_db_pool_waiting", "Threads waiting for a database connection", get_pool_stats, "waiting")
+stat_gauge("smart_light_state_writer_queue_depth", "State updates waiting to be written", state_writer.stats, "queue_depth")
+stat_gauge("smart_light_event_log_buffer_depth", "Events waiting to be copied into logs", event_log.stats, "buffer_depth")
+stat_gauge("smart_light_mqtt_outbound_queue_depth", "MQTT messages waiting to be published", mqtt_client.stats, "queue_depth")
+stat_gauge("smart_light_devices_offline", "Devices currently marked offline", offline_detector.stats, "offline_devices")
 # =========================================
 # USER ROUTES
 # =========================================
@@ -139,7 +187,6 @@ def home():
 @app.route("/control/<device_id>")
 @require_login
 def control(device_id):
-    print("hello")
     return render_template("index.html", device_id=device_id)
 
 
@@ -148,12 +195,116 @@ def control(device_id):
 # =========================================
 @app.route("/api/devices", methods=["GET"])
 def get_devices():
-    return jsonify(get_all_devices()), 200
+    if CLUSTER_MODE:
+        device_cache.refresh_if_stale(CACHE_MAX_AGE)
+    if not device_cache.warmed:
+        return jsonify(get_all_devices()), 200
+
+    # Phục vụ từ cache; snapshot không đổi thì trả 304 theo ETag
+    snap = device_cache.snapshot()
+    response = Response(snap.body, status=200, mimetype="application/json")
+    response.set_etag(snap.etag)
+    return response.make_conditional(request)
+
+
+@app.route("/api/devices/<device_id>/usage", methods=["GET"])
+@require_login
+def device_usage(device_id):
+    # Thời gian bật + điện năng ước lượng theo phút/giờ/ngày, đọc từ bảng rollup; chỉ chủ device hoặc admin
+    device_num = device_for_user(session["user_id"], device_id)
+    if device_num is None:
+        return jsonify({"error": "Không tìm thấy device"}), 404
+    response, status = get_usage(device_id, device_num, request.args.get("range", DEFAULT_RANGE))
+    return jsonify(response), status
+
+
+@app.route("/api/devices/<device_id>/logs", methods=["GET"])
+@require_login
+def device_logs(device_id):
+    # Sự kiện gần nhất (đổi trạng thái, lệnh, lịch, offline), tối đa 500; chỉ chủ device hoặc admin
+    device_num = device_for_user(session["user_id"], device_id)
+    if device_num is None:
+        return jsonify({"error": "Không tìm thấy device"}), 404
+    response, status = get_device_logs(device_num, request.args.get("limit", 50))
+    return jsonify(response), status
+
+
+@app.route("/api/usage/stats", methods=["GET"])
+def usage_stats():
+    return jsonify(usage.stats()), 200
+
+
+@app.route("/api/db/pool", methods=["GET"])
+def db_pool_stats():
+    # Thống kê pool kết nối DB (in_use, waiting, histogram checkout) để chỉnh POOL_MAX_SIZE
+    # + số lần PREPARE / EXECUTE của repository
+    stats = get_pool_stats()
+    stats["repository"] = repository_stats()
+    return jsonify(stats), 200
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    # Định dạng text của Prometheus: MQTT, truy vấn DB, scheduler, Socket.IO, độ sâu các hàng đợi
+    return Response(render_metrics(), content_type=METRICS_CONTENT_TYPE)
+
+
+@app.route("/api/db/writer", methods=["GET"])
+def db_writer_stats():
+    # Độ sâu hàng đợi, số bản ghi bị gộp/bỏ, thời gian flush của state writer
+    return jsonify(state_writer.stats()), 200
+
+
+@app.route("/api/db/liveness", methods=["GET"])
+def db_liveness_stats():
+    stats = liveness.stats()
+    stats["offline_detector"] = offline_detector.stats()
+    return jsonify(stats), 200
+
+
+@app.route("/api/db/cache", methods=["GET"])
+def db_cache_stats():
+    # Cache thiết bị + cache hồ sơ user (hit/miss)
+    stats = device_cache.stats()
+    stats["users"] = user_cache.stats()
+    return jsonify(stats), 200
+
+
+@app.route("/api/auth/hashing", methods=["GET"])
+def auth_hashing_stats():
+    # Cost scrypt, số yêu cầu đang chờ / bị từ chối khi pool băm mật khẩu đầy, thời gian băm trung bình
+    return jsonify(password_pool.stats()), 200
+
+
+@app.route("/api/db/events", methods=["GET"])
+def db_events_stats():
+    # Độ sâu buffer nhật ký, số sự kiện bị bỏ khi đầy, số dòng đã COPY, partition của logs
+    stats = event_log.stats()
+    stats["partitions"] = log_partitions.stats()
+    return jsonify(stats), 200
 
 
 @app.route("/api/device/command", methods=["POST"])
 def device_command():
     response, status = process_device_command(mqtt_client, request.json)
+    # ?wait=1: chờ đèn xác nhận (tối đa SYNC_WAIT_MAX giây), 504 nếu chưa có ack
+    wait = sync_wait_seconds(request.args.get("wait"))
+    if wait and status == 200:
+        response["ack"] = command_tracker.wait(response["cmd_id"], wait)
+        status = 200 if response["ack"]["status"] == ACKED else 504
+    return jsonify(response), status
+
+
+@app.route("/api/commands/stats", methods=["GET"])
+def command_stats():
+    # Lệnh đang chờ ack, số lệnh ack/failed/gửi lại, độ trễ lệnh -> ack; ?device=<device_name> cho 1 device
+    return jsonify(command_tracker.stats(request.args.get("device"))), 200
+
+
+@app.route("/api/device/bulk-command", methods=["POST"])
+@require_login
+def device_bulk_command():
+    response, status = process_bulk_command(mqtt_client, request.json, session["user_id"])
     return jsonify(response), status
 
 
@@ -166,7 +317,10 @@ def get_device_schedule(device_id):
     """
     THÊM: Lấy lịch hẹn giờ của thiết bị từ database
     """
-    schedule = get_schedule(device_id)
+    device_num = device_for_user(session["user_id"], device_id)
+    if device_num is None:
+        return jsonify({"error": "Không tìm thấy device"}), 404
+    schedule = get_schedule(device_num)
     return jsonify(schedule), 200
 
 
@@ -179,24 +333,67 @@ def save_device_schedule(device_id):
     data = request.json
     start_time = data.get("start_time")
     end_time = data.get("end_time")
-    print("Received schedule data:", data)
+    log.debug("Received schedule data: %s", data)
     
     if not start_time or not end_time:
         return jsonify({"error": "Thiếu start_time hoặc end_time"}), 400
     
-    success = save_schedule(device_id, start_time, end_time)
+    repeat = data.get("repeat", "daily")
+    if repeat not in ("none", "daily", "weekly"):
+        return jsonify({"error": "repeat phải là none, daily hoặc weekly"}), 400
+    device_num = device_for_user(session["user_id"], device_id)
+    if device_num is None:
+        return jsonify({"error": "Không tìm thấy device"}), 404
+
+    success = save_schedule(device_num, start_time, end_time, repeat)
     if success:
         return jsonify({"message": "Lịch hẹn giờ đã được lưu"}), 200
     else:
         return jsonify({"error": "Lỗi lưu lịch hẹn giờ"}), 500
 
 
-if __name__ == "__main__":
+@app.route("/api/device/brightness-stats", methods=["GET"])
+def brightness_stats():
+    # Số sự kiện brightness_change nhận được / đã gửi MQTT / bị gộp
+    return jsonify(brightness_coalescer.stats()), 200
+
+
+@app.route("/api/push/stats", methods=["GET"])
+def push_stats():
+    # Số dashboard đang nhận push, số frame/trường đã gửi, số lần gửi snapshot
+    return jsonify(delta_pusher.stats()), 200
+
+
+@app.route("/api/mqtt/stats", methods=["GET"])
+def mqtt_stats():
+    # Trạng thái kết nối, độ sâu hàng đợi gửi, độ trễ publish; ingest: bộ decode và message bị loại
+    return jsonify({**mqtt_client.stats(), "ingest": dead_letters.stats()}), 200
+
+
+@app.route("/api/cluster", methods=["GET"])
+def cluster_stats():
+    # Worker hiện tại, có đang là leader không, có dùng message queue không
+    return jsonify(cluster_info(leader_election)), 200
+
+
+@app.route("/api/scheduler/stats", methods=["GET"])
+def scheduler_stats():
+    engine = scheduler_module.schedule_engine
+    if engine is None:
+        return jsonify({"error": "Scheduler chưa chạy"}), 503
+    return jsonify(engine.stats()), 200
+
+
+def run(host="0.0.0.0", port=5000):
     db_conn = get_db_connection()
     if db_conn:
-        print("DB OK")
+        log.info("DB OK")
         db_conn.close()
-    # socketio.start_background_task(target=offline_checker)
-    # THÊM: Khởi chạy background scheduler thread
-    socketio.start_background_task(target=schedule_executor, socketio=socketio, mqtt_client=mqtt_client)
-    socketio.run(app, host="0.0.0.0", port=5000, debug=True,use_reloader=False)
+        # Mở sẵn POOL_MIN_SIZE kết nối cho MQTT thread / background task
+        db_pool.warmup()
+    start_background_tasks()
+    socketio.run(app, host=host, port=port, debug=True,use_reloader=False)
+
+
+if __name__ == "__main__":
+    run()
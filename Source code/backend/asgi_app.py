@@ -0,0 +1,586 @@
+# asgi_app.py
+# Runtime async: Starlette + python-socketio (ASGI) + aiomqtt + asyncpg trên 1 event loop.
+# Cùng các route và sự kiện Socket.IO với app.py. Chạy bằng: python main.py --runtime async
+# (hoặc: uvicorn asgi_app:app --host 0.0.0.0 --port 5000)
+#
+# Luồng nóng (ingest MQTT, ghi trạng thái, checkpoint heartbeat, offline, scheduler, /api/devices)
+# chạy hoàn toàn bằng coroutine. Các thao tác ít gặp (đăng nhập/đăng kí, CRUD schedule,
+# kiểm tra đích lệnh hàng loạt) dùng lại hàm của controller qua threadpool.
+import os
+import json
+import base64
+import asyncio
+import contextlib
+from functools import wraps
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+
+from itsdangerous import TimestampSigner, BadSignature
+
+import socketio as python_socketio
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.sessions import SessionMiddleware
+from starlette.responses import JSONResponse, RedirectResponse, Response
+from starlette.routing import Route
+from starlette.templating import Jinja2Templates
+
+from config.async_db import async_db
+from config.async_mqtt import async_mqtt_gateway
+from config.db import get_pool_stats
+from config.logger import get_logger
+from config.metrics import (
+    Gauge, instrument_socketio, stat_gauge, render as render_metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE,
+)
+from config.cluster import (
+    CLUSTER_MODE, SOCKETIO_MESSAGE_QUEUE, SOCKETIO_CHANNEL, CACHE_MAX_AGE, LeaderElection, shared_topic, cluster_info
+)
+from controller.auth import get_user_by_id
+from controller.user_controller import validate_registration
+from controller.devices import (
+    process_device_command, resolve_bulk_targets, send_bulk_command, get_all_devices, get_device_logs,
+    brightness_command, brightness_topic,
+)
+from controller.scheduler import get_schedule, save_schedule
+from controller.device_topics import device_for_user
+import controller.scheduler as scheduler_module
+from controller.liveness import liveness
+from controller.offline_detector import offline_detector
+from controller.device_cache import device_cache
+from controller.rooms import user_room, device_room, can_watch
+from controller.push import delta_pusher, dashboard_room, dashboard_scope, available_formats
+from controller.event_log import event_log
+from controller.log_partitions import log_partitions
+from controller.usage import usage, DEFAULT_RANGE
+from controller.user_cache import user_cache
+from controller.repository import stats as repository_stats
+from controller.passwords import password_pool, PasswordPoolBusy
+from controller.command_tracker import command_tracker, sync_wait_seconds, ACKED
+from controller.mqtt_decoder import dead_letters
+from controller.async_tasks import (
+    AsyncStateWriter, AsyncScheduleEngine, AsyncBrightnessCoalescer,
+    make_message_handler, make_schedule_fire, warm_cache, load_topics, seed_offline_detector,
+    liveness_loop, offline_loop, push_loop, event_log_loop, partition_loop, maintain_partitions, usage_loop, get_usage,
+    login_user, register_user, command_loop,
+)
+
+SECRET_KEY = 'smart_light_secret_key_2025'
+SESSION_COOKIE = "session"
+SESSION_MAX_AGE = 14 * 24 * 3600        # mặc định của SessionMiddleware
+log = get_logger("app")
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+
+# =========================================
+# SOCKET.IO / MQTT / WRITER
+# =========================================
+# Có SMART_LIGHT_MESSAGE_QUEUE thì emit đi qua Redis (cùng kênh với Flask-SocketIO)
+client_manager = (python_socketio.AsyncRedisManager(SOCKETIO_MESSAGE_QUEUE, channel=SOCKETIO_CHANNEL)
+                  if SOCKETIO_MESSAGE_QUEUE else None)
+sio = python_socketio.AsyncServer(async_mode="asgi", cors_allowed_origins="*", client_manager=client_manager)
+templates = Jinja2Templates(directory=TEMPLATES_DIR)
+
+mqtt_client = async_mqtt_gateway
+state_writer = AsyncStateWriter(async_db)
+
+# =========================================
+# METRICS (GET /metrics): gauge chỉ được đọc khi Prometheus scrape
+# =========================================
+instrument_socketio(sio)
+Gauge("smart_light_db_pool_in_use", "Database connections checked out",
+      lambda: async_db.stats()["size"] - async_db.stats()["idle"])
+stat_gauge("smart_light_state_writer_queue_depth", "State updates waiting to be written", state_writer.stats, "queue_depth")
+stat_gauge("smart_light_event_log_buffer_depth", "Events waiting to be copied into logs", event_log.stats, "buffer_depth")
+stat_gauge("smart_light_mqtt_outbound_queue_depth", "MQTT messages waiting to be published", mqtt_client.stats, "queue_depth")
+stat_gauge("smart_light_devices_offline", "Devices currently marked offline", offline_detector.stats, "offline_devices")
+
+
+def publish_brightness(topic, brightness):
+    if command_tracker.send(mqtt_client.publish, topic, brightness_command(brightness), "ws"):
+        event_log.record_command(topic.split("/")[2], {"brightness": brightness}, "ws")
+
+
+brightness_coalescer = AsyncBrightnessCoalescer(publish_brightness)
+
+
+def _session_user_id(environ):
+    """Đọc user_id từ cookie session của SessionMiddleware trong handshake Socket.IO."""
+    cookie = SimpleCookie(environ.get("HTTP_COOKIE", "")).get(SESSION_COOKIE)
+    if cookie is None:
+        return None
+    try:
+        data = TimestampSigner(SECRET_KEY).unsign(cookie.value.encode(), max_age=SESSION_MAX_AGE)
+        return json.loads(base64.b64decode(data)).get("user_id")
+    except (BadSignature, ValueError):
+        return None
+
+
+@sio.on("connect")
+async def handle_connect(sid, environ, auth=None):
+    user_id = _session_user_id(environ)
+    if user_id is None:
+        # Chưa đăng nhập: từ chối kết nối
+        return False
+    await sio.save_session(sid, {"user_id": user_id})
+    await sio.enter_room(sid, user_room(user_id))
+
+    device_name = parse_qs(environ.get("QUERY_STRING", "")).get("device_id", [None])[0] \
+        or (auth or {}).get("device_id")
+    if device_name and await run_in_threadpool(can_watch, user_id, device_name):
+        await sio.enter_room(sid, device_room(device_name))
+
+
+@sio.on("subscribe_device")
+async def handle_subscribe_device(sid, data):
+    user_id = (await sio.get_session(sid)).get("user_id")
+    device_name = (data or {}).get("device_id")
+    if user_id is None or not device_name or not await run_in_threadpool(can_watch, user_id, device_name):
+        return {"ok": False}
+    await sio.enter_room(sid, device_room(device_name))
+    return {"ok": True}
+
+
+@sio.on("unsubscribe_device")
+async def handle_unsubscribe_device(sid, data):
+    device_name = (data or {}).get("device_id")
+    if device_name:
+        await sio.leave_room(sid, device_room(device_name))
+    return {"ok": True}
+
+
+@sio.on("subscribe_dashboard")
+async def handle_subscribe_dashboard(sid, data):
+    user_id = (await sio.get_session(sid)).get("user_id")
+    fmt = (data or {}).get("format", "json")
+    if user_id is None or fmt not in available_formats():
+        return {"ok": False, "formats": list(available_formats())}
+    scope = await run_in_threadpool(dashboard_scope, user_id)
+    await sio.enter_room(sid, dashboard_room(scope, fmt))
+    # Như runtime threaded: dashboard chỉ nhận delta/snapshot, không nhận device_state_update của phòng user
+    await sio.leave_room(sid, user_room(user_id))
+    delta_pusher.subscribe(sid, scope, fmt)
+    return {"ok": True, "format": fmt}
+
+
+@sio.on("dashboard_resync")
+async def handle_dashboard_resync(sid, data=None):
+    delta_pusher.resync(sid)
+    return {"ok": True}
+
+
+@sio.on("disconnect")
+async def handle_disconnect(sid, *args):
+    delta_pusher.unsubscribe(sid)
+
+
+@sio.on("brightness_change")  # đồng bộ với frontend
+async def handle_brightness_command(sid, data):
+    topic = brightness_topic(data or {})
+    if topic:
+        brightness_coalescer.submit(topic, data["brightness"])
+    else:
+        log.warning("Invalid WS brightness payload: %s", data)
+
+
+# =========================================
+# HELPERS
+# =========================================
+def require_login(endpoint):
+    @wraps(endpoint)
+    async def wrapper(request):
+        if "user_id" not in request.session:
+            return RedirectResponse(request.url_for("login_page"), status_code=302)
+        return await endpoint(request)
+    return wrapper
+
+
+async def _json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+def _etag_matches(request, etag):
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    candidates = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return etag in candidates or "*" in candidates
+
+
+# =========================================
+# USER ROUTES
+# =========================================
+async def login_page(request):
+    if request.method == "GET":
+        return templates.TemplateResponse(request, "login.html")
+
+    data = await _json(request) or {}
+    username = data.get("username", "").strip()
+    password = data.get("password", "").strip()
+    if not username or not password:
+        return JSONResponse({"error": "Vui lòng nhập tên đăng nhập và mật khẩu"}, 400)
+
+    try:
+        user, error = await login_user(async_db, username, password)
+    except PasswordPoolBusy as e:
+        return JSONResponse({"error": str(e)}, 503)
+    if error:
+        return JSONResponse({"error": error}, 401)
+
+    request.session["user_id"] = user["user_id"]
+    return JSONResponse({"message": "Đăng nhập thành công", "user": user}, 200)
+
+
+async def register_page(request):
+    if request.method == "GET":
+        return templates.TemplateResponse(request, "login.html")
+
+    data = await _json(request) or {}
+    username = data.get("username", "").strip()
+    password = data.get("password", "").strip()
+    email = data.get("email", "").strip() or None
+    error = validate_registration(username, password, data.get("password_confirm", "").strip())
+    if error:
+        return JSONResponse({"error": error}, 400)
+
+    user, error = await register_user(async_db, username, password, email)
+    if error:
+        return JSONResponse({"error": error}, 400)
+
+    request.session["user_id"] = user["user_id"]
+    return JSONResponse({"message": "Đăng kí thành công", "user": user}, 201)
+
+
+async def logout(request):
+    request.session.pop("user_id", None)
+    return JSONResponse({"message": "Đã đăng xuất"}, 200)
+
+
+async def current_user(request):
+    if "user_id" not in request.session:
+        return JSONResponse({"error": "Chưa đăng nhập"}, 401)
+
+    # Cache hit trả lời ngay trên event loop, chỉ miss mới sang threadpool truy vấn DB
+    user_id = request.session["user_id"]
+    user = user_cache.get(user_id) or await run_in_threadpool(get_user_by_id, user_id)
+    if not user:
+        request.session.pop("user_id", None)
+        return JSONResponse({"error": "User không tồn tại"}, 404)
+    return JSONResponse(user, 200)
+
+
+# =========================================
+# MAIN ROUTES
+# =========================================
+@require_login
+async def home(request):
+    return templates.TemplateResponse(request, "dashboard.html")
+
+
+@require_login
+async def control(request):
+    return templates.TemplateResponse(request, "index.html", {"device_id": request.path_params["device_id"]})
+
+
+# =========================================
+# API — DEVICES
+# =========================================
+async def get_devices(request):
+    if not device_cache.warmed:
+        return JSONResponse(await run_in_threadpool(get_all_devices), 200)
+
+    # Phục vụ từ cache; snapshot không đổi thì trả 304 theo ETag
+    snap = device_cache.snapshot()
+    etag = f'"{snap.etag}"'
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(snap.body, status_code=200, media_type="application/json", headers={"ETag": etag})
+
+
+@require_login
+async def device_usage(request):
+    device = request.path_params["device_id"]
+    # Chủ device hoặc admin (có thể đọc 1 dòng devices nên chạy trong threadpool)
+    device_id = await run_in_threadpool(device_for_user, request.session["user_id"], device)
+    if device_id is None:
+        return JSONResponse({"error": "Không tìm thấy device"}, 404)
+    response, status = await get_usage(async_db, device, device_id, request.query_params.get("range", DEFAULT_RANGE))
+    return JSONResponse(response, status)
+
+
+@require_login
+async def device_logs(request):
+    device_id = await run_in_threadpool(device_for_user, request.session["user_id"], request.path_params["device_id"])
+    if device_id is None:
+        return JSONResponse({"error": "Không tìm thấy device"}, 404)
+    response, status = await run_in_threadpool(get_device_logs, device_id, request.query_params.get("limit", 50))
+    return JSONResponse(response, status)
+
+
+async def usage_stats(request):
+    return JSONResponse(usage.stats(), 200)
+
+
+async def db_pool_stats(request):
+    # Pool asyncpg cho luồng nóng + pool psycopg2 cho các thao tác chạy trong threadpool
+    threaded = get_pool_stats()
+    threaded["repository"] = repository_stats()
+    return JSONResponse({"async": async_db.stats(), "threaded": threaded}, 200)
+
+
+async def metrics(request):
+    return Response(render_metrics(), media_type=METRICS_CONTENT_TYPE)
+
+
+async def db_writer_stats(request):
+    return JSONResponse(state_writer.stats(), 200)
+
+
+async def db_liveness_stats(request):
+    stats = liveness.stats()
+    stats["offline_detector"] = offline_detector.stats()
+    return JSONResponse(stats, 200)
+
+
+async def db_cache_stats(request):
+    stats = device_cache.stats()
+    stats["users"] = user_cache.stats()
+    return JSONResponse(stats, 200)
+
+
+async def auth_hashing_stats(request):
+    return JSONResponse(password_pool.stats(), 200)
+
+
+async def db_events_stats(request):
+    stats = event_log.stats()
+    stats["partitions"] = log_partitions.stats()
+    return JSONResponse(stats, 200)
+
+
+async def device_command(request):
+    response, status = process_device_command(mqtt_client, await _json(request) or {})
+    wait = sync_wait_seconds(request.query_params.get("wait"))
+    if wait and status == 200:
+        response["ack"] = await command_tracker.wait_async(response["cmd_id"], wait)
+        status = 200 if response["ack"]["status"] == ACKED else 504
+    return JSONResponse(response, status)
+
+
+async def command_stats(request):
+    return JSONResponse(command_tracker.stats(request.query_params.get("device")), 200)
+
+
+@require_login
+async def device_bulk_command(request):
+    data = await _json(request) or {}
+    rows, missing, error = await run_in_threadpool(resolve_bulk_targets, data, request.session["user_id"])
+    if error:
+        message, status = error
+        return JSONResponse({"error": message}, status)
+    response, status = send_bulk_command(mqtt_client, data, rows, missing)
+    return JSONResponse(response, status)
+
+
+# =========================================
+# API — SCHEDULER
+# =========================================
+@require_login
+async def device_schedule(request):
+    # Chủ device hoặc admin; device mới chưa có trong chỉ mục device_topics được đọc từ DB
+    device_id = await run_in_threadpool(device_for_user, request.session["user_id"], request.path_params["device_id"])
+    if device_id is None:
+        return JSONResponse({"error": "Không tìm thấy device"}, 404)
+    if request.method == "GET":
+        return JSONResponse(await run_in_threadpool(get_schedule, device_id), 200)
+
+    data = await _json(request) or {}
+    start_time = data.get("start_time")
+    end_time = data.get("end_time")
+    if not start_time or not end_time:
+        return JSONResponse({"error": "Thiếu start_time hoặc end_time"}, 400)
+
+    repeat = data.get("repeat", "daily")
+    if repeat not in ("none", "daily", "weekly"):
+        return JSONResponse({"error": "repeat phải là none, daily hoặc weekly"}, 400)
+
+    # save_schedule gọi reload_device của engine, engine tự đánh thức vòng lặp async
+    success = await run_in_threadpool(save_schedule, device_id, start_time, end_time, repeat)
+    if success:
+        return JSONResponse({"message": "Lịch hẹn giờ đã được lưu"}, 200)
+    return JSONResponse({"error": "Lỗi lưu lịch hẹn giờ"}, 500)
+
+
+async def brightness_stats(request):
+    return JSONResponse(brightness_coalescer.stats(), 200)
+
+
+async def push_stats(request):
+    return JSONResponse(delta_pusher.stats(), 200)
+
+
+async def mqtt_stats(request):
+    return JSONResponse({**mqtt_client.stats(), "ingest": dead_letters.stats()}, 200)
+
+
+async def cluster_stats(request):
+    return JSONResponse(cluster_info(leader_election), 200)
+
+
+async def scheduler_stats(request):
+    engine = scheduler_module.schedule_engine
+    if engine is None:
+        return JSONResponse({"error": "Scheduler chưa chạy"}, 503)
+    return JSONResponse(engine.stats(), 200)
+
+
+# =========================================
+# TÁC VỤ LEADER (scheduler, offline, checkpoint)
+# =========================================
+leader_election = None
+leader_tasks = []
+
+
+def start_leader_duties():
+    if leader_tasks or not async_db.ready:
+        return
+    loop = asyncio.get_running_loop()
+    leader_tasks.append(asyncio.create_task(offline_loop(async_db, sio.emit), name="offline-detector"))
+    leader_tasks.append(asyncio.create_task(liveness_loop(async_db), name="liveness-checkpoint"))
+    leader_tasks.append(asyncio.create_task(partition_loop(async_db), name="log-partitions"))
+    leader_tasks.append(asyncio.create_task(usage_loop(async_db), name="usage-rollup"))
+    engine = AsyncScheduleEngine(async_db, make_schedule_fire(async_db, mqtt_client, sio.emit), loop)
+    scheduler_module.schedule_engine = engine
+    leader_tasks.append(asyncio.create_task(engine.run_async(), name="scheduler"))
+    log.info("Scheduler executor bắt đầu chạy")
+
+
+async def stop_leader_duties():
+    engine = scheduler_module.schedule_engine
+    if engine is not None:
+        engine.stop()
+        scheduler_module.schedule_engine = None
+    tasks = leader_tasks[:]
+    leader_tasks.clear()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def cache_refresh_loop():
+    # Nhiều worker: state do worker khác ghi chỉ thấy qua DB
+    while True:
+        await asyncio.sleep(CACHE_MAX_AGE)
+        try:
+            await warm_cache(async_db)
+        except Exception as e:
+            log.error("Device cache refresh error: %s", e)
+
+
+# =========================================
+# STARTUP / SHUTDOWN
+# =========================================
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    global leader_election
+    loop = asyncio.get_running_loop()
+    tasks = []
+
+    try:
+        await async_db.start()
+        log.info("DB OK")
+        # Nạp cache trạng thái + deadline offline trước khi nhận MQTT
+        await warm_cache(async_db)
+        await load_topics(async_db)
+        await seed_offline_detector(async_db)
+        # Partition hôm nay / các ngày tới có trước khi event_log ghi (retention chỉ leader chạy)
+        await maintain_partitions(async_db, retention=False)
+    except Exception as e:
+        log.error("Lỗi kết nối database: %s", e)
+
+    mqtt_client.set_on_message(make_message_handler(state_writer, sio.emit))
+    # State chia giữa các worker ($share/...); heartbeat thì worker nào cũng nhận
+    mqtt_client.subscribe(shared_topic("home/+/+/state"))
+    mqtt_client.subscribe("home/+/heartbeat")
+    mqtt_client.start()
+    brightness_coalescer.start()
+
+    tasks.append(asyncio.create_task(push_loop(sio), name="dashboard-push"))
+    tasks.append(asyncio.create_task(command_loop(mqtt_client), name="command-tracker"))
+    if async_db.ready:
+        tasks.append(asyncio.create_task(state_writer.run(), name="state-writer"))
+        tasks.append(asyncio.create_task(event_log_loop(async_db), name="event-log"))
+    if not CLUSTER_MODE:
+        start_leader_duties()
+    else:
+        tasks.append(asyncio.create_task(cache_refresh_loop(), name="device-cache-refresh"))
+        # Thread bầu leader gọi ngược về event loop
+        leader_election = LeaderElection(
+            on_elected=lambda: loop.call_soon_threadsafe(start_leader_duties),
+            on_demoted=lambda: asyncio.run_coroutine_threadsafe(stop_leader_duties(), loop),
+        )
+        leader_election.start()
+
+    try:
+        yield
+    finally:
+        if leader_election is not None:
+            await run_in_threadpool(leader_election.stop)
+        await stop_leader_duties()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await mqtt_client.stop()
+        await async_db.close()
+
+
+web = Starlette(
+    routes=[
+        Route("/login", login_page, methods=["GET", "POST"], name="login_page"),
+        Route("/register", register_page, methods=["GET", "POST"]),
+        Route("/logout", logout, methods=["POST"]),
+        Route("/api/current-user", current_user, methods=["GET"]),
+        Route("/", home),
+        Route("/control/{device_id}", control),
+        Route("/api/devices", get_devices, methods=["GET"]),
+        Route("/api/devices/{device_id}/usage", device_usage, methods=["GET"]),
+        Route("/api/devices/{device_id}/logs", device_logs, methods=["GET"]),
+        Route("/api/usage/stats", usage_stats, methods=["GET"]),
+        Route("/api/db/pool", db_pool_stats, methods=["GET"]),
+        Route("/metrics", metrics, methods=["GET"]),
+        Route("/api/db/writer", db_writer_stats, methods=["GET"]),
+        Route("/api/db/liveness", db_liveness_stats, methods=["GET"]),
+        Route("/api/db/cache", db_cache_stats, methods=["GET"]),
+        Route("/api/db/events", db_events_stats, methods=["GET"]),
+        Route("/api/auth/hashing", auth_hashing_stats, methods=["GET"]),
+        Route("/api/device/command", device_command, methods=["POST"]),
+        Route("/api/device/bulk-command", device_bulk_command, methods=["POST"]),
+        Route("/api/commands/stats", command_stats, methods=["GET"]),
+        Route("/api/schedule/{device_id}", device_schedule, methods=["GET", "POST"]),
+        Route("/api/device/brightness-stats", brightness_stats, methods=["GET"]),
+        Route("/api/push/stats", push_stats, methods=["GET"]),
+        Route("/api/mqtt/stats", mqtt_stats, methods=["GET"]),
+        Route("/api/cluster", cluster_stats, methods=["GET"]),
+        Route("/api/scheduler/stats", scheduler_stats, methods=["GET"]),
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"]),
+        Middleware(SessionMiddleware, secret_key=SECRET_KEY, session_cookie=SESSION_COOKIE, max_age=SESSION_MAX_AGE),
+    ],
+    lifespan=lifespan,
+)
+
+# Socket.IO ở /socket.io, còn lại chuyển cho Starlette (kể cả lifespan)
+app = python_socketio.ASGIApp(sio, other_asgi_app=web)
+
+
+def run(host="0.0.0.0", port=5000):
+    import uvicorn
+    uvicorn.run(app, host=host, port=port)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,75 @@
+# benchmarks/bench_emit_fanout.py
+# So sánh chi phí emit device_state_update: broadcast tới mọi client (cách cũ)
+# với emit theo phòng user/device (controller/rooms.py).
+#
+# Không cần DB/broker: client là các sid giả trong manager của python-socketio,
+# _send_eio_packet được thay bằng bộ đếm nên chỉ đo phần server (chọn người nhận + gửi packet).
+#
+#   cd "Source code/backend"
+#   python benchmarks/bench_emit_fanout.py --clients 1000 --devices 10000 --users 100
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import socketio as python_socketio
+
+from controller.device_topics import device_topics
+from controller.rooms import user_room, device_room, state_rooms
+
+
+def build_server(clients, devices, users):
+    server = python_socketio.Server()
+    sent = [0]
+
+    def count_packet(eio_sid, pkt):
+        sent[0] += 1
+    server._send_eio_packet = count_packet
+
+    # device i thuộc user (i % users) + 1
+    device_topics.load_rows(
+        [(i, f"light{i}", (i % users) + 1) for i in range(devices)], complete=True
+    )
+
+    # client c đăng nhập bằng user (c % users) + 1 và đang mở trang của 1 device của user đó
+    for c in range(clients):
+        user_id = (c % users) + 1
+        sid = server.manager.connect(f"eio{c}", "/")
+        server.manager.enter_room(sid, "/", user_room(user_id))
+        server.manager.enter_room(sid, "/", device_room(f"light{(c * users + user_id - 1) % devices}"))
+    return server, sent
+
+
+def run(server, sent, devices, scoped):
+    sent[0] = 0
+    start = time.perf_counter()
+    for i in range(devices):
+        data = {"device_id": f"light{i}", "state": "on", "mode": "manual", "brightness": 80}
+        if scoped:
+            server.emit("device_state_update", data, to=state_rooms(data["device_id"]))
+        else:
+            server.emit("device_state_update", data)
+    return time.perf_counter() - start, sent[0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--devices", type=int, default=10000)
+    parser.add_argument("--users", type=int, default=100)
+    args = parser.parse_args()
+
+    server, sent = build_server(args.clients, args.devices, args.users)
+    print(f"{args.clients} clients, {args.devices} devices, {args.users} users; "
+          f"1 update cho mỗi device ({args.devices} emit)")
+    print(f"{'mode':<10}{'packets':>14}{'packets/update':>16}{'seconds':>10}{'us/update':>12}")
+    for name, scoped in (("broadcast", False), ("rooms", True)):
+        elapsed, packets = run(server, sent, args.devices, scoped)
+        print(f"{name:<10}{packets:>14,}{packets / args.devices:>16.1f}{elapsed:>10.3f}"
+              f"{elapsed / args.devices * 1e6:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,529 @@
+# benchmarks/bench_fleet.py
+# Load test end-to-end với đội đèn ESP32 ảo: mỗi board ảo giống firmware esp32_smart_light.ino
+# (2 đèn, subscribe home/<user>/<device>/cmd, xử lý lệnh như callback() rồi publish state,
+# heartbeat home/<user>/heartbeat mỗi 5 giây kèm danh sách device).
+# Bộ điều khiển gửi lệnh qua POST /api/device/command, nhận device_state_update qua Socket.IO và đo:
+#   http            POST trả về
+#   cmd_to_device   POST -> đèn ảo nhận lệnh MQTT
+#   device_to_ws    đèn publish state -> backend -> Socket.IO tới client
+#   end_to_end      POST -> client Socket.IO thấy trạng thái mới
+# cùng số lệnh/giây và tải DB (pg_stat_database + /api/db/pool, /api/db/writer của backend).
+# Kết quả lưu JSON trong benchmarks/results/ để so giữa các phiên bản (lệnh compare).
+#
+#   cd "Source code/backend"
+#   pip install -r requirements-bench.txt
+#   python benchmarks/bench_fleet.py seed --devices 10000          # user "bench" + device bench1..benchN
+#   python benchmarks/mini_broker.py --port 1883 &                 # hoặc mosquitto
+#   SMART_LIGHT_MQTT_HOST=127.0.0.1 python main.py &               # khởi động SAU khi seed (nạp cache)
+#   python benchmarks/bench_fleet.py run --devices 100,1000,10000 --duration 30
+#   python benchmarks/bench_fleet.py compare results/a.json results/b.json
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import subprocess
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+HEARTBEAT_INTERVAL = 5.0        # giây, như HEARTBEAT_INTERVAL của firmware
+LAMPS_PER_BOARD = 2             # light1 + light2 trên 1 board
+DEVICE_PREFIX = "bench"
+BENCH_USER = "bench"
+BENCH_PASSWORD = "bench123"
+COMMAND_TIMEOUT = 5.0           # giây chờ trạng thái về tới Socket.IO
+SUBSCRIBE_CHUNK = 500
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+PG_COUNTERS = ("xact_commit", "xact_rollback", "tup_inserted", "tup_updated", "tup_deleted",
+               "tup_fetched", "blks_read", "blks_hit")
+
+
+def percentiles(values):
+    if not values:
+        return {"count": 0, "p50": None, "p99": None, "max": None}
+    ordered = sorted(values)
+    pick = lambda q: round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 2)
+    return {"count": len(ordered), "p50": pick(0.5), "p99": pick(0.99), "max": round(ordered[-1], 2)}
+
+
+def numeric_delta(before, after):
+    """Hiệu các trường số (kể cả dict lồng nhau) giữa 2 lần chụp thống kê."""
+    if not isinstance(before, dict) or not isinstance(after, dict):
+        return None
+    delta = {}
+    for key, value in after.items():
+        old = before.get(key)
+        if isinstance(value, (int, float)) and not isinstance(value, bool) and isinstance(old, (int, float)):
+            delta[key] = round(value - old, 3)
+        elif isinstance(value, dict):
+            nested = numeric_delta(old, value)
+            if nested:
+                delta[key] = nested
+    return delta
+
+
+# ====================
+# ĐÈN ẢO (giống firmware)
+# ====================
+class Lamp:
+    __slots__ = ("name", "state", "mode", "brightness")
+
+    def __init__(self, name):
+        self.name = name
+        self.state = "off"
+        self.mode = "manual"
+        self.brightness = 100
+
+    def set_light(self, new_state, brightness):
+        if new_state:
+            self.state = new_state
+        if brightness >= 0:
+            self.brightness = brightness
+
+    def apply(self, data):
+        """callback() của firmware cho 1 đèn."""
+        state_cmd = data.get("state") or ""
+        brightness_cmd = data.get("brightness")
+        brightness_cmd = -1 if brightness_cmd is None else int(brightness_cmd)
+        mode_cmd = data.get("mode") or ""
+
+        if mode_cmd:
+            self.mode = mode_cmd
+        if self.mode == "manual":
+            if state_cmd in ("on", "off"):
+                self.set_light(state_cmd, brightness_cmd)
+            elif brightness_cmd >= 0:
+                self.set_light("on", brightness_cmd)
+        else:
+            if state_cmd == "off":
+                self.set_light("off", -1)
+            if brightness_cmd >= 0:
+                self.set_light("", brightness_cmd)
+
+    def state_payload(self, uptime, cmd_id=None):
+        payload = {"device_id": self.name, "state": self.state, "brightness": self.brightness,
+                   "mode": self.mode, "timestamp": int(uptime)}
+        if cmd_id:
+            payload["cmd_id"] = cmd_id      # như firmware: gửi lại cmd_id để backend ack lệnh
+        return json.dumps(payload)
+
+
+class Tracker:
+    """Lệnh đang chờ theo device; mỗi device chỉ có tối đa 1 lệnh chờ (worker giữ tập device riêng)."""
+
+    def __init__(self):
+        self.pending = {}           # device -> Pending
+
+    def device_received(self, device, data):
+        pending = self.pending.get(device)
+        if pending is not None and pending.t_device is None and data.get("brightness") == pending.brightness:
+            pending.t_device = time.perf_counter()
+
+    def ws_received(self, data):
+        pending = self.pending.get(data.get("device_id"))
+        if pending is None or pending.done.done():
+            return
+        if data.get("brightness") == pending.brightness and data.get("state") == "on":
+            pending.t_ws = time.perf_counter()
+            pending.done.set_result(True)
+
+
+class Pending:
+    __slots__ = ("brightness", "t0", "t_http", "t_device", "t_ws", "done")
+
+    def __init__(self, brightness):
+        self.brightness = brightness
+        self.t0 = time.perf_counter()
+        self.t_http = self.t_device = self.t_ws = None
+        self.done = asyncio.get_running_loop().create_future()
+
+
+class Fleet:
+    """N đèn ảo chia cho `connections` kết nối MQTT (1 kết nối phục vụ nhiều board)."""
+
+    def __init__(self, host, port, topic_user, devices, connections, tracker):
+        self.host = host
+        self.port = port
+        self.topic_user = topic_user
+        self.tracker = tracker
+        self.lamps = {f"{DEVICE_PREFIX}{i}": Lamp(f"{DEVICE_PREFIX}{i}") for i in range(1, devices + 1)}
+        names = list(self.lamps)
+        boards = [names[i:i + LAMPS_PER_BOARD] for i in range(0, len(names), LAMPS_PER_BOARD)]
+        connections = max(1, min(connections, len(boards)))
+        self.shards = [boards[k::connections] for k in range(connections)]
+        self._tasks = []
+        self._ready = 0
+        self.started_at = time.monotonic()
+
+        self.commands = 0
+        self.states = 0
+        self.heartbeats = 0
+
+    def cmd_topic(self, device):
+        return f"home/{self.topic_user}/{device}/cmd"
+
+    def state_topic(self, device):
+        return f"home/{self.topic_user}/{device}/state"
+
+    async def _publish_state(self, client, lamp, cmd_id=None):
+        await client.publish(self.state_topic(lamp.name),
+                             lamp.state_payload(time.monotonic() - self.started_at, cmd_id))
+        self.states += 1
+
+    async def _heartbeats(self, client, boards):
+        # Rải đều các board trong chu kỳ 5 giây như các ESP32 bật lên ở thời điểm khác nhau
+        topic = f"home/{self.topic_user}/heartbeat"
+        step = HEARTBEAT_INTERVAL / max(1, len(boards))
+        while True:
+            for board in boards:
+                payload = json.dumps({"timestamp": int(time.monotonic() - self.started_at), "devices": board})
+                await client.publish(topic, payload)
+                self.heartbeats += 1
+                await asyncio.sleep(step)
+
+    async def _run_shard(self, index, boards):
+        import aiomqtt
+
+        async with aiomqtt.Client(self.host, self.port, identifier=f"fleet-{os.getpid()}-{index}",
+                                  keepalive=60, max_queued_outgoing_messages=100000) as client:
+            topics = [(self.cmd_topic(name), 1) for board in boards for name in board]
+            for i in range(0, len(topics), SUBSCRIBE_CHUNK):
+                await client.subscribe(topics[i:i + SUBSCRIBE_CHUNK])
+            # Như reconnectMQTT(): publish state hiện tại ngay khi kết nối
+            for board in boards:
+                for name in board:
+                    await self._publish_state(client, self.lamps[name])
+            self._ready += 1
+
+            heartbeat = asyncio.create_task(self._heartbeats(client, boards))
+            try:
+                async for message in client.messages:
+                    device = message.topic.value.split("/")[2]
+                    lamp = self.lamps.get(device)
+                    if lamp is None:
+                        continue
+                    try:
+                        data = json.loads(message.payload)
+                    except ValueError:
+                        continue        # firmware: "Failed to parse JSON!"
+                    self.commands += 1
+                    self.tracker.device_received(device, data)
+                    lamp.apply(data)
+                    await self._publish_state(client, lamp, data.get("cmd_id"))
+            finally:
+                heartbeat.cancel()
+
+    async def start(self, timeout=60):
+        self._tasks = [asyncio.create_task(self._run_shard(i, boards)) for i, boards in enumerate(self.shards)]
+        deadline = time.monotonic() + timeout
+        while self._ready < len(self.shards):
+            for task in self._tasks:
+                if task.done() and task.exception():
+                    raise task.exception()
+            if time.monotonic() > deadline:
+                raise TimeoutError("Fleet không kết nối xong tới broker")
+            await asyncio.sleep(0.05)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self):
+        return {"boards": sum(len(s) for s in self.shards), "mqtt_connections": len(self.shards),
+                "commands_received": self.commands, "states_published": self.states,
+                "heartbeats_published": self.heartbeats}
+
+
+# ====================
+# THỐNG KÊ DB / BACKEND
+# ====================
+def pg_snapshot():
+    try:
+        import psycopg2
+        from config.db import DB_CONFIG
+        conn = psycopg2.connect(**DB_CONFIG)
+    except Exception as e:
+        print(f"⚠️ Không đọc được pg_stat_database: {e}")
+        return None
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT {', '.join(PG_COUNTERS)} FROM pg_stat_database WHERE datname = current_database()")
+        row = cursor.fetchone()
+        cursor.execute("SELECT count(*) FROM pg_stat_activity WHERE datname = current_database()")
+        connections = cursor.fetchone()[0]
+        return dict(zip(PG_COUNTERS, row), connections=connections)
+    finally:
+        conn.close()
+
+
+async def backend_snapshot(http, base_url):
+    stats = {}
+    for name in ("db/pool", "db/writer", "mqtt/stats"):
+        try:
+            async with http.get(f"{base_url}/api/{name}") as response:
+                stats[name] = await response.json() if response.status == 200 else None
+        except Exception:
+            stats[name] = None
+    return stats
+
+
+# ====================
+# CHẠY 1 MỨC SỐ DEVICE
+# ====================
+async def login(http, base_url, username, password):
+    async with http.post(f"{base_url}/login", json={"username": username, "password": password}) as response:
+        body = await response.json()
+        if response.status != 200:
+            raise RuntimeError(f"Đăng nhập {username} lỗi: {body}")
+    cookie = "; ".join(f"{c.key}={c.value}" for c in http.cookie_jar)
+    return body["user"], cookie
+
+
+async def connect_watchers(base_url, cookie, count, tracker):
+    import socketio as python_socketio
+
+    watchers = []
+    for _ in range(count):
+        client = python_socketio.AsyncClient(reconnection=False)
+        client.on("device_state_update", tracker.ws_received)
+        await client.connect(base_url, headers={"Cookie": cookie}, transports=["websocket"])
+        watchers.append(client)
+    return watchers
+
+
+async def drive(http, base_url, topic_user, devices, tracker, samples, deadline):
+    """1 worker vòng kín: gửi lệnh, chờ trạng thái về tới Socket.IO rồi mới gửi lệnh kế."""
+    while time.monotonic() < deadline:
+        device = random.choice(devices)
+        brightness = random.randint(1, 100)
+        pending = tracker.pending[device] = Pending(brightness)
+        try:
+            async with http.post(f"{base_url}/api/device/command", json={
+                "user_id": topic_user, "device_id": device, "state": "on", "brightness": brightness,
+            }) as response:
+                await response.read()
+                pending.t_http = time.perf_counter()
+                if response.status != 200:
+                    samples["errors"] += 1
+                    continue
+            await asyncio.wait_for(pending.done, COMMAND_TIMEOUT)
+        except asyncio.TimeoutError:
+            samples["timeouts"] += 1
+            continue
+        except Exception:
+            samples["errors"] += 1
+            continue
+        finally:
+            tracker.pending.pop(device, None)
+
+        ms = lambda a, b: (b - a) * 1000
+        samples["http"].append(ms(pending.t0, pending.t_http))
+        samples["end_to_end"].append(ms(pending.t0, pending.t_ws))
+        if pending.t_device is not None:
+            samples["cmd_to_device"].append(ms(pending.t0, pending.t_device))
+            samples["device_to_ws"].append(ms(pending.t_device, pending.t_ws))
+
+
+async def run_scale(args, devices):
+    import aiohttp
+
+    tracker = Tracker()
+    timeout = aiohttp.ClientTimeout(total=COMMAND_TIMEOUT)
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as http:
+        user, cookie = await login(http, args.url, args.username, args.password)
+        topic_user = args.topic_user or f"user{user['user_id']}"
+        fleet = Fleet(args.broker_host, args.broker_port, topic_user, devices, args.mqtt_connections, tracker)
+        watchers = []
+        try:
+            await fleet.start()
+            watchers = await connect_watchers(args.url, cookie, args.watchers, tracker)
+            print(f"==> {devices} devices online ({fleet.stats()['mqtt_connections']} kết nối MQTT), "
+                  f"warmup {args.warmup}s")
+            await asyncio.sleep(args.warmup)
+
+            pg_before, backend_before = pg_snapshot(), await backend_snapshot(http, args.url)
+            samples = {"http": [], "cmd_to_device": [], "device_to_ws": [], "end_to_end": [],
+                       "timeouts": 0, "errors": 0}
+            # Mỗi worker giữ 1 phần device riêng để 1 device không có 2 lệnh chờ cùng lúc
+            names = list(fleet.lamps)
+            workers = max(1, min(args.concurrency, len(names)))
+            start = time.monotonic()
+            deadline = start + args.duration
+            await asyncio.gather(*(drive(http, args.url, topic_user, names[k::workers], tracker, samples, deadline)
+                                   for k in range(workers)))
+            elapsed = time.monotonic() - start
+            pg_after, backend_after = pg_snapshot(), await backend_snapshot(http, args.url)
+        finally:
+            for client in watchers:
+                await client.disconnect()
+            await fleet.stop()
+
+    completed = len(samples["end_to_end"])
+    db = None
+    if pg_before and pg_after:
+        db = {f"{k}_per_s": round((pg_after[k] - pg_before[k]) / elapsed, 1) for k in PG_COUNTERS}
+        db["connections"] = pg_after["connections"]
+    return {
+        "devices": devices,
+        "duration_s": round(elapsed, 2),
+        "concurrency": workers,
+        "watchers": args.watchers,
+        "commands_completed": completed,
+        "timeouts": samples["timeouts"],
+        "errors": samples["errors"],
+        "throughput_cmd_s": round(completed / elapsed, 1),
+        "latency_ms": {k: percentiles(samples[k]) for k in ("http", "cmd_to_device", "device_to_ws", "end_to_end")},
+        "fleet": fleet.stats(),
+        "db": db,
+        "backend": {name: numeric_delta(backend_before.get(name), value) for name, value in backend_after.items()},
+    }
+
+
+def git_version():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return "unknown"
+
+
+def print_run(result):
+    e2e = result["latency_ms"]["end_to_end"]
+    hop = result["latency_ms"]["device_to_ws"]
+    print(f"{result['devices']:>8} {result['throughput_cmd_s']:>10} {e2e['p50']!s:>9} {e2e['p99']!s:>9} "
+          f"{hop['p50']!s:>9} {hop['p99']!s:>9} {result['timeouts']:>8} "
+          f"{(result['db'] or {}).get('xact_commit_per_s', '-')!s:>10}")
+
+
+def cmd_run(args):
+    results = {
+        "version": git_version(),
+        "label": args.label,
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "url": args.url,
+        "broker": f"{args.broker_host}:{args.broker_port}",
+        "runs": [],
+    }
+    header = f"{'devices':>8} {'cmd/s':>10} {'e2e p50':>9} {'e2e p99':>9} {'ws p50':>9} {'ws p99':>9} {'timeout':>8} {'xact/s':>10}"
+    for devices in (int(d) for d in args.devices.split(",")):
+        result = asyncio.run(run_scale(args, devices))
+        results["runs"].append(result)
+        print(header)
+        print_run(result)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(args.output_dir, f"fleet-{args.label or results['version']}-{stamp}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    print(f"==> Kết quả: {path}")
+
+
+# ====================
+# SEED / COMPARE
+# ====================
+SEED_DEVICES_QUERY = f"""
+    INSERT INTO devices (user_id, device_name, is_on, mode, brightness)
+    SELECT %s, '{DEVICE_PREFIX}' || g, FALSE, 'manual', 100 FROM generate_series(1, %s) g
+    ON CONFLICT (device_name) DO NOTHING
+"""
+
+
+def cmd_seed(args):
+    import psycopg2
+    from config.db import DB_CONFIG
+    from controller.passwords import hash_password
+
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT user_id FROM users WHERE username = %s", (args.username,))
+        row = cursor.fetchone()
+        if row is None:
+            cursor.execute("INSERT INTO users (username, password, role) VALUES (%s, %s, 'user') RETURNING user_id",
+                           (args.username, hash_password(args.password)))
+            row = cursor.fetchone()
+        user_id = row[0]
+        cursor.execute(SEED_DEVICES_QUERY, (user_id, args.devices))
+        created = cursor.rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    print(f"==> User {args.username} (user_id={user_id}, topic home/user{user_id}/...): "
+          f"thêm {created} device {DEVICE_PREFIX}1..{DEVICE_PREFIX}{args.devices}")
+    print("==> Khởi động lại backend để nạp cache device trước khi chạy `run`")
+
+
+def cmd_compare(args):
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(args.candidate, encoding="utf-8") as f:
+        candidate = json.load(f)
+    base_runs = {r["devices"]: r for r in baseline["runs"]}
+
+    print(f"{baseline['label'] or baseline['version']} -> {candidate['label'] or candidate['version']}")
+    print(f"{'devices':>8} {'metric':>16} {'trước':>10} {'sau':>10} {'đổi':>8}")
+    regressions = 0
+    for run in candidate["runs"]:
+        base = base_runs.get(run["devices"])
+        if base is None:
+            continue
+        # (tên, giá trị, cao hơn là tốt hơn?)
+        metrics = [("cmd/s", base["throughput_cmd_s"], run["throughput_cmd_s"], True)]
+        for key in ("end_to_end", "device_to_ws"):
+            for q in ("p50", "p99"):
+                metrics.append((f"{key} {q}", base["latency_ms"][key][q], run["latency_ms"][key][q], False))
+        for name, old, new, higher_better in metrics:
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = -change if higher_better else change
+            flag = " !" if worse > args.threshold else ""
+            regressions += bool(flag)
+            print(f"{run['devices']:>8} {name:>16} {old:>10} {new:>10} {change:>+7.0%}{flag}")
+    if regressions:
+        print(f"==> {regressions} chỉ số xấu đi quá {args.threshold:.0%}")
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    seed = sub.add_parser("seed", help="tạo user bench và device bench1..N trong DB")
+    seed.add_argument("--devices", type=int, default=10000)
+
+    run = sub.add_parser("run", help="chạy load test, lưu kết quả JSON")
+    run.add_argument("--devices", default="100,1000,10000", help="các mức số đèn ảo, cách nhau bởi dấu phẩy")
+    run.add_argument("--duration", type=float, default=30.0, help="giây gửi lệnh ở mỗi mức")
+    run.add_argument("--warmup", type=float, default=HEARTBEAT_INTERVAL + 1)
+    run.add_argument("--concurrency", type=int, default=32, help="số worker gửi lệnh vòng kín")
+    run.add_argument("--watchers", type=int, default=2, help="số client Socket.IO")
+    run.add_argument("--mqtt-connections", type=int, default=16)
+    run.add_argument("--url", default="http://127.0.0.1:5000")
+    run.add_argument("--broker-host", default="127.0.0.1")
+    run.add_argument("--broker-port", type=int, default=1883)
+    run.add_argument("--topic-user", default=None, help="phần <user> của topic, mặc định user<user_id>")
+    run.add_argument("--label", default=None, help="tên phiên bản trong file kết quả (mặc định commit git)")
+    run.add_argument("--output-dir", default=RESULTS_DIR)
+
+    compare = sub.add_parser("compare", help="so 2 file kết quả, exit 1 nếu có chỉ số xấu đi quá ngưỡng")
+    compare.add_argument("baseline")
+    compare.add_argument("candidate")
+    compare.add_argument("--threshold", type=float, default=0.2)
+
+    for p in (seed, run):
+        p.add_argument("--username", default=BENCH_USER)
+        p.add_argument("--password", default=BENCH_PASSWORD)
+
+    args = parser.parse_args()
+    {"seed": cmd_seed, "run": cmd_run, "compare": cmd_compare}[args.command](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+# benchmarks/bench_mqtt_decode.py
+# So sánh phần decode + phân loại của MQTT callback cũ (payload.decode, json.loads 2 lần, endswith/split,
+# chuỗi dict.get) với controller/mqtt_decoder.py (regex topic biên dịch sẵn, parse 1 lần, schema -> namedtuple),
+# chạy cả với json của thư viện chuẩn và orjson (nếu đã cài). Không cần DB / broker: chỉ đo tầng decode,
+# phần cập nhật cache / writer / emit phía sau giống nhau ở cả hai.
+#
+#   cd "Source code/backend"
+#   python benchmarks/bench_mqtt_decode.py --messages 200000 --invalid 0.01
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from controller import mqtt_decoder
+from controller.mqtt_decoder import decode, HeartbeatMessage
+
+DEVICES_PER_USER = 20
+LAMPS_PER_BOARD = 2
+
+
+# ---------- cách cũ (chép từ devices.on_message trước khi có mqtt_decoder) ----------
+def old_decode(topic, raw):
+    try:
+        payload = raw.decode()
+        data = json.loads(payload)
+        if topic.endswith("/heartbeat"):
+            user = topic.split("/")[1]
+            devices = data.get("devices")
+            if not devices and data.get("device_id"):
+                devices = (data["device_id"],)
+            return user, devices
+        try:
+            data = json.loads(payload)
+            parts = topic.split("/")
+            user = cmd_id = None
+            if len(parts) == 4 and data.get("device_id"):
+                # liveness.register(parts[1], ...), command_tracker.ack(..., cmd_id)
+                user, cmd_id = parts[1], data.get("cmd_id")
+            # update_device_state
+            return (user, cmd_id, data.get("device_id"), data.get("state") == "on", data.get("mode"),
+                    data.get("brightness"))
+        except json.JSONDecodeError:
+            return None
+    except Exception:
+        return None
+
+
+def new_decode(topic, raw):
+    message = decode(topic, raw)
+    if message is None:
+        return None
+    if type(message) is HeartbeatMessage:
+        return message.user, message.devices
+    return (message.user, message.cmd_id, message.device_id, message.state == "on", message.mode, message.brightness)
+
+
+# ---------- dữ liệu ----------
+def make_messages(count, invalid_ratio, heartbeat_ratio=0.2, seed=1):
+    rng = random.Random(seed)
+    messages = []
+    for i in range(count):
+        user = rng.randrange(1, 50)
+        device = f"light{rng.randrange(1, DEVICES_PER_USER + 1)}"
+        if rng.random() < invalid_ratio:
+            topic = f"home/{user}/{device}/state"
+            raw = rng.choice([b"{not json", b'{"device_id": "x"}', b'{"state": "on"}', b"[1, 2]"])
+        elif rng.random() < heartbeat_ratio:
+            topic = f"home/{user}/heartbeat"
+            board = [f"light{rng.randrange(1, DEVICES_PER_USER + 1)}" for _ in range(LAMPS_PER_BOARD)]
+            raw = json.dumps({"timestamp": i, "devices": board}).encode()
+        else:
+            topic = f"home/{user}/{device}/state"
+            payload = {"device_id": device, "state": rng.choice(["on", "off"]), "brightness": rng.randrange(101),
+                       "mode": rng.choice(["manual", "auto"]), "timestamp": i}
+            if rng.random() < 0.5:
+                payload["cmd_id"] = f"{i:x}"
+            raw = json.dumps(payload).encode()
+        messages.append((topic, raw))
+    return messages
+
+
+def measure(fn, messages, rounds):
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for topic, raw in messages:
+            fn(topic, raw)
+        best = min(best, time.perf_counter() - start)
+    return best / len(messages) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark decode message MQTT: callback cũ vs mqtt_decoder")
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--invalid", type=float, default=0.01, help="tỉ lệ message lỗi (JSON / schema)")
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    messages = make_messages(args.messages, args.invalid)
+    # Dead letter log tối đa 1 dòng / lý do / giây, không làm lệch phép đo
+    mqtt_decoder.log.disabled = True
+
+    backends = [("json", mqtt_decoder._json_loads, (ValueError, UnicodeDecodeError))]
+    if mqtt_decoder.orjson is not None:
+        backends.append(("orjson", mqtt_decoder.orjson.loads, (mqtt_decoder.orjson.JSONDecodeError,)))
+    else:
+        print("orjson chưa cài: chỉ đo mqtt_decoder với json (pip install orjson)")
+
+    old_us = measure(old_decode, messages, args.rounds)
+    print(f"\n{args.messages} message, {args.invalid:.1%} lỗi, tốt nhất / {args.rounds} lượt")
+    print(f"{'cách':>22} {'µs/msg':>8} {'msg/s':>10} {'nhanh hơn':>10}")
+    print(f"{'callback cũ (json x2)':>22} {old_us:>8.2f} {1e6 / old_us:>10.0f} {'1.00x':>10}")
+    for name, loads, errors in backends:
+        mqtt_decoder.loads, mqtt_decoder.DECODE_ERRORS = loads, errors
+        new_us = measure(new_decode, messages, args.rounds)
+        label = f"mqtt_decoder ({name})"
+        print(f"{label:>22} {new_us:>8.2f} {1e6 / new_us:>10.0f} {old_us / new_us:>9.2f}x")
+    print(f"\ndead letters: {mqtt_decoder.dead_letters.stats()['dead_letters']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+# benchmarks/bench_password_hash.py
+# Số lần đăng nhập/giây (1 lần verify scrypt) ở từng mức cost, qua PasswordPool như login_user.
+# Dùng để chọn SMART_LIGHT_SCRYPT_N / SMART_LIGHT_HASH_WORKERS cho máy triển khai.
+#
+# Không cần DB: --logins yêu cầu verify được gửi cùng lúc (giới hạn max_pending đủ lớn để không bị từ chối),
+# đo tổng thời gian và độ trễ p50/p99 của từng yêu cầu.
+#
+#   cd "Source code/backend"
+#   python benchmarks/bench_password_hash.py --logins 64 --workers 4 --costs 12,13,14,15
+import os
+import sys
+import time
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from controller.passwords import PasswordPool, hash_password, HASH_WORKERS, SCRYPT_R, SCRYPT_P
+
+PASSWORD = "correct horse battery staple"
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def run(n, workers, logins):
+    pool = PasswordPool(workers=workers, max_pending=logins, n=n, r=SCRYPT_R, p=SCRYPT_P)
+    stored = hash_password(PASSWORD, n, SCRYPT_R, SCRYPT_P)
+    latencies = []
+    lock = threading.Lock()
+
+    def login():
+        start = time.perf_counter()
+        ok, _ = pool.verify(PASSWORD, stored)
+        assert ok
+        with lock:
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    # Mỗi client 1 thread như thread request của Flask
+    clients = [threading.Thread(target=login) for _ in range(logins)]
+    start = time.perf_counter()
+    for t in clients:
+        t.start()
+    for t in clients:
+        t.join()
+    elapsed = time.perf_counter() - start
+    pool._executor.shutdown()
+    return logins / elapsed, percentile(latencies, 0.5), percentile(latencies, 0.99)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logins", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=HASH_WORKERS)
+    parser.add_argument("--costs", default="12,13,14,15", help="log2(n) của scrypt, cách nhau bởi dấu phẩy")
+    args = parser.parse_args()
+
+    print(f"logins={args.logins} workers={args.workers} r={SCRYPT_R} p={SCRYPT_P} cpus={os.cpu_count()}")
+    print(f"{'n':>8} {'RAM/hash':>10} {'logins/s':>10} {'p50 ms':>10} {'p99 ms':>10}")
+    for log_n in (int(c) for c in args.costs.split(",")):
+        n = 2 ** log_n
+        rate, p50, p99 = run(n, args.workers, args.logins)
+        memory_mib = 128 * n * SCRYPT_R / (1024 * 1024)
+        print(f"{'2^' + str(log_n):>8} {memory_mib:>8.0f}MB {rate:>10.1f} {p50:>10.1f} {p99:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+# benchmarks/bench_repository.py
+# So sánh cách truy vấn cũ của các controller (SQL tạo mỗi lần, cursor mới, tuple/RealDictRow -> dict)
+# với controller/repository.py (prepared statement, cursor dùng lại theo kết nối, namedtuple).
+#
+# Phần 1 không cần DB: chi phí dựng record cho --rows dòng devices (thời gian + bộ nhớ).
+# Phần 2 cần PostgreSQL theo config/db.py (bỏ qua nếu không kết nối được): µs/lần gọi của
+# get_user_by_id, get_schedule, danh sách devices, --calls lần mỗi kiểu.
+#
+#   cd "Source code/backend"
+#   python benchmarks/bench_repository.py --rows 10000 --calls 2000
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from psycopg2.extras import RealDictCursor
+
+from config.db import pool
+from controller import repository
+from controller.repository import Device
+
+
+# ---------- cách cũ (chép từ controller trước khi có repository) ----------
+def old_devices(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT device_id, device_name, is_on, mode, brightness FROM devices;")
+    result = [{"device_id": d[0], "device_name": d[1], "is_on": d[2], "mode": d[3], "brightness": d[4]}
+              for d in cursor.fetchall()]
+    cursor.close()
+    return result
+
+
+def old_user(conn, user_id):
+    cursor = conn.cursor()
+    cursor.execute("SELECT user_id, username, email, role FROM users WHERE user_id = %s", (user_id,))
+    row = cursor.fetchone()
+    cursor.close()
+    return {"user_id": row[0], "username": row[1], "email": row[2], "role": row[3]} if row else None
+
+
+def old_schedule(conn, device_id):
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor.execute(
+        "SELECT schedule_id, start_time, end_time, repeat, brightness, is_active FROM schedules WHERE device_id=%s LIMIT 1",
+        (device_id,)
+    )
+    row = cursor.fetchone()
+    cursor.close()
+    return row
+
+
+def new_devices(conn):
+    return list(map(Device._make, repository.execute(conn, repository.ALL_DEVICES).fetchall()))
+
+
+def new_user(conn, user_id):
+    row = repository.execute(conn, repository.USER_BY_ID, (user_id,)).fetchone()
+    return repository.User._make(row) if row else None
+
+
+def new_schedule(conn, device_id):
+    row = repository.execute(conn, repository.DEVICE_SCHEDULE, (device_id,)).fetchone()
+    return repository.Schedule._make(row) if row else None
+
+
+# ---------- phần 1: dựng record ----------
+def measure_records(rows):
+    raw = [(i, f"light{i}", i % 2 == 0, "manual", i % 101) for i in range(rows)]
+    builders = {
+        "dict (cũ)": lambda: [{"device_id": d[0], "device_name": d[1], "is_on": d[2], "mode": d[3],
+                              "brightness": d[4]} for d in raw],
+        "namedtuple": lambda: list(map(Device._make, raw)),
+    }
+    print(f"\n{rows} dòng devices")
+    print(f"{'record':>12} {'ms':>8} {'byte/dòng':>10}")
+    for name, build in builders.items():
+        start = time.perf_counter()
+        for _ in range(10):
+            build()
+        elapsed_ms = (time.perf_counter() - start) * 100
+        tracemalloc.start()
+        records = build()
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del records
+        print(f"{name:>12} {elapsed_ms:>8.2f} {size / rows:>10.0f}")
+
+
+# ---------- phần 2: truy vấn thật ----------
+def measure_queries(calls):
+    try:
+        conn = pool.acquire()
+    except Exception as e:
+        print(f"\nBỏ qua phần truy vấn (không kết nối được PostgreSQL: {e})")
+        return
+    try:
+        cases = [
+            ("devices", old_devices, new_devices, ()),
+            ("user_by_id", old_user, new_user, (1,)),
+            ("schedule", old_schedule, new_schedule, (1,)),
+        ]
+        print(f"\n{calls} lần gọi / kiểu, cùng 1 kết nối")
+        print(f"{'truy vấn':>12} {'cũ µs':>10} {'repo µs':>10} {'nhanh hơn':>10}")
+        for name, old, new, args in cases:
+            results = []
+            for fn in (old, new):
+                fn(conn, *args)             # làm nóng (repository PREPARE ở lần này)
+                conn.commit()
+                start = time.perf_counter()
+                for _ in range(calls):
+                    fn(conn, *args)
+                    conn.commit()
+                results.append((time.perf_counter() - start) / calls * 1e6)
+            print(f"{name:>12} {results[0]:>10.1f} {results[1]:>10.1f} {results[0] / results[1]:>9.2f}x")
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--calls", type=int, default=2000)
+    args = parser.parse_args()
+
+    measure_records(args.rows)
+    measure_queries(args.calls)
+
+
+if __name__ == "__main__":
+    main()
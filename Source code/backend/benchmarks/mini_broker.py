@@ -0,0 +1,240 @@
+# benchmarks/mini_broker.py
+# Broker MQTT 3.1.1 tối giản (asyncio, không thư viện ngoài) thay cho broker.hivemq.com khi load test
+# bằng benchmarks/bench_fleet.py: không đi qua Internet, không bị giới hạn tốc độ của broker public.
+#
+# Hỗ trợ: CONNECT, PUBLISH QoS 0/1 (trả PUBACK), SUBSCRIBE/UNSUBSCRIBE với + và #,
+# subscription chia sẻ $share/<group>/<filter> (round-robin như MQTT 5, backend dùng khi chạy --cluster),
+# PINGREQ, DISCONNECT. Message luôn được chuyển tiếp ở QoS 0; không có retained, QoS 2, will, session.
+#
+#   cd "Source code/backend"
+#   python benchmarks/mini_broker.py --port 1883
+#   SMART_LIGHT_MQTT_HOST=127.0.0.1 python main.py
+import time
+import asyncio
+import argparse
+import itertools
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+WRITE_BUFFER_LIMIT = 4 * 1024 * 1024    # byte chờ gửi tới 1 client trước khi bắt publisher chờ (backpressure)
+
+
+def encode_length(length):
+    out = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        out.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(out)
+
+
+def _string(data, offset):
+    size = int.from_bytes(data[offset:offset + 2], "big")
+    return data[offset + 2:offset + 2 + size].decode("utf-8"), offset + 2 + size
+
+
+def publish_packet(topic, payload):
+    topic = topic.encode("utf-8")
+    body = len(topic).to_bytes(2, "big") + topic + payload
+    return bytes((PUBLISH << 4,)) + encode_length(len(body)) + body
+
+
+def topic_matches(filter_parts, topic_parts):
+    for i, part in enumerate(filter_parts):
+        if part == "#":
+            return True
+        if i >= len(topic_parts) or (part != "+" and part != topic_parts[i]):
+            return False
+    return len(filter_parts) == len(topic_parts)
+
+
+class Session:
+    __slots__ = ("client_id", "writer", "filters")
+
+    def __init__(self, client_id, writer):
+        self.client_id = client_id
+        self.writer = writer
+        self.filters = set()        # filter gốc (kể cả $share/...)
+
+
+class MiniBroker:
+
+    def __init__(self):
+        self._exact = {}            # topic -> set(Session)
+        self._wildcard = {}         # filter -> (parts, set(Session))
+        self._shared = {}           # (group, filter) -> [parts, list(Session), itertools.cycle]
+        self.sessions = {}
+
+        self.connections = 0
+        self.received = 0
+        self.delivered = 0
+        self.started_at = time.monotonic()
+
+    # ---------- subscription ----------
+    def subscribe(self, session, topic_filter):
+        session.filters.add(topic_filter)
+        if topic_filter.startswith("$share/"):
+            _, group, real = topic_filter.split("/", 2)
+            entry = self._shared.setdefault((group, real), [real.split("/"), [], None])
+            if session not in entry[1]:
+                entry[1].append(session)
+                entry[2] = itertools.cycle(list(entry[1]))
+        elif "+" in topic_filter or "#" in topic_filter:
+            self._wildcard.setdefault(topic_filter, (topic_filter.split("/"), set()))[1].add(session)
+        else:
+            self._exact.setdefault(topic_filter, set()).add(session)
+
+    def unsubscribe(self, session, topic_filter):
+        session.filters.discard(topic_filter)
+        if topic_filter.startswith("$share/"):
+            _, group, real = topic_filter.split("/", 2)
+            entry = self._shared.get((group, real))
+            if entry and session in entry[1]:
+                entry[1].remove(session)
+                if entry[1]:
+                    entry[2] = itertools.cycle(list(entry[1]))
+                else:
+                    del self._shared[(group, real)]
+        elif topic_filter in self._wildcard:
+            subscribers = self._wildcard[topic_filter][1]
+            subscribers.discard(session)
+            if not subscribers:
+                del self._wildcard[topic_filter]
+        elif topic_filter in self._exact:
+            self._exact[topic_filter].discard(session)
+            if not self._exact[topic_filter]:
+                del self._exact[topic_filter]
+
+    def targets(self, topic):
+        found = set(self._exact.get(topic, ()))
+        parts = topic.split("/")
+        for filter_parts, subscribers in self._wildcard.values():
+            if topic_matches(filter_parts, parts):
+                found.update(subscribers)
+        for filter_parts, members, cycle in self._shared.values():
+            if topic_matches(filter_parts, parts):
+                found.add(next(cycle))
+        return found
+
+    async def route(self, topic, payload):
+        self.received += 1
+        packet = publish_packet(topic, payload)
+        slow = []
+        for session in self.targets(topic):
+            writer = session.writer
+            if writer.is_closing():
+                continue
+            writer.write(packet)
+            self.delivered += 1
+            if writer.transport.get_write_buffer_size() > WRITE_BUFFER_LIMIT:
+                slow.append(writer)
+        for writer in slow:
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+
+    # ---------- 1 kết nối ----------
+    async def _read_packet(self, reader):
+        header = await reader.readexactly(1)
+        length, multiplier = 0, 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            if not byte & 0x80:
+                break
+            multiplier *= 128
+        return header[0], await reader.readexactly(length)
+
+    async def handle(self, reader, writer):
+        session = None
+        try:
+            first, data = await self._read_packet(reader)
+            if first >> 4 != CONNECT:
+                return
+            _, offset = _string(data, 0)            # "MQTT"
+            offset += 4                             # level, flags, keepalive
+            client_id, _ = _string(data, offset)
+            session = Session(client_id or f"anon-{id(writer)}", writer)
+            self.sessions[session.client_id] = session
+            self.connections += 1
+            writer.write(bytes((CONNACK << 4, 2, 0, 0)))
+
+            while True:
+                first, data = await self._read_packet(reader)
+                kind = first >> 4
+                if kind == PUBLISH:
+                    qos = (first >> 1) & 0x03
+                    topic, offset = _string(data, 0)
+                    if qos:
+                        packet_id = data[offset:offset + 2]
+                        offset += 2
+                        writer.write(bytes((PUBACK << 4, 2)) + packet_id)
+                    await self.route(topic, data[offset:])
+                elif kind == SUBSCRIBE:
+                    packet_id, offset, granted = data[:2], 2, bytearray()
+                    while offset < len(data):
+                        topic_filter, offset = _string(data, offset)
+                        offset += 1                 # QoS yêu cầu; luôn cấp QoS 0
+                        self.subscribe(session, topic_filter)
+                        granted.append(0)
+                    writer.write(bytes((SUBACK << 4,)) + encode_length(2 + len(granted)) + packet_id + granted)
+                elif kind == UNSUBSCRIBE:
+                    offset = 2
+                    while offset < len(data):
+                        topic_filter, offset = _string(data, offset)
+                        self.unsubscribe(session, topic_filter)
+                    writer.write(bytes((UNSUBACK << 4, 2)) + data[:2])
+                elif kind == PINGREQ:
+                    writer.write(bytes((PINGRESP << 4, 0)))
+                elif kind == DISCONNECT:
+                    return
+                # PUBACK... từ client: bỏ qua (broker chỉ gửi QoS 0)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if session is not None:
+                for topic_filter in list(session.filters):
+                    self.unsubscribe(session, topic_filter)
+                if self.sessions.get(session.client_id) is session:
+                    del self.sessions[session.client_id]
+            writer.close()
+
+    def stats(self):
+        return {
+            "clients": len(self.sessions),
+            "connections": self.connections,
+            "received": self.received,
+            "delivered": self.delivered,
+            "uptime_seconds": round(time.monotonic() - self.started_at, 1),
+        }
+
+
+async def serve(host, port, report_interval=10):
+    broker = MiniBroker()
+    server = await asyncio.start_server(broker.handle, host, port, limit=2 ** 20)
+    print(f"==> Mini MQTT broker listening on {host}:{port}")
+    async with server:
+        last = 0
+        while True:
+            await asyncio.sleep(report_interval)
+            rate = (broker.received - last) / report_interval
+            last = broker.received
+            print(f"[broker] {broker.stats()} in={rate:.0f} msg/s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1883)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
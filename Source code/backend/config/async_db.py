@@ -0,0 +1,115 @@
+# config/async_db.py
+# Pool asyncpg cho runtime async (asgi_app.py). Cùng DB_CONFIG và giới hạn với pool psycopg2
+# trong config/db.py; chỉ được import khi chạy `python main.py --runtime async`.
+import re
+import time
+
+import asyncpg
+
+from config.db import DB_CONFIG, POOL_MIN_SIZE, POOL_MAX_SIZE, POOL_CHECKOUT_TIMEOUT, POOL_MAX_LIFETIME
+from config.metrics import DB_QUERY_SECONDS, DB_QUERY_ERRORS
+
+COMMAND_TIMEOUT = 10        # giây cho mỗi câu lệnh
+
+# bỏ qua "extract(epoch FROM cột)"
+_TABLE_RE = re.compile(r"(?<!epoch )\b(?:FROM|INTO|UPDATE)\s+([a-z_][a-z0-9_]*)", re.IGNORECASE)
+_labels = {}                # câu SQL -> nhãn metric, các câu lệnh đều là hằng nên dict không phình ra
+
+
+def statement_label(query):
+    """Nhãn metric cho 1 câu SQL của runtime async: "<lệnh>_<bảng>", ví dụ select_devices."""
+    label = _labels.get(query)
+    if label is None:
+        words = query.split(None, 1)
+        verb = words[0].lower() if words else "unknown"
+        if verb == "with":
+            verb = "cte"
+        table = _TABLE_RE.search(query)
+        label = _labels[query] = f"{verb}_{table.group(1).lower()}" if table else verb
+    return label
+
+
+class AsyncDatabase:
+    """
+    Bọc asyncpg.Pool: mỗi hàm mượn kết nối, chạy 1 câu lệnh rồi trả lại ngay.
+    asyncpg dùng placeholder $1, $2... nên các câu SQL của runtime async được viết riêng.
+    """
+
+    def __init__(self, config=DB_CONFIG):
+        self._config = config
+        self._pool = None
+
+        self.queries = 0
+        self.errors = 0
+        self._query_ms = 0.0
+
+    async def start(self):
+        if self._pool is not None:
+            return
+        self._pool = await asyncpg.create_pool(
+            database=self._config["dbname"],
+            user=self._config["user"],
+            password=self._config["password"],
+            host=self._config["host"],
+            port=int(self._config["port"]),
+            min_size=POOL_MIN_SIZE,
+            max_size=POOL_MAX_SIZE,
+            max_inactive_connection_lifetime=POOL_MAX_LIFETIME,
+            command_timeout=COMMAND_TIMEOUT,
+        )
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    @property
+    def ready(self):
+        return self._pool is not None
+
+    def acquire(self):
+        """`async with async_db.acquire() as conn:` cho các thao tác nhiều câu lệnh / transaction."""
+        return self._pool.acquire(timeout=POOL_CHECKOUT_TIMEOUT)
+
+    async def _run(self, method, query, *args):
+        start = time.perf_counter()
+        try:
+            async with self.acquire() as conn:
+                return await getattr(conn, method)(query, *args)
+        except Exception:
+            self.errors += 1
+            DB_QUERY_ERRORS.inc(statement_label(query))
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self.queries += 1
+            self._query_ms += elapsed * 1000
+            DB_QUERY_SECONDS.observe(elapsed, statement_label(query))
+
+    async def fetch(self, query, *args):
+        return await self._run("fetch", query, *args)
+
+    async def fetchrow(self, query, *args):
+        return await self._run("fetchrow", query, *args)
+
+    async def fetchval(self, query, *args):
+        return await self._run("fetchval", query, *args)
+
+    async def execute(self, query, *args):
+        return await self._run("execute", query, *args)
+
+    def stats(self):
+        pool = self._pool
+        return {
+            "driver": "asyncpg",
+            "size": pool.get_size() if pool else 0,
+            "idle": pool.get_idle_size() if pool else 0,
+            "min_size": POOL_MIN_SIZE,
+            "max_size": POOL_MAX_SIZE,
+            "queries": self.queries,
+            "errors": self.errors,
+            "query_avg_ms": (self._query_ms / self.queries) if self.queries else 0.0,
+        }
+
+
+async_db = AsyncDatabase()
@@ -0,0 +1,152 @@
+# config/async_mqtt.py
+# Gateway MQTT cho runtime async: aiomqtt chạy trên cùng event loop với web server,
+# nhận message bằng `async for` thay vì thread loop_start của paho.
+# Giữ nguyên giao diện của MqttGateway (publish/publish_many/subscribe/stats) để
+# code điều khiển device dùng chung được cho cả hai runtime.
+import ssl
+import time
+import asyncio
+
+import aiomqtt
+
+from config.mqtt import (
+    MqttGateway, USE_HIVEMQ_CLOUD, MQTT_HOST, HIVEMQ_USERNAME, HIVEMQ_PASSWORD, MQTT_KEEPALIVE,
+    RECONNECT_MIN_DELAY, RECONNECT_MAX_DELAY, OUTBOUND_QUEUE_SIZE, MAX_INFLIGHT,
+    broker_address, qos_for, topic_class,
+)
+from config.metrics import MQTT_MESSAGES, MQTT_CALLBACK_SECONDS
+from config.logger import get_logger
+
+log = get_logger("mqtt")
+
+
+class AsyncMqttGateway(MqttGateway):
+    """
+    - run(): kết nối, subscribe lại toàn bộ topic đã đăng ký, đọc message; mất kết nối thì
+      chờ theo backoff (RECONNECT_MIN_DELAY..RECONNECT_MAX_DELAY) rồi kết nối lại
+    - publish() chỉ put_nowait vào asyncio.Queue có giới hạn; task gửi chỉ lấy ra khi đang kết nối
+    - on_message là coroutine `handler(topic, payload_bytes)`
+    """
+
+    def __init__(self, queue_size=OUTBOUND_QUEUE_SIZE):
+        super().__init__(queue_size)
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._connected = asyncio.Event()
+        self._tasks = []
+
+    # ---------- vòng đời ----------
+    def set_on_message(self, callback):
+        self._on_message = callback
+
+    def subscribe(self, topic, qos=None):
+        # Chỉ ghi nhớ; subscribe thật diễn ra mỗi lần kết nối trong run()
+        self._subscriptions[topic] = qos_for(topic) if qos is None else qos
+
+    def start(self):
+        if self._started:
+            return
+        self._started = True
+        self._tasks = [
+            asyncio.create_task(self._run(), name="mqtt-connection"),
+            asyncio.create_task(self._send_loop(), name="mqtt-sender"),
+        ]
+
+    async def stop(self, timeout=5.0):
+        """Gửi nốt hàng đợi (nếu đang kết nối) rồi ngắt."""
+        if not self._started:
+            return
+        if self.connected:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._started = False
+
+    def _create_client(self):
+        host, port = broker_address()
+        if USE_HIVEMQ_CLOUD and not MQTT_HOST:
+            return aiomqtt.Client(
+                host, port,
+                username=HIVEMQ_USERNAME, password=HIVEMQ_PASSWORD,
+                tls_params=aiomqtt.TLSParameters(cert_reqs=ssl.CERT_REQUIRED, tls_version=ssl.PROTOCOL_TLS),
+                keepalive=MQTT_KEEPALIVE, max_inflight_messages=MAX_INFLIGHT,
+            )
+        return aiomqtt.Client(host, port, keepalive=MQTT_KEEPALIVE, max_inflight_messages=MAX_INFLIGHT)
+
+    async def _run(self):
+        delay = RECONNECT_MIN_DELAY
+        while True:
+            try:
+                async with self._create_client() as client:
+                    self._client = client
+                    for topic, qos in self._subscriptions.items():
+                        await client.subscribe(topic, qos)
+                    self.connects += 1
+                    delay = RECONNECT_MIN_DELAY
+                    self._connected.set()
+                    log.info("MQTT (async) connected (lần %d), subscribe %d topic", self.connects, len(self._subscriptions))
+
+                    async for message in client.messages:
+                        if self._on_message is None:
+                            continue
+                        topic = message.topic.value
+                        cls = topic_class(topic)
+                        MQTT_MESSAGES.inc("in", cls)
+                        start = time.perf_counter()
+                        try:
+                            await self._on_message(topic, message.payload)
+                        except Exception:
+                            log.exception("MQTT callback error", extra={"topic": topic})
+                        MQTT_CALLBACK_SECONDS.since(start, cls)
+            except aiomqtt.MqttError as e:
+                log.warning("MQTT (async) mất kết nối: %s, thử lại sau %ss", e, delay)
+            finally:
+                if self._connected.is_set():
+                    self.disconnects += 1
+                self._connected.clear()
+                self._client = None
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    # ---------- gửi ----------
+    def publish(self, topic, payload, qos=None):
+        """Đưa message vào hàng đợi gửi. Trả về False nếu hàng đợi đầy (message bị bỏ)."""
+        qos = qos_for(topic) if qos is None else qos
+        try:
+            self._queue.put_nowait((topic, payload, qos, time.monotonic()))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+        self.enqueued += 1
+        return True
+
+    async def _send_loop(self):
+        while True:
+            topic, payload, qos, enqueued_at = await self._queue.get()
+            try:
+                # Mất kết nối: giữ message, chờ kết nối lại
+                while True:
+                    await self._connected.wait()
+                    client = self._client
+                    if client is None:
+                        continue
+                    try:
+                        await client.publish(topic, payload, qos=qos)
+                        ok = True
+                    except aiomqtt.MqttError:
+                        # Kết nối vừa rớt giữa chừng: chờ lần kết nối sau rồi gửi lại
+                        await asyncio.sleep(RECONNECT_MIN_DELAY)
+                        continue
+                    except Exception as e:
+                        log.error("MQTT publish error %s: %s", topic, e)
+                        ok = False
+                    break
+                self._record(topic, ok, (time.monotonic() - enqueued_at) * 1000)
+            finally:
+                self._queue.task_done()
+
+
+async_mqtt_gateway = AsyncMqttGateway()
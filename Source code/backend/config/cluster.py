@@ -0,0 +1,145 @@
+# config/cluster.py
+# Chế độ nhiều worker (SMART_LIGHT_CLUSTER=1):
+# - MQTT state được chia giữa các worker bằng shared subscription "$share/<group>/..."
+# - Socket.IO emit đi qua message queue (Redis) nên tới được client ở mọi worker
+# - Scheduler, offline detector, checkpoint heartbeat chỉ chạy trên worker leader,
+#   leader được bầu bằng PostgreSQL advisory lock (không cần thêm dịch vụ nào ngoài DB)
+import os
+import zlib
+import socket
+import threading
+
+import psycopg2
+
+from config.db import DB_CONFIG
+from config.logger import get_logger
+
+CLUSTER_MODE = os.environ.get("SMART_LIGHT_CLUSTER", "0") == "1"
+WORKER_ID = os.environ.get("SMART_LIGHT_WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+MQTT_SHARE_GROUP = os.environ.get("SMART_LIGHT_SHARE_GROUP", "smart_light")
+SOCKETIO_MESSAGE_QUEUE = os.environ.get("SMART_LIGHT_MESSAGE_QUEUE")   # vd: redis://localhost:6379/0
+SOCKETIO_CHANNEL = "flask-socketio"     # kênh mặc định của Flask-SocketIO, runtime async dùng chung
+
+LEADER_LOCK_NAME = "smart_light_leader"
+LEADER_POLL_INTERVAL = 5        # giây giữa 2 lần thử giành / kiểm tra lock
+CACHE_MAX_AGE = 1.0             # giây, cache thiết bị nạp lại từ DB để thấy state do worker khác ghi
+
+log = get_logger("cluster")
+
+
+def shared_topic(topic):
+    """Topic ingest: chế độ nhiều worker thì mỗi message chỉ giao cho 1 worker trong group."""
+    if not CLUSTER_MODE:
+        return topic
+    return f"$share/{MQTT_SHARE_GROUP}/{topic}"
+
+
+# ====================
+# LEADER ELECTION
+# ====================
+class LeaderElection:
+    """
+    Giữ pg_try_advisory_lock trên 1 kết nối riêng (không lấy từ pool vì pool đóng/mở lại kết nối).
+    Lock gắn với session: worker chết hoặc mất kết nối DB thì PostgreSQL tự nhả,
+    worker khác giành được ở lần thử kế tiếp (tối đa LEADER_POLL_INTERVAL giây).
+    """
+
+    def __init__(self, on_elected, on_demoted, name=LEADER_LOCK_NAME,
+                 interval=LEADER_POLL_INTERVAL, connect=psycopg2.connect):
+        self._on_elected = on_elected
+        self._on_demoted = on_demoted
+        self._key = zlib.crc32(name.encode())
+        self.interval = interval
+        self._connect = connect
+        self._conn = None
+        self._stop = threading.Event()
+        self._thread = None
+        self.is_leader = False
+
+        self.elections = 0
+        self.demotions = 0
+
+    def _query(self, sql, params=()):
+        if self._conn is None or self._conn.closed:
+            self._conn = self._connect(**DB_CONFIG)
+            self._conn.autocommit = True
+        cursor = self._conn.cursor()
+        cursor.execute(sql, params)
+        row = cursor.fetchone()
+        cursor.close()
+        return row[0]
+
+    def _close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+    def _tick(self):
+        try:
+            if self.is_leader:
+                self._query("SELECT 1")
+                return
+            if self._query("SELECT pg_try_advisory_lock(%s)", (self._key,)):
+                self.is_leader = True
+                self.elections += 1
+                log.info("Worker %s trở thành leader", WORKER_ID)
+                self._on_elected()
+        except Exception as e:
+            # Mất kết nối giữ lock: lock đã (hoặc sẽ) bị nhả phía DB, thôi làm leader ngay
+            log.warning("Leader election (%s): %s", WORKER_ID, e)
+            self._close()
+            self._demote()
+
+    def _demote(self):
+        if not self.is_leader:
+            return
+        self.is_leader = False
+        self.demotions += 1
+        log.info("Worker %s thôi làm leader", WORKER_ID)
+        try:
+            self._on_demoted()
+        except Exception as e:
+            log.exception("Lỗi dừng tác vụ leader: %s", e)
+
+    def _run(self):
+        while True:
+            self._tick()
+            if self._stop.wait(self.interval):
+                return
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="leader-election", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(self.interval + 1)
+        self._demote()
+        # Đóng session cũng nhả advisory lock
+        self._close()
+
+    def stats(self):
+        return {
+            "worker_id": WORKER_ID,
+            "is_leader": self.is_leader,
+            "elections": self.elections,
+            "demotions": self.demotions,
+            "poll_interval_seconds": self.interval,
+        }
+
+
+def cluster_info(election=None):
+    return {
+        "cluster_mode": CLUSTER_MODE,
+        "worker_id": WORKER_ID,
+        "share_group": MQTT_SHARE_GROUP if CLUSTER_MODE else None,
+        "message_queue": bool(SOCKETIO_MESSAGE_QUEUE),
+        "leader": election.stats() if election is not None else {"is_leader": True},
+    }
@@ -1,7 +1,14 @@
 # config/db.py
+import time
+import threading
+from collections import deque
+
 import psycopg2
+from psycopg2 import extensions
 from datetime import datetime
 
+from config.logger import get_logger, Throttle
+
 DB_CONFIG = {
     "dbname": "smart_light_db",
     "user": "postgres",
@@ -10,9 +17,302 @@ DB_CONFIG = {
     "port": "5432"
 }
 
+# ====================
+# CẤU HÌNH POOL
+# ====================
+# Pool dùng chung cho MQTT thread, các worker Socket.IO và background task
+POOL_MIN_SIZE = 2
+POOL_MAX_SIZE = 20
+POOL_CHECKOUT_TIMEOUT = 5.0     # giây chờ tối đa khi pool đã hết kết nối
+POOL_MAX_LIFETIME = 1800        # giây, quá thời gian này thì đóng và mở kết nối mới
+POOL_HEALTH_CHECK_IDLE = 30     # giây, kết nối nhàn rỗi lâu hơn sẽ được "SELECT 1" khi mượn
+POOL_CONNECT_RETRIES = 3
+POOL_CONNECT_BACKOFF = 0.2      # giây, nhân đôi sau mỗi lần thử lại
+
+# Các mốc (ms) cho histogram thời gian checkout
+CHECKOUT_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+
+class PoolTimeout(Exception):
+    """Không lấy được kết nối trong POOL_CHECKOUT_TIMEOUT giây."""
+
+
+class PooledConnection:
+    """
+    Bọc kết nối psycopg2 mượn từ pool.
+    close() trả kết nối về pool thay vì đóng hẳn, nên code cũ
+    (conn = get_db_connection() ... conn.close()) vẫn chạy đúng.
+    Dùng được với `with`: commit khi thành công, rollback khi lỗi, rồi trả về pool.
+    """
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._raw = raw
+        self._released = False
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    @property
+    def raw(self):
+        return self._raw
+
+    @property
+    def state(self):
+        """dict sống cùng kết nối thật (qua nhiều lần mượn): prepared statement, cursor dùng lại..."""
+        return self._pool.connection_state(self._raw)
+
+    def close(self):
+        if not self._released:
+            self._released = True
+            self._pool.release(self._raw)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if not self._raw.closed:
+                if exc_type is None:
+                    self._raw.commit()
+                else:
+                    self._raw.rollback()
+        finally:
+            self.close()
+        return False
+
+
+class ConnectionPool:
+    """Pool kết nối PostgreSQL có giới hạn, an toàn đa luồng."""
+
+    def __init__(self, dsn_kwargs, min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE,
+                 checkout_timeout=POOL_CHECKOUT_TIMEOUT, max_lifetime=POOL_MAX_LIFETIME,
+                 health_check_idle=POOL_HEALTH_CHECK_IDLE, connect=psycopg2.connect):
+        self._dsn_kwargs = dsn_kwargs
+        self.min_size = min_size
+        self.max_size = max_size
+        self.checkout_timeout = checkout_timeout
+        self.max_lifetime = max_lifetime
+        self.health_check_idle = health_check_idle
+        self._connect = connect
+
+        self._cond = threading.Condition()
+        self._idle = deque()          # (conn, last_used)
+        self._created_at = {}         # id(conn) -> thời điểm tạo
+        self._state = {}              # id(conn) -> dict, xoá khi kết nối bị đóng
+        self._size = 0                # tổng số kết nối đang mở (idle + in use)
+        self._in_use = 0
+        self._waiting = 0
+        self._closed = False
+
+        # Thống kê
+        self._checkouts = 0
+        self._timeouts = 0
+        self._reconnects = 0
+        self._discarded = 0
+        self._latency_buckets = [0] * (len(CHECKOUT_BUCKETS_MS) + 1)
+        self._latency_sum_ms = 0.0
+
+    # ---------- tạo / huỷ kết nối ----------
+    def _open(self):
+        delay = POOL_CONNECT_BACKOFF
+        last_error = None
+        for attempt in range(POOL_CONNECT_RETRIES):
+            try:
+                conn = self._connect(**self._dsn_kwargs)
+                self._created_at[id(conn)] = time.monotonic()
+                if attempt:
+                    self._reconnects += 1
+                return conn
+            except Exception as e:
+                last_error = e
+                if attempt < POOL_CONNECT_RETRIES - 1:
+                    time.sleep(delay)
+                    delay *= 2
+        raise last_error
+
+    def _discard(self, conn):
+        self._created_at.pop(id(conn), None)
+        self._state.pop(id(conn), None)
+        self._discarded += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def connection_state(self, conn):
+        state = self._state.get(id(conn))
+        if state is None:
+            state = self._state[id(conn)] = {}
+        return state
+
+    def _expired(self, conn, now):
+        created = self._created_at.get(id(conn), now)
+        return now - created > self.max_lifetime
+
+    def _healthy(self, conn, last_used, now):
+        if conn.closed:
+            return False
+        if now - last_used < self.health_check_idle:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            cursor.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    # ---------- mượn / trả ----------
+    def acquire(self, timeout=None):
+        timeout = self.checkout_timeout if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+
+        with self._cond:
+            if self._closed:
+                raise PoolTimeout("Pool đã đóng")
+            self._waiting += 1
+            try:
+                while True:
+                    if self._idle:
+                        conn, last_used = self._idle.pop()
+                        self._in_use += 1
+                        break
+                    if self._size < self.max_size:
+                        # Giữ chỗ rồi mở kết nối ngoài lock
+                        self._size += 1
+                        self._in_use += 1
+                        conn, last_used = None, None
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeout(
+                            f"Không lấy được kết nối DB sau {timeout}s "
+                            f"(in_use={self._in_use}, max={self.max_size})"
+                        )
+                    self._cond.wait(remaining)
+            finally:
+                self._waiting -= 1
+
+        # Kiểm tra sức khoẻ / tuổi thọ ngoài lock để không chặn thread khác
+        try:
+            now = time.monotonic()
+            if conn is not None and (self._expired(conn, now) or not self._healthy(conn, last_used, now)):
+                self._discard(conn)
+                self._reconnects += 1
+                conn = None
+            if conn is None:
+                conn = self._open()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        self._record_checkout((time.monotonic() - start) * 1000)
+        return PooledConnection(self, conn)
+
+    def release(self, conn):
+        broken = conn.closed
+        if not broken:
+            try:
+                status = conn.info.transaction_status
+                if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                    broken = True
+                elif status != extensions.TRANSACTION_STATUS_IDLE:
+                    # Không để transaction dở dang rò sang lần mượn sau
+                    conn.rollback()
+            except Exception:
+                broken = True
+
+        with self._cond:
+            self._in_use -= 1
+            if broken or self._closed or self._expired(conn, time.monotonic()):
+                self._size -= 1
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def connection(self, timeout=None):
+        """with pool.connection() as conn: ..."""
+        return self.acquire(timeout)
+
+    def warmup(self):
+        """Mở trước POOL_MIN_SIZE kết nối để request đầu tiên không phải chờ handshake."""
+        conns = []
+        try:
+            for _ in range(self.min_size):
+                conns.append(self.acquire())
+        finally:
+            for c in conns:
+                c.close()
+
+    def close_all(self):
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._size -= 1
+                self._discard(conn)
+            self._cond.notify_all()
+
+    # ---------- thống kê ----------
+    def _record_checkout(self, elapsed_ms):
+        with self._cond:
+            self._checkouts += 1
+            self._latency_sum_ms += elapsed_ms
+            for i, bound in enumerate(CHECKOUT_BUCKETS_MS):
+                if elapsed_ms <= bound:
+                    self._latency_buckets[i] += 1
+                    break
+            else:
+                self._latency_buckets[-1] += 1
+
+    def stats(self):
+        with self._cond:
+            histogram = {f"le_{b}ms": n for b, n in zip(CHECKOUT_BUCKETS_MS, self._latency_buckets)}
+            histogram["inf"] = self._latency_buckets[-1]
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "waiting": self._waiting,
+                "max_size": self.max_size,
+                "checkouts": self._checkouts,
+                "timeouts": self._timeouts,
+                "reconnects": self._reconnects,
+                "discarded": self._discarded,
+                "checkout_avg_ms": (self._latency_sum_ms / self._checkouts) if self._checkouts else 0.0,
+                "checkout_latency_ms": histogram,
+            }
+
+
+pool = ConnectionPool(DB_CONFIG)
+
+log = get_logger("db")
+_connect_error_throttle = Throttle()
+
+
 def get_db_connection():
+    """
+    Mượn một kết nối từ pool.
+    Trả về None nếu không kết nối được (giữ nguyên hành vi cũ cho các controller).
+    """
     try:
-        return psycopg2.connect(**DB_CONFIG)
+        return pool.acquire()
     except Exception as e:
-        print(f"❌ Error connecting to DB: {e}")
+        # DB sập thì mọi request đều lỗi: gộp lại tối đa 1 dòng / SAMPLE_INTERVAL
+        suppressed = _connect_error_throttle.allow()
+        if suppressed is not None:
+            log.error("Error connecting to DB: %s", e, extra={"suppressed": suppressed})
         return None
+
+
+def get_pool_stats():
+    return pool.stats()
@@ -0,0 +1,164 @@
+# config/logger.py
+# Logging có cấu trúc cho backend, thay cho print:
+# - Mỗi subsystem 1 logger "smart_light.<subsystem>" (mqtt, db, devices, scheduler...), mức log chỉnh riêng:
+#     SMART_LIGHT_LOG_LEVEL="info,mqtt=debug,scheduler=warning"
+# - Thread gọi log chỉ put_nowait 1 LogRecord vào hàng đợi có giới hạn; thread nền định dạng rồi ghi ra
+#   stdout. Hàng đợi đầy thì bỏ record (đếm ở smart_light_log_records_dropped_total), không chặn luồng MQTT.
+# - Log debug tắt (mặc định) thì logger.debug(...) chỉ tốn 1 lần so mức log, chưa định dạng gì.
+# - Throttle: log theo từng device / lỗi lặp lại tối đa 1 lần mỗi khoảng, kèm số lần đã bị nén.
+#     SMART_LIGHT_LOG_FORMAT=text (mặc định) | json
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import logging.handlers
+from datetime import datetime
+
+from config.metrics import Counter
+
+ROOT_LOGGER = "smart_light"
+LOG_LEVEL = os.environ.get("SMART_LIGHT_LOG_LEVEL", "info")
+LOG_FORMAT = os.environ.get("SMART_LIGHT_LOG_FORMAT", "text")
+LOG_QUEUE_SIZE = 10000                  # record chờ ghi tối đa
+SAMPLE_INTERVAL = float(os.environ.get("SMART_LIGHT_LOG_SAMPLE_SECONDS", "1"))     # giây, cho Throttle
+
+DEBUG = logging.DEBUG
+
+LOG_DROPPED = Counter("smart_light_log_records_dropped_total", "Log records dropped because the log queue was full")
+
+# Thuộc tính có sẵn của LogRecord; phần còn lại (truyền qua extra=) là trường có cấu trúc
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+def get_logger(subsystem):
+    return logging.getLogger(f"{ROOT_LOGGER}.{subsystem}")
+
+
+def parse_levels(spec):
+    """"info,mqtt=debug" -> ("INFO", {"mqtt": "DEBUG"})."""
+    default, levels = "INFO", {}
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        name, sep, level = part.partition("=")
+        if sep:
+            levels[name.strip()] = level.strip().upper()
+        else:
+            default = name.upper()
+    return default, levels
+
+
+def _fields(record):
+    return {k: v for k, v in vars(record).items() if k not in _RECORD_ATTRS and not k.startswith("_")}
+
+
+class TextFormatter(logging.Formatter):
+    """2025-01-01 12:00:00.123 INFO    mqtt       thông điệp key=value ..."""
+
+    def format(self, record):
+        ts = datetime.fromtimestamp(record.created).strftime("%Y-%m-%d %H:%M:%S")
+        subsystem = record.name.rpartition(".")[2]
+        line = f"{ts}.{int(record.msecs):03d} {record.levelname:<7} {subsystem:<10} {record.getMessage()}"
+        fields = _fields(record)
+        if fields:
+            line += " " + " ".join(f"{k}={v}" for k, v in fields.items())
+        if record.exc_text:
+            line += "\n" + record.exc_text
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "subsystem": record.name.rpartition(".")[2],
+            "msg": record.getMessage(),
+        }
+        entry.update(_fields(record))
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Không định dạng ở thread gọi (QueueHandler gốc format ngay), không chặn khi hàng đợi đầy."""
+
+    def prepare(self, record):
+        if record.exc_info:
+            # traceback phải lấy ngay, trước khi frame bị giải phóng
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.inc()
+
+
+class LogWriter:
+    """Gắn handler hàng đợi vào logger "smart_light" và chạy thread ghi (QueueListener)."""
+
+    def __init__(self, levels=LOG_LEVEL, fmt=LOG_FORMAT, queue_size=LOG_QUEUE_SIZE, stream=None):
+        self._queue = queue.Queue(maxsize=queue_size)
+        output = logging.StreamHandler(stream or sys.stdout)
+        output.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+        self._listener = logging.handlers.QueueListener(self._queue, output)
+        self._handler = _QueueHandler(self._queue)
+        self._levels = levels
+        self._running = False
+
+    def start(self):
+        if self._running:
+            return
+        root = logging.getLogger(ROOT_LOGGER)
+        default, levels = parse_levels(self._levels)
+        root.setLevel(default)
+        for subsystem, level in levels.items():
+            get_logger(subsystem).setLevel(level)
+        root.addHandler(self._handler)
+        root.propagate = False
+        self._listener.start()
+        self._running = True
+
+    def stop(self):
+        """Ghi nốt các record còn trong hàng đợi."""
+        if not self._running:
+            return
+        self._running = False
+        logging.getLogger(ROOT_LOGGER).removeHandler(self._handler)
+        self._listener.stop()
+
+    def stats(self):
+        return {"queue_depth": self._queue.qsize(), "dropped": LOG_DROPPED.value()}
+
+
+class Throttle:
+    """
+    Cho qua tối đa 1 log mỗi `interval` giây cho mỗi khoá (tên device, loại lỗi...).
+    allow(key) trả về None nếu phải bỏ, ngược lại trả về số lần đã bị bỏ kể từ lần log trước.
+    Không khoá: chạy đồng thời có thể lọt thêm 1 dòng hoặc lệch số đếm, chấp nhận được cho log.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self._last = {}
+        self._suppressed = {}
+
+    def allow(self, key=None):
+        now = time.monotonic()
+        last = self._last.get(key)
+        if last is not None and now - last < self.interval:
+            self._suppressed[key] = self._suppressed.get(key, 0) + 1
+            return None
+        self._last[key] = now
+        return self._suppressed.pop(key, 0)
+
+
+log_writer = LogWriter()
+log_writer.start()
+atexit.register(log_writer.stop)
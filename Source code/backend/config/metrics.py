@@ -0,0 +1,192 @@
+# config/metrics.py
+# Counter / histogram kiểu Prometheus cho GET /metrics (text format 0.0.4), không cần prometheus_client.
+# Đường nóng chỉ tốn 1 lock + 1 phép cộng (histogram thêm 1 bisect trên ~14 mốc), đủ rẻ để bật thường trực
+# ở 10k message/s. Gauge (độ sâu hàng đợi, pool, số client...) chỉ đọc lúc scrape qua callback.
+import time
+import bisect
+import threading
+
+# giây: 0.5ms .. 10s cho callback MQTT, truy vấn DB
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# giây: độ trễ của scheduler so với mốc hẹn giờ (MISFIRE_GRACE = 300)
+LAG_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0, 60.0, 300.0)
+
+_registry = []
+
+
+def _label_text(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values = {} if labels else {(): 0}     # tuple giá trị label -> số
+        _registry.append(self)
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        with self._lock:
+            return self._values.get(label_values, 0)
+
+    def render(self):
+        with self._lock:
+            values = list(self._values.items())
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_label_text(self.labels, k)} {_number(v)}" for k, v in values]
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = {}           # tuple giá trị label -> [đếm theo bucket (không cộng dồn), tổng, số mẫu]
+        _registry.append(self)
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def since(self, start, *label_values):
+        """observe(perf_counter() - start): cách đo rẻ nhất ở đường nóng, không tạo context manager."""
+        self.observe(time.perf_counter() - start, *label_values)
+
+    def render(self):
+        with self._lock:
+            values = [(k, list(v[0]), v[1], v[2]) for k, v in self._values.items()]
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        bucket_labels = self.labels + ("le",)
+        for key, counts, total, count in values:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_label_text(bucket_labels, key + (_number(bound),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_text(self.labels, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_label_text(self.labels, key)} {count}")
+        return lines
+
+
+class Gauge:
+    """Giá trị đọc lúc scrape: fn() trả về số, hoặc dict {tuple giá trị label: số}."""
+
+    def __init__(self, name, description, fn, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._fn = fn
+        _registry.append(self)
+
+    def render(self):
+        try:
+            value = self._fn()
+        except Exception:
+            return []
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} gauge"]
+        if isinstance(value, dict):
+            lines += [f"{self.name}{_label_text(self.labels, k)} {_number(v)}" for k, v in value.items()]
+        elif value is not None:
+            lines.append(f"{self.name} {_number(value)}")
+        return lines
+
+
+def stat_gauge(name, description, stats, key):
+    """Gauge lấy 1 khoá trong dict stats() sẵn có (state_writer.stats, get_pool_stats...)."""
+    return Gauge(name, description, lambda: stats()[key])
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# ====================
+# METRIC DÙNG CHUNG
+# ====================
+MQTT_MESSAGES = Counter("smart_light_mqtt_messages_total",
+                        "MQTT messages received (in) or published (out) per topic class", ("direction", "topic_class"))
+MQTT_CALLBACK_SECONDS = Histogram("smart_light_mqtt_callback_seconds",
+                                  "Time spent handling one incoming MQTT message", ("topic_class",))
+MQTT_PUBLISH_SECONDS = Histogram("smart_light_mqtt_publish_seconds",
+                                 "Time from publish() enqueue to broker hand-off", ("topic_class",))
+DB_QUERY_SECONDS = Histogram("smart_light_db_query_seconds", "Database statement latency", ("statement",))
+DB_QUERY_ERRORS = Counter("smart_light_db_query_errors_total", "Database statements that raised", ("statement",))
+SCHEDULER_FIRES = Counter("smart_light_scheduler_fires_total", "Schedule events executed", ("action",))
+SCHEDULER_MISSED = Counter("smart_light_scheduler_missed_total", "Schedule events skipped for exceeding the grace period")
+SCHEDULER_LAG_SECONDS = Histogram("smart_light_scheduler_lag_seconds",
+                                  "Delay between a schedule's due time and its execution", buckets=LAG_BUCKETS)
+OFFLINE_TRANSITIONS = Counter("smart_light_device_transitions_total",
+                              "Devices marked offline by the detector or seen alive again", ("to",))
+SOCKETIO_EMITS = Counter("smart_light_socketio_emits_total", "Socket.IO emit calls per event", ("event",))
+
+
+def timed_query(statement, fn, *args):
+    """Chạy fn(*args) và ghi độ trễ / lỗi dưới nhãn statement (cho các lệnh ghi theo batch)."""
+    start = time.perf_counter()
+    try:
+        return fn(*args)
+    except Exception:
+        DB_QUERY_ERRORS.inc(statement)
+        raise
+    finally:
+        DB_QUERY_SECONDS.since(start, statement)
+
+
+def instrument_socketio(server):
+    """Đếm emit theo event và thêm gauge số client đang kết nối cho 1 python-socketio Server/AsyncServer."""
+    emit = server.emit
+
+    if getattr(emit, "_counted", False):
+        return
+    if _is_coroutine(emit):
+        async def counted(event, *args, **kwargs):
+            SOCKETIO_EMITS.inc(event)
+            return await emit(event, *args, **kwargs)
+    else:
+        def counted(event, *args, **kwargs):
+            SOCKETIO_EMITS.inc(event)
+            return emit(event, *args, **kwargs)
+    counted._counted = True
+    server.emit = counted
+
+    def connected():
+        return sum(1 for _ in server.manager.get_participants("/", None))
+    Gauge("smart_light_socketio_connected_clients", "Socket.IO clients connected to this worker", connected)
+
+
+def _is_coroutine(fn):
+    import inspect
+    return inspect.iscoroutinefunction(fn)
@@ -1,7 +1,14 @@
 # config/mqtt.py
+import os
 import ssl
+import time
+import queue
+import threading
 import paho.mqtt.client as mqtt
 
+from config.metrics import MQTT_MESSAGES, MQTT_PUBLISH_SECONDS
+from config.logger import get_logger
+
 USE_HIVEMQ_CLOUD = False
 
 HIVEMQ_PUBLIC_BROKER = "broker.hivemq.com"
@@ -12,12 +19,44 @@ HIVEMQ_CLOUD_PORT = 8883
 HIVEMQ_USERNAME = "your-username"
 HIVEMQ_PASSWORD = "your-password"
 
-def create_mqtt_client(on_message_callback):
-    client = mqtt.Client()
+# Broker riêng (mosquitto, benchmarks/mini_broker.py khi load test...): không TLS, không tài khoản
+MQTT_HOST = os.environ.get("SMART_LIGHT_MQTT_HOST")
+MQTT_PORT = int(os.environ.get("SMART_LIGHT_MQTT_PORT", "1883"))
+
+MQTT_KEEPALIVE = 60
+RECONNECT_MIN_DELAY = 1     # giây
+RECONNECT_MAX_DELAY = 30    # giây
+
+# QoS theo loại topic (phần cuối của topic): lệnh điều khiển cần tới nơi nên dùng QoS 1
+MQTT_QOS = {
+    "cmd": 1,
+    "state": 0,
+    "heartbeat": 0,
+}
+DEFAULT_QOS = 0
+
+OUTBOUND_QUEUE_SIZE = 20000             # số lệnh tối đa giữ lại khi mất kết nối broker
+MAX_INFLIGHT = 100                      # số message QoS>0 chưa được broker xác nhận
+PUBLISH_LATENCY_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000, 30000)
+
+_STOP = object()
+
+log = get_logger("mqtt")
+
+
+def create_mqtt_client(on_message_callback=None):
+    """Tạo paho client đã cấu hình TLS/tài khoản nhưng CHƯA kết nối (kết nối do MqttGateway.start)."""
+    if hasattr(mqtt, "CallbackAPIVersion"):
+        # paho-mqtt >= 2.0 bắt buộc chọn phiên bản callback
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
+    else:
+        client = mqtt.Client()
     client.on_message = on_message_callback
 
-    if USE_HIVEMQ_CLOUD:
-        print("==> Using HiveMQ Cloud")
+    if MQTT_HOST:
+        log.info("Using MQTT broker %s:%s", MQTT_HOST, MQTT_PORT)
+    elif USE_HIVEMQ_CLOUD:
+        log.info("Using HiveMQ Cloud")
         client.tls_set(
             ca_certs=None,
             certfile=None,
@@ -26,10 +65,206 @@ def create_mqtt_client(on_message_callback):
             tls_version=ssl.PROTOCOL_TLS
         )
         client.username_pw_set(HIVEMQ_USERNAME, HIVEMQ_PASSWORD)
-        client.connect(HIVEMQ_CLOUD_HOST, HIVEMQ_CLOUD_PORT)
-
     else:
-        print("==> Using HiveMQ Public Broker")
-        client.connect(HIVEMQ_PUBLIC_BROKER, HIVEMQ_PUBLIC_PORT)
+        log.info("Using HiveMQ Public Broker")
 
     return client
+
+
+def broker_address():
+    if MQTT_HOST:
+        return MQTT_HOST, MQTT_PORT
+    if USE_HIVEMQ_CLOUD:
+        return HIVEMQ_CLOUD_HOST, HIVEMQ_CLOUD_PORT
+    return HIVEMQ_PUBLIC_BROKER, HIVEMQ_PUBLIC_PORT
+
+
+def topic_class(topic):
+    return topic.rsplit("/", 1)[-1]
+
+
+def qos_for(topic):
+    return MQTT_QOS.get(topic_class(topic), DEFAULT_QOS)
+
+
+# ====================
+# MQTT GATEWAY (1 kết nối dùng chung cho cả backend)
+# ====================
+class MqttGateway:
+    """
+    Một paho client duy nhất cho toàn backend:
+    - start() kết nối bất đồng bộ (không chặn lúc import/khởi động), paho tự reconnect
+    - các subscribe được ghi nhớ và subscribe lại sau mỗi lần kết nối
+    - publish() chỉ đưa vào hàng đợi có giới hạn; thread gửi chỉ lấy ra khi đang kết nối,
+      nên lệnh phát ra lúc mất kết nối vẫn được giữ lại và gửi khi broker quay lại
+    """
+
+    def __init__(self, queue_size=OUTBOUND_QUEUE_SIZE):
+        self._client = None
+        self._on_message = None
+        self._subscriptions = {}        # topic -> qos
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._connected = threading.Event()
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._sender = None
+        self._started = False
+
+        self.connects = 0
+        self.disconnects = 0
+        self.enqueued = 0
+        self.published = 0
+        self.dropped = 0
+        self.publish_errors = 0
+        self.by_class = {}              # topic class -> số message đã gửi
+        self._latency_buckets = [0] * (len(PUBLISH_LATENCY_BUCKETS_MS) + 1)
+        self._latency_sum_ms = 0.0
+
+    # ---------- vòng đời ----------
+    def set_on_message(self, callback):
+        self._on_message = callback
+        if self._client is not None:
+            self._client.on_message = callback
+
+    def subscribe(self, topic, qos=None):
+        qos = qos_for(topic) if qos is None else qos
+        self._subscriptions[topic] = qos
+        if self._connected.is_set():
+            self._client.subscribe(topic, qos)
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+
+        client = create_mqtt_client(self._on_message)
+        client.on_connect = self._handle_connect
+        client.on_disconnect = self._handle_disconnect
+        client.reconnect_delay_set(RECONNECT_MIN_DELAY, RECONNECT_MAX_DELAY)
+        client.max_inflight_messages_set(MAX_INFLIGHT)
+        self._client = client
+
+        host, port = broker_address()
+        client.connect_async(host, port, MQTT_KEEPALIVE)
+        client.loop_start()
+
+        self._sender = threading.Thread(target=self._send_loop, name="mqtt-sender", daemon=True)
+        self._sender.start()
+
+    def stop(self, timeout=5.0):
+        """Gửi nốt hàng đợi (nếu đang kết nối) rồi ngắt; chặn tối đa `timeout` giây kể cả khi broker mất."""
+        if not self._started:
+            return
+        deadline = time.monotonic() + timeout
+        # Mất kết nối + hàng đợi đầy thì put(_STOP) không bao giờ có chỗ: sender tự thoát khi thấy cờ này
+        self._stopping.set()
+        try:
+            if self._connected.is_set():
+                self._queue.put(_STOP, timeout=timeout)
+            else:
+                self._queue.put_nowait(_STOP)
+        except queue.Full:
+            pass
+        if self._connected.is_set():
+            self._sender.join(max(0.0, deadline - time.monotonic()))
+        self._client.loop_stop()
+        self._client.disconnect()
+
+    def _handle_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            log.error("MQTT connect failed rc=%s", rc)
+            return
+        self.connects += 1
+        log.info("MQTT connected (lần %d), subscribe %d topic", self.connects, len(self._subscriptions))
+        for topic, qos in self._subscriptions.items():
+            client.subscribe(topic, qos)
+        self._connected.set()
+
+    def _handle_disconnect(self, client, userdata, rc):
+        self._connected.clear()
+        self.disconnects += 1
+        if rc != 0:
+            log.warning("MQTT mất kết nối rc=%s, paho sẽ tự kết nối lại", rc)
+
+    @property
+    def connected(self):
+        return self._connected.is_set()
+
+    # ---------- gửi ----------
+    def publish(self, topic, payload, qos=None):
+        """Đưa message vào hàng đợi gửi. Trả về False nếu hàng đợi đầy (message bị bỏ)."""
+        qos = qos_for(topic) if qos is None else qos
+        try:
+            self._queue.put_nowait((topic, payload, qos, time.monotonic()))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+        with self._lock:
+            self.enqueued += 1
+        return True
+
+    def publish_many(self, messages, qos=None):
+        """Đưa cả đợt (topic, payload) vào hàng đợi; trả về danh sách topic bị bỏ do hàng đợi đầy."""
+        return [topic for topic, payload in messages if not self.publish(topic, payload, qos)]
+
+    def _send_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            topic, payload, qos, enqueued_at = item
+
+            # Mất kết nối: giữ message, chờ paho reconnect (trừ khi đang stop)
+            while not self._connected.wait(1.0):
+                if self._stopping.is_set():
+                    return
+
+            try:
+                info = self._client.publish(topic, payload, qos=qos)
+                ok = info.rc == mqtt.MQTT_ERR_SUCCESS
+            except Exception as e:
+                log.error("MQTT publish error %s: %s", topic, e)
+                ok = False
+            self._record(topic, ok, (time.monotonic() - enqueued_at) * 1000)
+
+    def _record(self, topic, ok, latency_ms):
+        with self._lock:
+            if not ok:
+                self.publish_errors += 1
+                return
+            self.published += 1
+            cls = topic_class(topic)
+            self.by_class[cls] = self.by_class.get(cls, 0) + 1
+            MQTT_MESSAGES.inc("out", cls)
+            MQTT_PUBLISH_SECONDS.observe(latency_ms / 1000, cls)
+            self._latency_sum_ms += latency_ms
+            for i, bound in enumerate(PUBLISH_LATENCY_BUCKETS_MS):
+                if latency_ms <= bound:
+                    self._latency_buckets[i] += 1
+                    break
+            else:
+                self._latency_buckets[-1] += 1
+
+    def stats(self):
+        with self._lock:
+            histogram = {f"le_{b}ms": n for b, n in zip(PUBLISH_LATENCY_BUCKETS_MS, self._latency_buckets)}
+            histogram["inf"] = self._latency_buckets[-1]
+            return {
+                "connected": self.connected,
+                "connects": self.connects,
+                "disconnects": self.disconnects,
+                "queue_depth": self._queue.qsize(),
+                "queue_max_size": self._queue.maxsize,
+                "enqueued": self.enqueued,
+                "published": self.published,
+                "dropped": self.dropped,
+                "publish_errors": self.publish_errors,
+                "published_by_class": dict(self.by_class),
+                "publish_latency_avg_ms": (self._latency_sum_ms / self.published) if self.published else 0.0,
+                "publish_latency_ms": histogram,
+            }
+
+
+mqtt_gateway = MqttGateway()
@@ -0,0 +1,681 @@
+# controller/async_tasks.py
+# Các tác vụ nền của runtime async (asgi_app.py), chạy chung 1 event loop:
+# ingest MQTT, ghi trạng thái theo batch, checkpoint heartbeat, phát hiện offline, scheduler.
+# Dùng lại các cấu trúc trong bộ nhớ của runtime thread (device_cache, liveness,
+# offline_detector, ScheduleEngine, device_topics); chỉ phần I/O được viết lại bằng asyncpg.
+import time
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from controller.state_writer import FLUSH_MAX_ROWS, FLUSH_INTERVAL, QUEUE_MAX_SIZE
+from controller.liveness import liveness, CHECKPOINT_INTERVAL
+from controller.offline_detector import offline_detector, EMIT_COALESCE_WINDOW
+from controller.device_cache import device_cache
+from controller.device_topics import device_topics
+from controller.schedule_engine import ScheduleEngine, SCHEDULE_COLUMNS, MAX_SLEEP
+from controller.brightness_coalescer import BrightnessCoalescer
+from controller.devices import heartbeat_devices
+from controller.mqtt_decoder import decode, state_event, HeartbeatMessage
+from controller.rooms import state_rooms
+from controller.push import delta_pusher
+from controller.event_log import event_log, EVENT_COLUMNS, OFFLINE, SCHEDULE
+from controller.log_partitions import (
+    log_partitions, PARTITIONS_QUERY, DEFAULT_PARTITION, DEFAULT_DAYS_QUERY, MAINTENANCE_INTERVAL,
+)
+from controller.usage import (
+    usage, compute_backfill, floor_minute, usage_query, usage_response,
+    USAGE_RANGES, USAGE_TIMEZONE, HOURLY_ROLLUP_QUERY, DAILY_ROLLUP_QUERY,
+    MINUTE_RETENTION_DAYS, BACKFILL_LOOKBACK_DAYS, ROLLUP_INTERVAL,
+)
+from controller.auth import _profile
+from controller.user_cache import user_cache
+from controller.passwords import password_pool, PasswordPoolBusy
+from controller.command_tracker import command_tracker
+from config.logger import get_logger, Throttle
+
+db_log = get_logger("db")
+liveness_log = get_logger("liveness")
+scheduler_log = get_logger("scheduler")
+events_log = get_logger("events")
+usage_log = get_logger("usage")
+auth_log = get_logger("auth")
+push_log = get_logger("push")
+queue_full_throttle = Throttle()
+
+# asyncpg: ghi nhiều dòng bằng unnest các mảng thay cho execute_values
+ASYNC_STATE_UPDATE_QUERY = """
+    UPDATE devices AS d
+    SET is_on = v.is_on, mode = v.mode, brightness = v.brightness, last_online = v.last_online
+    FROM unnest($1::varchar[], $2::boolean[], $3::varchar[], $4::integer[], $5::timestamptz[])
+         AS v(device_name, is_on, mode, brightness, last_online)
+    WHERE d.device_name = v.device_name
+"""
+ASYNC_SINGLE_UPDATE_QUERY = """
+    UPDATE devices SET is_on = $2, mode = $3, brightness = $4, last_online = $5
+    WHERE device_name = $1
+"""
+ASYNC_CHECKPOINT_QUERY = """
+    UPDATE devices AS d
+    SET last_online = v.last_online
+    FROM unnest($1::varchar[], $2::timestamptz[]) AS v(device_name, last_online)
+    WHERE d.device_name = v.device_name
+      AND (d.last_online IS NULL OR d.last_online < v.last_online)
+"""
+ASYNC_WARM_QUERY = "SELECT device_id, device_name, is_on, mode, brightness FROM devices"
+ASYNC_SEED_QUERY = "SELECT device_name, last_online FROM devices WHERE last_online IS NOT NULL AND is_on"
+ASYNC_OFFLINE_QUERY = "UPDATE devices SET is_on=FALSE WHERE device_name = ANY($1::varchar[])"
+ASYNC_SCHEDULES_QUERY = f"SELECT {SCHEDULE_COLUMNS} FROM schedules WHERE is_active=TRUE"
+ASYNC_DEACTIVATE_QUERY = "UPDATE schedules SET is_active=FALSE WHERE schedule_id = ANY($1::int[])"
+ASYNC_TOPICS_QUERY = "SELECT device_id, device_name, user_id FROM devices"
+ASYNC_TOPICS_BY_ID_QUERY = "SELECT device_id, device_name, user_id FROM devices WHERE device_id = ANY($1::int[])"
+
+_USAGE_MINUTE_VALUES = "unnest($1::int[], $2::timestamptz[], $3::float8[], $4::float8[])"
+ASYNC_USAGE_UPSERT_QUERY = f"""
+    INSERT INTO usage_minute (device_id, bucket, on_seconds, brightness_seconds)
+    SELECT * FROM {_USAGE_MINUTE_VALUES}
+    ON CONFLICT (device_id, bucket) DO UPDATE
+    SET on_seconds = usage_minute.on_seconds + EXCLUDED.on_seconds,
+        brightness_seconds = usage_minute.brightness_seconds + EXCLUDED.brightness_seconds
+"""
+ASYNC_USAGE_INSERT_QUERY = f"""
+    INSERT INTO usage_minute (device_id, bucket, on_seconds, brightness_seconds)
+    SELECT * FROM {_USAGE_MINUTE_VALUES}
+"""
+ASYNC_USAGE_DELETE_QUERY = "DELETE FROM usage_minute WHERE bucket >= $1 AND bucket < $2"
+ASYNC_USAGE_RETENTION_QUERY = "DELETE FROM usage_minute WHERE bucket < $1"
+ASYNC_LAST_MINUTE_QUERY = "SELECT max(bucket) FROM usage_minute"
+ASYNC_HOURLY_ROLLUP_QUERY = HOURLY_ROLLUP_QUERY.replace("%(start)s", "$1").replace("%(end)s", "$2")
+ASYNC_DAILY_ROLLUP_QUERY = (DAILY_ROLLUP_QUERY.replace("%(start)s", "$1").replace("%(end)s", "$2")
+                            .replace("%(tz)s", "$3"))
+ASYNC_BACKFILL_EVENTS_QUERY = """
+    SELECT device_id, extract(epoch FROM created_at), event_type, new_value
+    FROM logs
+    WHERE created_at >= $1 AND created_at < $2 AND device_id IS NOT NULL
+      AND event_type IN ('state_change', 'brightness_change', 'offline')
+    ORDER BY device_id, created_at
+"""
+ASYNC_BACKFILL_INITIAL_QUERY = """
+    SELECT DISTINCT ON (device_id, event_type = 'brightness_change')
+           device_id, event_type, new_value
+    FROM logs
+    WHERE created_at < $1 AND created_at >= $2 AND device_id IS NOT NULL
+      AND event_type IN ('state_change', 'brightness_change', 'offline')
+    ORDER BY device_id, event_type = 'brightness_change', created_at DESC
+"""
+ASYNC_USAGE_QUERY = """
+    SELECT bucket, on_seconds, brightness_seconds FROM {table}
+    WHERE device_id = $1 AND bucket >= $2
+    ORDER BY bucket
+"""
+
+ASYNC_LOGIN_QUERY = "SELECT user_id, username, email, role, password FROM users WHERE username = $1"
+ASYNC_USER_EXISTS_QUERY = "SELECT 1 FROM users WHERE username = $1"
+ASYNC_REGISTER_QUERY = """
+    INSERT INTO users (username, password, email, role)
+    VALUES ($1, $2, $3, 'user')
+    RETURNING user_id, username, email, role
+"""
+ASYNC_REHASH_QUERY = "UPDATE users SET password = $1 WHERE user_id = $2 AND password = $3"
+
+
+def _columns(rows):
+    return [list(column) for column in zip(*rows)]
+
+
+# ====================
+# STATE WRITER (async)
+# ====================
+class AsyncStateWriter:
+    """
+    Giống DeviceStateWriter: gộp theo device_name (bản mới nhất thắng), ghi 1 câu UPDATE
+    mỗi FLUSH_INTERVAL hoặc khi đủ FLUSH_MAX_ROWS. Không cần hàng đợi vì cùng event loop.
+    """
+
+    def __init__(self, db, max_rows=FLUSH_MAX_ROWS, interval=FLUSH_INTERVAL, max_pending=QUEUE_MAX_SIZE):
+        self._db = db
+        self.max_rows = max_rows
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending = {}          # device_name -> row
+        self._full = asyncio.Event()
+
+        self.submitted = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self.rows_failed = 0
+        self.last_flush_ms = 0.0
+
+    def submit(self, row):
+        device_name = row[0]
+        if device_name in self._pending:
+            self.coalesced += 1
+        elif len(self._pending) >= self.max_pending:
+            self.dropped += 1
+            return False
+        self._pending[device_name] = row
+        self.submitted += 1
+        if len(self._pending) >= self.max_rows:
+            self._full.set()
+        return True
+
+    async def flush(self):
+        if not self._pending:
+            return
+        rows, self._pending = list(self._pending.values()), {}
+        start = time.monotonic()
+        try:
+            await self._db.execute(ASYNC_STATE_UPDATE_QUERY, *_columns(rows))
+            self.rows_written += len(rows)
+        except Exception as e:
+            db_log.error("Batch update error (%d rows), retry từng dòng: %s", len(rows), e)
+            for row in rows:
+                try:
+                    await self._db.execute(ASYNC_SINGLE_UPDATE_QUERY, *row)
+                    self.rows_written += 1
+                except Exception as row_error:
+                    self.rows_failed += 1
+                    db_log.error("DB error %s: %s", row[0], row_error)
+        self.flushes += 1
+        self.last_flush_ms = (time.monotonic() - start) * 1000
+
+    async def run(self):
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._full.clear()
+                await self.flush()
+        finally:
+            # Bị huỷ lúc tắt server: ghi nốt phần còn lại
+            await asyncio.shield(self.flush())
+
+    def stats(self):
+        return {
+            "queue_depth": len(self._pending),
+            "queue_max_size": self.max_pending,
+            "submitted": self.submitted,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "rows_failed": self.rows_failed,
+            "last_flush_ms": self.last_flush_ms,
+        }
+
+
+# ====================
+# MQTT INGEST
+# ====================
+def make_message_handler(state_writer, emit):
+    """Handler cho AsyncMqttGateway: decode + kiểm tra schema 1 lần, chỉ cập nhật bộ nhớ + đưa vào writer, không chờ DB."""
+
+    async def on_message(topic, payload):
+        message = decode(topic, payload)
+        if message is None:
+            return
+
+        # Heartbeat home/<user>/heartbeat
+        if type(message) is HeartbeatMessage:
+            devices = heartbeat_devices(message)
+            liveness.touch(devices)
+            offline_detector.alive(devices)
+            return
+
+        # home/<user>/<device>/state
+        device_name, mode, brightness = message.device_id, message.mode, message.brightness
+        liveness.register(message.user, device_name)
+        liveness.touch((device_name,))
+        offline_detector.alive((device_name,))
+        command_tracker.ack(device_name, message.cmd_id)
+
+        is_on = message.state == "on"
+        now = datetime.now(timezone.utc)
+        event_log.record_state(device_name, device_cache.get(device_name), is_on, mode, brightness, at=now)
+        usage.observe(device_name, is_on, brightness, now)
+        device_cache.update(device_name, is_on, mode, brightness)
+        delta_pusher.record(device_name, is_on=is_on, mode=mode, brightness=brightness, offline=False)
+        row = (device_name, is_on, mode, brightness, now)
+        if not state_writer.submit(row):
+            suppressed = queue_full_throttle.allow()
+            if suppressed is not None:
+                db_log.warning("State queue full, dropped update",
+                               extra={"device": device_name, "suppressed": suppressed})
+        await emit("device_state_update", state_event(message), to=state_rooms(device_name))
+
+    return on_message
+
+
+# ====================
+# KHỞI ĐỘNG: nạp cache / seed detector
+# ====================
+async def warm_cache(db):
+    device_cache.load_rows(await db.fetch(ASYNC_WARM_QUERY))
+
+
+async def load_topics(db):
+    # Chỉ mục device -> owner cho state_rooms, nạp trước để luồng ingest không phải truy vấn
+    device_topics.load_rows(await db.fetch(ASYNC_TOPICS_QUERY), complete=True)
+
+
+async def seed_offline_detector(db):
+    offline_detector.seed_rows(await db.fetch(ASYNC_SEED_QUERY))
+
+
+# ====================
+# HEARTBEAT CHECKPOINT
+# ====================
+async def checkpoint_liveness(db):
+    rows = liveness.take_dirty()
+    if not rows:
+        return 0
+    try:
+        await db.execute(ASYNC_CHECKPOINT_QUERY, *_columns(rows))
+    except Exception as e:
+        liveness_log.error("Heartbeat checkpoint error: %s", e)
+        liveness.requeue(rows)
+        return 0
+    liveness.mark_checkpointed(len(rows))
+    return len(rows)
+
+
+async def liveness_loop(db):
+    try:
+        while True:
+            await asyncio.sleep(CHECKPOINT_INTERVAL)
+            await checkpoint_liveness(db)
+    finally:
+        await asyncio.shield(checkpoint_liveness(db))
+
+
+# ====================
+# OFFLINE DETECTION
+# ====================
+async def offline_loop(db, emit):
+    """Ngủ tới deadline gần nhất trong heap của offline_detector rồi đánh dấu offline cả batch."""
+    while True:
+        deadline = offline_detector.next_deadline()
+        wait = offline_detector.threshold if deadline is None else deadline - time.monotonic()
+        if wait > 0:
+            # Device mới luôn có deadline = now + threshold nên không thể sớm hơn mốc đang chờ
+            await asyncio.sleep(min(wait, offline_detector.threshold))
+            continue
+
+        await asyncio.sleep(EMIT_COALESCE_WINDOW)
+        expired = offline_detector.pop_expired()
+        if not expired:
+            continue
+        try:
+            await mark_offline(db, emit, expired)
+        except Exception as e:
+            liveness_log.exception("Error in offline detector: %s", e)
+        offline_detector.transitions += len(expired)
+        offline_detector.batches += 1
+
+
+async def command_loop(mqtt_client):
+    """Như thread của command_tracker: ngủ tới deadline ack gần nhất, gửi lại lệnh chưa được ack."""
+    while True:
+        deadline = command_tracker.next_deadline()
+        wait = 1.0 if deadline is None else deadline - time.monotonic()
+        if wait > 0:
+            # Lệnh mới có thể có deadline sớm hơn mốc đang chờ: không ngủ quá 1 giây
+            await asyncio.sleep(min(wait, 1.0))
+            continue
+        for topic, payload in command_tracker.pop_expired():
+            mqtt_client.publish(topic, payload)
+
+
+async def mark_offline(db, emit, device_names):
+    device_cache.mark_offline(device_names)
+    try:
+        await db.execute(ASYNC_OFFLINE_QUERY, list(device_names))
+    except Exception as e:
+        liveness_log.error("Error marking devices offline: %s", e)
+
+    liveness_log.warning("%d device(s) offline: %s", len(device_names), ", ".join(device_names[:10]))
+    for name in device_names:
+        delta_pusher.record(name, is_on=False, offline=True)
+        event_log.record(name, OFFLINE, "online", "offline", "offline_detector")
+        usage.observe(name, False, None, datetime.now(timezone.utc))
+        await emit("device_state_update", {"device_id": name, "state": "offline", "brightness": None},
+                   to=state_rooms(name))
+
+
+# ====================
+# SCHEDULER
+# ====================
+async def resolve_topics(db, device_ids):
+    """Như device_topics.resolve_many nhưng nạp phần còn thiếu bằng asyncpg."""
+    if not device_topics.loaded:
+        device_topics.load_rows(await db.fetch(ASYNC_TOPICS_QUERY), complete=True)
+    missing = device_topics.missing(device_ids)
+    if missing:
+        device_topics.load_rows(await db.fetch(ASYNC_TOPICS_BY_ID_QUERY, missing))
+    return device_topics.lookup_many(device_ids)
+
+
+class AsyncScheduleEngine(ScheduleEngine):
+    """
+    Cùng heap/logic với ScheduleEngine, nhưng vòng lặp là coroutine.
+    save_schedule/delete_schedule (chạy trong threadpool) vẫn gọi reload_device như cũ;
+    reload_rows đánh thức vòng lặp qua call_soon_threadsafe.
+    """
+
+    def __init__(self, db, on_fire, loop):
+        super().__init__(on_fire=on_fire)
+        self._db = db
+        self._loop = loop
+        self._wake = asyncio.Event()
+
+    def reload_rows(self, device_id, rows):
+        super().reload_rows(device_id, rows)
+        self._loop.call_soon_threadsafe(self._wake.set)
+
+    async def run_async(self):
+        self.load_rows(await self._db.fetch(ASYNC_SCHEDULES_QUERY))
+        while self._running:
+            next_fire = self.next_fire()
+            wait = MAX_SLEEP if next_fire is None else (next_fire - datetime.now()).total_seconds()
+            if wait > 0:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), min(wait, MAX_SLEEP))
+                except asyncio.TimeoutError:
+                    pass
+                self._wake.clear()
+
+            now = datetime.now()
+            due = self.pop_due(now)
+
+            finished = self.take_finished()
+            if finished:
+                try:
+                    await self._db.execute(ASYNC_DEACTIVATE_QUERY, finished)
+                except Exception as e:
+                    scheduler_log.error("Lỗi tắt schedule một lần %s: %s", finished, e)
+            if not due:
+                continue
+
+            try:
+                await self._on_fire(due, now)
+                self.record_fired(due, now)
+            except Exception as e:
+                scheduler_log.exception("Lỗi khi thực thi lịch: %s", e)
+
+
+def make_schedule_fire(db, mqtt_client, emit):
+    async def fire(events, now):
+        current_time = now.strftime("%H:%M")
+        start = time.monotonic()
+        topics = await resolve_topics(db, list({schedule["device_id"] for _, _, schedule in events}))
+        timestamp = datetime.utcnow().isoformat() + "Z"
+
+        messages = []
+        executed = []
+        for fire_at, action, schedule in events:
+            target = topics.get(schedule["device_id"])
+            if target is None:
+                scheduler_log.warning("Không tìm thấy device %s cho schedule %s", schedule["device_id"], schedule["schedule_id"])
+                continue
+            device_name, topic = target
+            payload = {"command": "set", "state": action, "mode": "manual", "timestamp": timestamp}
+            if action == "on" and schedule.get("brightness") is not None:
+                payload["brightness"] = schedule["brightness"]
+            messages.append((topic, payload))
+            executed.append((device_name, action, topic, schedule["schedule_id"]))
+
+        failed = command_tracker.send_many(mqtt_client.publish_many, messages, "schedule")
+        scheduler_log.info("%s: gửi %d lệnh trong %.1fms, lỗi %d",
+                           current_time, len(messages), (time.monotonic() - start) * 1000, len(failed))
+
+        failed = set(failed)
+        for device_name, action, topic, schedule_id in executed:
+            if topic not in failed:
+                event_log.record(device_name, SCHEDULE, None, action, f"schedule {schedule_id}")
+            if action == "on":
+                await emit("schedule_executed", {"device_id": device_name, "action": "on", "time": current_time},
+                           to=state_rooms(device_name))
+
+    return fire
+
+
+# ====================
+# EVENT LOG (COPY qua asyncpg)
+# ====================
+async def flush_events(db):
+    """Ghi hết buffer của event_log theo batch bằng copy_records_to_table."""
+    while True:
+        rows = event_log.take_batch()
+        if not rows:
+            return
+        start = time.monotonic()
+        try:
+            async with db.acquire() as conn:
+                await conn.copy_records_to_table("logs", records=rows, columns=EVENT_COLUMNS)
+        except Exception as e:
+            events_log.error("Event log COPY error (%d rows): %s", len(rows), e)
+            event_log.requeue(rows)
+            return
+        event_log.mark_written(len(rows), (time.monotonic() - start) * 1000)
+
+
+async def event_log_loop(db):
+    try:
+        while True:
+            await asyncio.sleep(event_log.flush_interval)
+            await flush_events(db)
+    finally:
+        await asyncio.shield(flush_events(db))
+
+
+async def maintain_partitions(db, retention=True):
+    existing = [row[0] for row in await db.fetch(PARTITIONS_QUERY)]
+    default_days = []
+    if DEFAULT_PARTITION in existing:
+        default_days = [row[0] for row in await db.fetch(DEFAULT_DAYS_QUERY)]
+    for kind, name, statements in log_partitions.plan(existing, default_days=default_days, retention=retention):
+        try:
+            async with db.acquire() as conn:
+                async with conn.transaction():
+                    for sql in statements:
+                        await conn.execute(sql)
+            log_partitions.record(kind, name)
+        except Exception as e:
+            log_partitions.record(kind, name, e)
+    log_partitions.last_run = datetime.now(timezone.utc).isoformat()
+
+
+async def partition_loop(db):
+    while True:
+        try:
+            await maintain_partitions(db)
+        except Exception as e:
+            log_partitions.errors += 1
+            events_log.error("Log partition maintenance error: %s", e)
+        await asyncio.sleep(MAINTENANCE_INTERVAL)
+
+
+# ====================
+# USAGE ROLLUP
+# ====================
+async def _usage_rollup(conn, start, end):
+    await conn.execute(ASYNC_HOURLY_ROLLUP_QUERY, start, end)
+    await conn.execute(ASYNC_DAILY_ROLLUP_QUERY, start, end, USAGE_TIMEZONE)
+
+
+async def flush_usage(db, now=None):
+    rows = usage.take_rows(now)
+    if not rows:
+        return 0
+    start = time.monotonic()
+    minutes = [row[1] for row in rows]
+    try:
+        async with db.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(ASYNC_USAGE_UPSERT_QUERY, *_columns(rows))
+                await _usage_rollup(conn, min(minutes), max(minutes))
+    except Exception as e:
+        usage_log.error("Usage rollup error: %s", e)
+        usage.requeue(rows)
+        return 0
+    usage.mark_written(len(rows), (time.monotonic() - start) * 1000)
+    return len(rows)
+
+
+async def backfill_usage(db, start, end):
+    """Như controller.usage.backfill: tính lại usage_minute trong [start, end) từ logs."""
+    start, end = floor_minute(start), floor_minute(end)
+    if end <= start:
+        return 0
+    events = await db.fetch(ASYNC_BACKFILL_EVENTS_QUERY, start, end)
+    initial = await db.fetch(ASYNC_BACKFILL_INITIAL_QUERY, start, start - timedelta(days=BACKFILL_LOOKBACK_DAYS))
+    rows = compute_backfill(events, initial, start, end)
+    async with db.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute(ASYNC_USAGE_DELETE_QUERY, start, end)
+            if rows:
+                await conn.execute(ASYNC_USAGE_INSERT_QUERY, *_columns(rows))
+            await _usage_rollup(conn, start, end - timedelta(minutes=1))
+    usage.backfilled_minutes += len(rows)
+    return len(rows)
+
+
+async def usage_loop(db):
+    """Leader: 1 worker thì ghi phần cộng dồn từ luồng state, nhiều worker thì backfill các phút vừa xong."""
+    watermark = None
+    expired_hour = None
+    try:
+        while True:
+            await asyncio.sleep(ROLLUP_INTERVAL)
+            now = datetime.now(timezone.utc)
+            try:
+                if usage.live:
+                    await flush_usage(db, now)
+                else:
+                    if watermark is None:
+                        watermark = await db.fetchval(ASYNC_LAST_MINUTE_QUERY) or floor_minute(now) - timedelta(hours=1)
+                    end = floor_minute(now)
+                    if end > watermark:
+                        await backfill_usage(db, watermark, end)
+                        watermark = end
+                hour = now.replace(minute=0, second=0, microsecond=0)
+                if hour != expired_hour:
+                    await db.execute(ASYNC_USAGE_RETENTION_QUERY, now - timedelta(days=MINUTE_RETENTION_DAYS))
+                    expired_hour = hour
+            except Exception as e:
+                usage_log.exception("Usage rollup loop error: %s", e)
+    finally:
+        if usage.live:
+            await asyncio.shield(flush_usage(db))
+
+
+async def get_usage(db, device, device_id, range_key):
+    query = usage_query(range_key)
+    if query is None:
+        return {"error": f"range phải là một trong {list(USAGE_RANGES)}"}, 400
+    _, since = query
+    table = USAGE_RANGES[range_key][0]
+    rows = await db.fetch(ASYNC_USAGE_QUERY.format(table=table), device_id, since)
+    return usage_response(device, range_key, rows), 200
+
+
+# ====================
+# ĐĂNG NHẬP / ĐĂNG KÍ (như controller/auth.py, scrypt chạy trong password_pool)
+# ====================
+async def login_user(db, username, password):
+    """
+    Trả về (hồ sơ user, error_message); event loop không bị chặn trong lúc băm.
+    Pool băm đầy: ném PasswordPoolBusy để route trả 503 (như controller/auth.py).
+    """
+    try:
+        row = await db.fetchrow(ASYNC_LOGIN_QUERY, username)
+        ok, needs_rehash = await password_pool.verify_async(password, row["password"] if row else None)
+    except PasswordPoolBusy:
+        raise
+    except Exception as e:
+        auth_log.error("Lỗi đăng nhập: %s", e)
+        return None, f"Lỗi: {str(e)}"
+    if not ok:
+        return None, "Tên đăng nhập hoặc mật khẩu không đúng"
+
+    user = _profile(row)
+    if needs_rehash:
+        try:
+            new_hash = await password_pool.hash_async(password)
+            await db.execute(ASYNC_REHASH_QUERY, new_hash, user["user_id"], row["password"])
+            password_pool.mark_rehashed()
+        except Exception as e:
+            auth_log.warning("Không băm lại được mật khẩu user %s: %s", user["user_id"], e)
+    user_cache.put(user)
+    auth_log.info("Đăng nhập thành công: %s", username)
+    return user, None
+
+
+async def register_user(db, username, password, email=None):
+    try:
+        if await db.fetchval(ASYNC_USER_EXISTS_QUERY, username):
+            return None, "Tên đăng nhập đã tồn tại"
+        password_hash = await password_pool.hash_async(password)
+        user = _profile(await db.fetchrow(ASYNC_REGISTER_QUERY, username, password_hash, email))
+    except PasswordPoolBusy as e:
+        return None, str(e)
+    except Exception as e:
+        auth_log.error("Lỗi đăng kí: %s", e)
+        return None, f"Lỗi: {str(e)}"
+
+    user_cache.invalidate(user["user_id"])
+    user_cache.put(user)
+    auth_log.info("Đăng kí thành công: %s", username)
+    return user, None
+
+
+# ====================
+# DASHBOARD PUSH
+# ====================
+async def push_loop(server):
+    """Như DeltaPusher._run nhưng emit qua AsyncServer."""
+    while True:
+        await asyncio.sleep(delta_pusher.tick)
+        try:
+            for event, data, to, skip_sid in delta_pusher.prepare(server):
+                await server.emit(event, data, to=to, skip_sid=skip_sid)
+        except Exception as e:
+            push_log.exception("Dashboard push error: %s", e)
+
+
+# ====================
+# BRIGHTNESS (async)
+# ====================
+class AsyncBrightnessCoalescer(BrightnessCoalescer):
+    """Cùng logic leading/trailing edge; trailing edge do 1 task trên event loop gửi."""
+
+    def __init__(self, publish, **kwargs):
+        super().__init__(publish, **kwargs)
+        self._event = asyncio.Event()
+        self._task = None
+
+    def _wake(self):
+        self._event.set()
+
+    async def run(self):
+        while True:
+            with self._cond:
+                wait = self._heap[0][0] - time.monotonic() if self._heap else None
+            if wait is None:
+                await self._event.wait()
+                self._event.clear()
+                continue
+            if wait > 0:
+                await asyncio.sleep(wait)
+            with self._cond:
+                due = self._take_due(time.monotonic())
+            for topic, brightness in due:
+                self._send(topic, brightness)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run(), name="brightness-coalescer")
+
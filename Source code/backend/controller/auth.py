@@ -1,14 +1,42 @@
 # controller/auth.py
-# Module đơn giản để xử lý đăng nhập và đăng kí (không mã hóa mật khẩu)
+# Module đơn giản để xử lý đăng nhập và đăng kí (mật khẩu băm scrypt, xem controller/passwords.py)
 from config.db import get_db_connection
+from config.logger import get_logger
+from controller.user_cache import user_cache
+from controller.passwords import password_pool, PasswordPoolBusy
+from controller.repository import credentials, user_by_id
+
+log = get_logger("auth")
+
+REGISTER_QUERY = """
+    INSERT INTO users (username, password, email, role)
+    VALUES (%s, %s, %s, 'user')
+    RETURNING user_id, username, email, role
+"""
+REHASH_QUERY = "UPDATE users SET password = %s WHERE user_id = %s AND password = %s"
+
+
+def _profile(row):
+    """(user_id, username, email, role) -> dict trả về cho frontend."""
+    return {
+        "user_id": row[0],
+        "username": row[1],
+        "email": row[2],
+        "role": row[3]
+    }
 
 # ==================== ĐĂNG KÍ ====================
 def register_user(username, password, email=None):
     """
     # Tạo tài khoản người dùng mới
-    # Lưu mật khẩu dưới dạng text thường (không mã hóa)
-    # Trả về: (user_id, error_message)
+    # Mật khẩu được băm scrypt trong password_pool trước khi mượn kết nối DB
+    # Trả về: (hồ sơ user, error_message) - hồ sơ lấy luôn từ RETURNING, không cần truy vấn lại
     """
+    try:
+        password_hash = password_pool.hash(password)
+    except PasswordPoolBusy as e:
+        return None, str(e)
+
     conn = None
     try:
         # Kiểm tra username đã tồn tại
@@ -23,20 +51,18 @@ def register_user(username, password, email=None):
             return None, "Tên đăng nhập đã tồn tại"
         
         # Thêm user mới vào database
-        # INSERT user với username, password (text), email, role mặc định là 'user'
-        query = """
-            INSERT INTO users (username, password, email, role)
-            VALUES (%s, %s, %s, 'user')
-            RETURNING user_id
-        """
-        cursor.execute(query, (username, password, email))
-        user_id = cursor.fetchone()[0]
+        # INSERT user với username, password (chuỗi scrypt$...), email, role mặc định là 'user'
+        cursor.execute(REGISTER_QUERY, (username, password_hash, email))
+        user = _profile(cursor.fetchone())
         conn.commit()
-        
-        print(f"✅ Đăng kí thành công: {username}")
-        return user_id, None
+
+        # user_id mới: bỏ mọi bản cache cũ (nếu có) rồi cache hồ sơ vừa tạo
+        user_cache.invalidate(user["user_id"])
+        user_cache.put(user)
+        log.info("Đăng kí thành công: %s", username)
+        return user, None
     except Exception as e:
-        print(f"❌ Lỗi đăng kí: {e}")
+        log.error("Lỗi đăng kí: %s", e)
         if conn:
             conn.rollback()
         return None, f"Lỗi: {str(e)}"
@@ -47,74 +73,86 @@ def register_user(username, password, email=None):
 # ==================== ĐĂNG NHẬP ====================
 def login_user(username, password):
     """
-    # Xác thực đăng nhập: kiểm tra username và password trong database
-    # So sánh password text với text trong DB (không mã hóa)
-    # Trả về: (user_id, error_message)
+    # Xác thực đăng nhập: lấy hồ sơ + hash theo username, trả kết nối rồi mới kiểm tra mật khẩu
+    # (scrypt ~70ms chạy trong password_pool, không giữ kết nối DB trong lúc băm)
+    # Dòng còn mật khẩu text thường / cost cũ được băm lại ngay sau khi đăng nhập đúng
+    # Trả về: (hồ sơ user, error_message)
+    # Pool băm đầy / quá thời gian chờ: ném PasswordPoolBusy để route trả 503 (không phải sai mật khẩu)
     """
-    conn = None
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return None, "Lỗi kết nối database"
-        
-        cursor = conn.cursor()
-        # Lấy user_id và password từ database với username
-        cursor.execute(
-            "SELECT user_id, password FROM users WHERE username = %s",
-            (username,)
-        )
-        result = cursor.fetchone()
-        
-        if result is None:
-            # Không tìm thấy user
-            return None, "Tên đăng nhập hoặc mật khẩu không đúng"
-        
-        user_id, db_password = result
-        
-        # So sánh password nhập vào với password trong DB (text so sánh text)
-        if password != db_password:
-            # Mật khẩu sai
-            return None, "Tên đăng nhập hoặc mật khẩu không đúng"
-        
-        print(f"✅ Đăng nhập thành công: {username}")
-        return user_id, None
+        # Lấy hồ sơ và password từ database với username (namedtuple Credentials)
+        result = credentials(username)
     except Exception as e:
-        print(f"❌ Lỗi đăng nhập: {e}")
+        log.error("Lỗi đăng nhập: %s", e)
         return None, f"Lỗi: {str(e)}"
-    finally:
-        if conn:
-            conn.close()
+
+    # Không có user vẫn tốn 1 lần băm (hash giả) để không lộ username qua thời gian phản hồi
+    ok, needs_rehash = password_pool.verify(password, result.password if result else None)
+    if not ok:
+        return None, "Tên đăng nhập hoặc mật khẩu không đúng"
+
+    user = _profile(result)
+    if needs_rehash:
+        _rehash(user["user_id"], password, result.password)
+    user_cache.put(user)
+    log.info("Đăng nhập thành công: %s", username)
+    return user, None
+
+
+def _rehash(user_id, password, old_hash):
+    """Lỗi ở đây không làm hỏng đăng nhập, lần sau sẽ thử lại."""
+    try:
+        new_hash = password_pool.hash(password)
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            # AND password = cũ: không ghi đè nếu user vừa đổi mật khẩu ở request khác
+            cursor.execute(REHASH_QUERY, (new_hash, user_id, old_hash))
+            cursor.close()
+        password_pool.mark_rehashed()
+    except Exception as e:
+        log.warning("Không băm lại được mật khẩu user %s: %s", user_id, e)
 
 # ==================== LẤY THÔNG TIN USER ====================
 def get_user_by_id(user_id):
     """
-    # Lấy thông tin user từ user_id
+    # Lấy thông tin user từ user_id (qua user_cache, chỉ truy vấn DB khi miss)
     """
-    conn = None
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
+
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return None
-        
-        cursor = conn.cursor()
-        # Lấy username, email, role từ user_id
-        cursor.execute(
-            "SELECT user_id, username, email, role FROM users WHERE user_id = %s",
-            (user_id,)
-        )
-        result = cursor.fetchone()
+        # Lấy username, email, role từ user_id (namedtuple User)
+        result = user_by_id(user_id)
         
         if result:
-            return {
-                "user_id": result[0],
-                "username": result[1],
-                "email": result[2],
-                "role": result[3]
-            }
+            user = result._asdict()
+            user_cache.put(user)
+            return user
         return None
     except Exception as e:
-        print(f"❌ Lỗi lấy user: {e}")
+        log.error("Lỗi lấy user: %s", e)
         return None
+
+
+# ==================== ĐỔI ROLE ====================
+def update_user_role(user_id, role):
+    """
+    # Đổi role (vd: 'user' -> 'admin') và xoá hồ sơ trong cache để lần đọc sau lấy role mới
+    # Trả về: (True, None) hoặc (False, error_message)
+    """
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE users SET role = %s WHERE user_id = %s", (role, user_id))
+            updated = cursor.rowcount
+            cursor.close()
+    except Exception as e:
+        log.error("Lỗi đổi role: %s", e)
+        return False, f"Lỗi: {str(e)}"
     finally:
-        if conn:
-            conn.close()
+        user_cache.invalidate(user_id)
+
+    if not updated:
+        return False, "User không tồn tại"
+    return True, None
@@ -0,0 +1,100 @@
+# controller/brightness_coalescer.py
+# Gộp sự kiện brightness_change theo device: trong mỗi cửa sổ BRIGHTNESS_WINDOW chỉ gửi
+# tối đa 1 lệnh MQTT. Giá trị đầu tiên gửi ngay (leading edge), các giá trị sau chỉ giữ
+# bản mới nhất và luôn được gửi khi hết cửa sổ (trailing edge), nên đèn luôn dừng đúng
+# ở vị trí cuối của thanh trượt.
+import time
+import heapq
+import threading
+
+from config.logger import get_logger
+
+log = get_logger("devices")
+
+BRIGHTNESS_WINDOW = 0.05    # giây
+
+
+class BrightnessCoalescer:
+
+    def __init__(self, publish, window=BRIGHTNESS_WINDOW):
+        self._publish = publish         # publish(topic, brightness)
+        self.window = window
+        self._cond = threading.Condition()
+        self._last_sent = {}            # topic -> time.monotonic() lần gửi gần nhất
+        self._pending = {}              # topic -> brightness chờ gửi ở trailing edge
+        self._heap = []                 # (due, topic)
+        self._thread = None
+
+        self.received = 0
+        self.sent = 0
+        self.merged = 0                 # giá trị bị bản mới hơn thay thế (không gửi)
+
+    def submit(self, topic, brightness):
+        now = time.monotonic()
+        with self._cond:
+            self.received += 1
+            last = self._last_sent.get(topic)
+            if topic not in self._pending and (last is None or now - last >= self.window):
+                self._last_sent[topic] = now
+                send_now = True
+            else:
+                send_now = False
+                if topic in self._pending:
+                    self.merged += 1
+                else:
+                    heapq.heappush(self._heap, (last + self.window, topic))
+                    self._wake()
+                self._pending[topic] = brightness
+
+        if send_now:
+            self._send(topic, brightness)
+
+    def _wake(self):
+        # Gọi khi đang giữ lock, có mốc trailing edge mới
+        self._cond.notify()
+
+    def _send(self, topic, brightness):
+        try:
+            self._publish(topic, brightness)
+            self.sent += 1
+        except Exception as e:
+            log.error("Brightness publish error %s: %s", topic, e)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    self._cond.wait(timeout)
+                due = self._take_due(time.monotonic())
+
+            for topic, brightness in due:
+                self._send(topic, brightness)
+
+    def _take_due(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, topic = heapq.heappop(self._heap)
+            if topic in self._pending:
+                due.append((topic, self._pending.pop(topic)))
+                self._last_sent[topic] = now
+        # Dọn các device đã im lặng để dict không phình theo số device từng kéo thanh trượt
+        if len(self._last_sent) > 10000:
+            self._last_sent = {t: s for t, s in self._last_sent.items() if now - s < self.window}
+        return due
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="brightness-coalescer", daemon=True)
+        self._thread.start()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "window_ms": self.window * 1000,
+                "received": self.received,
+                "sent": self.sent,
+                "merged": self.merged,
+                "pending": len(self._pending),
+            }
@@ -0,0 +1,343 @@
+# controller/command_tracker.py
+# Theo dõi lệnh gửi xuống đèn tới khi đèn xác nhận (ack):
+# - Mỗi lệnh có cmd_id trong payload; firmware gửi lại cmd_id trong message state ngay sau khi xử lý lệnh.
+#   Chỉ state có đúng cmd_id mới là ack: firmware publish state không có cmd_id mỗi lần kết nối lại MQTT,
+#   message đó không xác nhận lệnh nào. Firmware cũ không gửi cmd_id: bật SMART_LIGHT_ACK_LEGACY=1 để
+#   state kế tiếp của device được coi là ack.
+# - Mỗi device chỉ theo dõi lệnh mới nhất; lệnh mới thay lệnh cũ đang chờ (superseded) để không bao giờ
+#   gửi lại 1 lệnh cũ đè lên lệnh mới hơn.
+# - Hết ACK_TIMEOUT chưa có ack thì gửi lại cùng cmd_id, chờ lâu dần theo RETRY_BACKOFF; hết ACK_RETRIES
+#   lần thì đánh dấu failed (đếm theo device). Nhiều worker: ack có thể tới worker khác nên hết hạn chỉ là
+#   unconfirmed, không báo failed.
+# - Deadline giữ trong min-heap như offline_detector: thread (hoặc task async) chỉ thức dậy khi có lệnh hết hạn.
+import os
+import json
+import time
+import heapq
+import asyncio
+import secrets
+import itertools
+import threading
+from collections import OrderedDict
+
+from config.cluster import CLUSTER_MODE
+from config.logger import get_logger
+from config.metrics import Histogram, Counter
+
+ACK_TIMEOUT = float(os.environ.get("SMART_LIGHT_ACK_TIMEOUT", "3"))         # giây cho lần gửi đầu
+# Nhiều worker: state có thể tới worker khác ($share/...) nên worker gửi không thấy ack; mặc định không gửi lại
+ACK_RETRIES = int(os.environ.get("SMART_LIGHT_ACK_RETRIES", "0" if CLUSTER_MODE else "2"))
+ACK_LEGACY = os.environ.get("SMART_LIGHT_ACK_LEGACY", "0") == "1"     # state không có cmd_id cũng là ack
+RETRY_BACKOFF = 2.0                 # lần gửi lại thứ n chờ ACK_TIMEOUT * RETRY_BACKOFF**n
+MAX_PENDING = 100000                # quá số lệnh đang chờ thì lệnh mới không được theo dõi
+FINISHED_KEEP = 10000               # kết quả gần nhất giữ lại cho wait() gọi sau khi ack đã tới
+SYNC_WAIT_MAX = 10.0                # giây, giới hạn chờ của chế độ ?wait=1
+DEVICE_STATS_LIMIT = 100
+
+ACKED, FAILED, SUPERSEDED, PENDING = "acked", "failed", "superseded", "pending"
+UNCONFIRMED = "unconfirmed"         # hết hạn khi ack có thể đã tới worker khác (cluster)
+
+COMMAND_ACK_SECONDS = Histogram("smart_light_command_ack_seconds",
+                                "Time from first publish of a command to the device's state ack", ("source",),
+                                buckets=(0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+COMMANDS = Counter("smart_light_commands_total", "Tracked device commands by outcome", ("source", "result"))
+COMMAND_RETRIES = Counter("smart_light_command_retries_total", "Commands re-published after an ack timeout")
+
+log = get_logger("commands")
+
+
+def sync_wait_seconds(value):
+    """?wait=1|true -> SYNC_WAIT_MAX, ?wait=<giây> -> tối đa SYNC_WAIT_MAX, không có / 0 -> None."""
+    if not value or value in ("0", "false"):
+        return None
+    try:
+        return min(float(value), SYNC_WAIT_MAX)
+    except ValueError:
+        return SYNC_WAIT_MAX
+
+
+def command_device(topic):
+    """home/<user>/<device>/cmd|state -> <device>."""
+    parts = topic.split("/")
+    return parts[2] if len(parts) == 4 else None
+
+
+class PendingCommand:
+    __slots__ = ("cmd_id", "device", "topic", "payload", "source", "sent_at", "deadline", "attempts", "waiters")
+
+    def __init__(self, cmd_id, device, topic, payload, source, now, deadline):
+        self.cmd_id = cmd_id
+        self.device = device
+        self.topic = topic
+        self.payload = payload
+        self.source = source
+        self.sent_at = now
+        self.deadline = deadline
+        self.attempts = 1
+        self.waiters = []
+
+
+class CommandTracker:
+
+    def __init__(self, timeout=ACK_TIMEOUT, retries=ACK_RETRIES, backoff=RETRY_BACKOFF,
+                 max_pending=MAX_PENDING, publish=None, legacy_acks=ACK_LEGACY, local_acks=not CLUSTER_MODE):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_pending = max_pending
+        self.legacy_acks = legacy_acks
+        # False: worker này không thấy mọi state ($share/...), lệnh hết hạn là unconfirmed thay vì failed
+        self.local_acks = local_acks
+        self._publish = publish         # (topic, payload_str) -> bool, cho thread gửi lại
+        self._cond = threading.Condition()
+        self._by_device = {}            # device -> PendingCommand (chỉ lệnh mới nhất)
+        self._by_id = {}                # cmd_id -> PendingCommand
+        self._heap = []                 # (deadline, seq, cmd_id)
+        self._seq = itertools.count()
+        self._finished = OrderedDict()  # cmd_id -> kết quả
+        self._failed_by_device = {}
+        # Tiền tố ngẫu nhiên theo process: cmd_id không trùng giữa các worker / lần khởi động
+        self._prefix = secrets.token_hex(3)
+        self._ids = itertools.count(1)
+        self._thread = None
+        self._running = False
+
+        self.tracked = 0
+        self.acked = 0
+        self.failed = 0
+        self.superseded = 0
+        self.unconfirmed = 0
+        self.retried = 0
+        self.untracked = 0
+        self._latency_sum = 0.0
+        self.max_latency = 0.0
+
+    def new_id(self):
+        return f"{self._prefix}{next(self._ids):x}"
+
+    # ---------- gửi ----------
+    def track(self, cmd_id, topic, payload, source, now=None):
+        """Gọi sau khi lệnh (payload đã có cmd_id) được đưa vào hàng đợi MQTT."""
+        device = command_device(topic)
+        if device is None:
+            return False
+        now = time.monotonic() if now is None else now
+        with self._cond:
+            if len(self._by_id) >= self.max_pending:
+                self.untracked += 1
+                return False
+            previous = self._by_device.get(device)
+            if previous is not None:
+                self._finish(previous, SUPERSEDED, now)
+            command = PendingCommand(cmd_id, device, topic, payload, source, now, now + self.timeout)
+            self._by_device[device] = command
+            self._by_id[cmd_id] = command
+            wake = not self._heap or command.deadline < self._heap[0][0]
+            heapq.heappush(self._heap, (command.deadline, next(self._seq), cmd_id))
+            self.tracked += 1
+            if wake:
+                self._cond.notify()
+        return True
+
+    def send(self, publish, topic, payload, source):
+        """Gắn cmd_id vào payload (dict), publish, theo dõi nếu vào được hàng đợi. Trả về cmd_id hoặc None."""
+        cmd_id = payload["cmd_id"] = self.new_id()
+        if not publish(topic, json.dumps(payload)):
+            return None
+        self.track(cmd_id, topic, payload, source)
+        return cmd_id
+
+    def send_many(self, publish_many, messages, source):
+        """Như send() cho cả đợt [(topic, payload dict)] qua publish_many; trả về các topic bị bỏ."""
+        for _, payload in messages:
+            payload["cmd_id"] = self.new_id()
+        failed = publish_many([(topic, json.dumps(payload)) for topic, payload in messages])
+        skip = set(failed)
+        now = time.monotonic()
+        for topic, payload in messages:
+            if topic not in skip:
+                self.track(payload["cmd_id"], topic, payload, source, now)
+        return failed
+
+    # ---------- nhận ack ----------
+    def ack(self, device, cmd_id=None, now=None):
+        """
+        Gọi với mỗi message state. cmd_id khác lệnh đang chờ = ack muộn của lệnh đã bị thay, bỏ qua.
+        State không có cmd_id (kết nối lại, nút bấm, cảm biến) chỉ là ack khi bật legacy_acks.
+        """
+        if device not in self._by_device or not (cmd_id or self.legacy_acks):
+            return False
+        now = time.monotonic() if now is None else now
+        with self._cond:
+            command = self._by_device.get(device)
+            if command is None or (cmd_id and cmd_id != command.cmd_id):
+                return False
+            self._finish(command, ACKED, now)
+        return True
+
+    # ---------- hết hạn ----------
+    def pop_expired(self, now=None):
+        """Xử lý các lệnh quá hạn ack. Trả về [(topic, payload_str)] cần gửi lại."""
+        now = time.monotonic() if now is None else now
+        resend = []
+        with self._cond:
+            while self._heap and self._heap[0][0] <= now:
+                deadline, _, cmd_id = heapq.heappop(self._heap)
+                command = self._by_id.get(cmd_id)
+                if command is None or command.deadline != deadline:
+                    continue
+                if command.attempts > self.retries:
+                    self._finish(command, FAILED if self.local_acks else UNCONFIRMED, now)
+                    continue
+                command.deadline = now + self.timeout * self.backoff ** command.attempts
+                command.attempts += 1
+                heapq.heappush(self._heap, (command.deadline, next(self._seq), cmd_id))
+                resend.append((command.topic, json.dumps(command.payload)))
+                self.retried += 1
+        if resend:
+            COMMAND_RETRIES.inc(amount=len(resend))
+        return resend
+
+    def next_deadline(self):
+        with self._cond:
+            return self._heap[0][0] if self._heap else None
+
+    def _finish(self, command, status, now):
+        # gọi khi đang giữ self._cond
+        del self._by_id[command.cmd_id]
+        if self._by_device.get(command.device) is command:
+            del self._by_device[command.device]
+        result = {"cmd_id": command.cmd_id, "device": command.device, "status": status,
+                  "attempts": command.attempts}
+        if status == ACKED:
+            latency = now - command.sent_at
+            result["latency_ms"] = round(latency * 1000, 1)
+            self.acked += 1
+            self._latency_sum += latency
+            self.max_latency = max(self.max_latency, latency)
+            COMMAND_ACK_SECONDS.observe(latency, command.source)
+        elif status == FAILED:
+            self.failed += 1
+            self._failed_by_device[command.device] = self._failed_by_device.get(command.device, 0) + 1
+            log.warning("Command not acknowledged", extra={"device": command.device, "cmd_id": command.cmd_id,
+                                                           "attempts": command.attempts})
+        elif status == UNCONFIRMED:
+            self.unconfirmed += 1
+        else:
+            self.superseded += 1
+        COMMANDS.inc(command.source, status)
+
+        self._finished[command.cmd_id] = result
+        if len(self._finished) > FINISHED_KEEP:
+            self._finished.popitem(last=False)
+        for waiter in command.waiters:
+            waiter(result)
+
+    # ---------- chế độ đồng bộ ----------
+    def _watch(self, cmd_id, callback):
+        """Đăng ký callback(result); trả về kết quả ngay nếu lệnh đã xong, None nếu đang chờ."""
+        with self._cond:
+            command = self._by_id.get(cmd_id)
+            if command is None:
+                return self._finished.get(cmd_id, {"cmd_id": cmd_id, "status": FAILED, "attempts": 0})
+            command.waiters.append(callback)
+            return None
+
+    def _pending_result(self, cmd_id):
+        with self._cond:
+            command = self._by_id.get(cmd_id)
+            if command is None:
+                return self._finished.get(cmd_id)
+            return {"cmd_id": cmd_id, "device": command.device, "status": PENDING, "attempts": command.attempts}
+
+    def wait(self, cmd_id, timeout=SYNC_WAIT_MAX):
+        """Chặn thread gọi tới khi lệnh được ack / failed / bị thay, hoặc hết timeout (status pending)."""
+        done = threading.Event()
+        box = []
+
+        def on_done(result):
+            box.append(result)
+            done.set()
+
+        result = self._watch(cmd_id, on_done)
+        if result is not None:
+            return result
+        if done.wait(timeout):
+            return box[0]
+        return self._pending_result(cmd_id)
+
+    async def wait_async(self, cmd_id, timeout=SYNC_WAIT_MAX):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def on_done(result):
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(result))
+
+        result = self._watch(cmd_id, on_done)
+        if result is not None:
+            return result
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return self._pending_result(cmd_id)
+
+    # ---------- thread gửi lại (runtime threaded) ----------
+    def _run(self):
+        while self._running:
+            with self._cond:
+                wait = (self._heap[0][0] - time.monotonic()) if self._heap else 1.0
+                if wait > 0:
+                    self._cond.wait(min(wait, 1.0))
+            for topic, payload in self.pop_expired():
+                self._publish(topic, payload)
+
+    def start(self, publish=None):
+        if self._running:
+            return
+        if publish is not None:
+            self._publish = publish
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True, name="command-tracker")
+        self._thread.start()
+        log.info("Command tracker started", extra={"timeout": self.timeout, "retries": self.retries})
+
+    def stop(self):
+        self._running = False
+        with self._cond:
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+            self._thread = None
+
+    def stats(self, device=None):
+        with self._cond:
+            if device is not None:
+                command = self._by_device.get(device)
+                return {
+                    "device": device,
+                    "pending": 1 if command else 0,
+                    "pending_cmd_id": command.cmd_id if command else None,
+                    "failed": self._failed_by_device.get(device, 0),
+                }
+            failing = sorted(self._failed_by_device.items(), key=lambda kv: -kv[1])[:DEVICE_STATS_LIMIT]
+            return {
+                "timeout_seconds": self.timeout,
+                "max_retries": self.retries,
+                "legacy_acks": self.legacy_acks,
+                "local_acks": self.local_acks,
+                "pending": len(self._by_id),
+                "tracked": self.tracked,
+                "acked": self.acked,
+                "failed": self.failed,
+                "superseded": self.superseded,
+                "unconfirmed": self.unconfirmed,
+                "retried": self.retried,
+                "untracked": self.untracked,
+                "ack_latency_avg_ms": (self._latency_sum / self.acked * 1000) if self.acked else 0.0,
+                "ack_latency_max_ms": self.max_latency * 1000,
+                "pending_devices": sorted(self._by_device)[:DEVICE_STATS_LIMIT],
+                "failed_by_device": dict(failing),
+            }
+
+
+command_tracker = CommandTracker()
@@ -0,0 +1,143 @@
+# controller/device_cache.py
+# Cache trạng thái thiết bị trong bộ nhớ: nạp từ DB lúc khởi động, sau đó cập nhật từ MQTT
+# và offline detector. GET /api/devices đọc snapshot đã dựng sẵn, không truy vấn DB.
+import json
+import os
+import time
+import threading
+
+from config.logger import get_logger
+from controller.repository import all_devices
+
+log = get_logger("cache")
+
+
+class DeviceSnapshot:
+    """Snapshot bất biến: danh sách devices + JSON đã serialize + ETag."""
+    __slots__ = ("version", "devices", "body", "etag")
+
+    def __init__(self, version, devices, body, etag):
+        self.version = version
+        self.devices = devices
+        self.body = body
+        self.etag = etag
+
+
+class DeviceCache:
+    """
+    Ghi (MQTT thread, offline detector) sửa dict dưới lock và tăng version.
+    Đọc chỉ so version với snapshot hiện tại; snapshot chỉ dựng lại khi có thay đổi,
+    nên request dashboard không tranh lock với luồng ingest trong trường hợp thường gặp.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._devices = {}          # device_name -> dict
+        self._version = 0
+        self._boot = os.urandom(4).hex()
+        self._snapshot = None
+        self._refreshing = threading.Lock()
+        self._loaded_at = 0.0
+        self.warmed = False
+
+        self.hits = 0
+        self.rebuilds = 0
+
+    def warm(self):
+        """Nạp toàn bộ bảng devices một lần."""
+        try:
+            rows = all_devices()
+        except Exception as e:
+            log.error("Device cache warm error: %s", e)
+            return False
+        self.load_rows(rows)
+        return True
+
+    def load_rows(self, rows):
+        """Thay toàn bộ cache bằng các dòng (device_id, device_name, is_on, mode, brightness)."""
+        first = not self.warmed
+        with self._lock:
+            self._devices = {
+                row[1]: {
+                    "device_id": row[0],
+                    "device_name": row[1],
+                    "is_on": row[2],
+                    "mode": row[3],
+                    "brightness": row[4]
+                }
+                for row in rows
+            }
+            self._version += 1
+            self._loaded_at = time.monotonic()
+            self.warmed = True
+        if first:
+            log.info("Device cache warmed: %d devices", len(rows))
+
+    def stale(self, max_age):
+        return time.monotonic() - self._loaded_at >= max_age
+
+    def refresh_if_stale(self, max_age):
+        """
+        Chế độ nhiều worker: state do worker khác ghi chỉ thấy qua DB, nên nạp lại khi cache
+        cũ hơn max_age giây. Chỉ 1 thread nạp, các request khác dùng snapshot hiện tại.
+        """
+        if not self.stale(max_age) or not self._refreshing.acquire(blocking=False):
+            return
+        try:
+            self.warm()
+        finally:
+            self._refreshing.release()
+
+    def update(self, device_name, is_on, mode, brightness):
+        """Áp trạng thái mới; bỏ qua device chưa có trong DB (giống UPDATE không khớp dòng nào)."""
+        with self._lock:
+            device = self._devices.get(device_name)
+            if device is None:
+                return False
+            if device["is_on"] == is_on and device["mode"] == mode and device["brightness"] == brightness:
+                return True
+            self._devices[device_name] = dict(device, is_on=is_on, mode=mode, brightness=brightness)
+            self._version += 1
+            return True
+
+    def mark_offline(self, device_names):
+        with self._lock:
+            changed = False
+            for name in device_names:
+                device = self._devices.get(name)
+                if device is not None and device["is_on"]:
+                    self._devices[name] = dict(device, is_on=False)
+                    changed = True
+            if changed:
+                self._version += 1
+
+    def get(self, device_name):
+        return self._devices.get(device_name)
+
+    def snapshot(self):
+        snap = self._snapshot
+        if snap is not None and snap.version == self._version:
+            self.hits += 1
+            return snap
+
+        with self._lock:
+            snap = self._snapshot
+            if snap is None or snap.version != self._version:
+                devices = sorted(self._devices.values(), key=lambda d: d["device_id"])
+                body = json.dumps(devices)
+                snap = DeviceSnapshot(self._version, devices, body, f"{self._boot}-{self._version}")
+                self._snapshot = snap
+                self.rebuilds += 1
+        return snap
+
+    def stats(self):
+        return {
+            "warmed": self.warmed,
+            "devices": len(self._devices),
+            "version": self._version,
+            "snapshot_hits": self.hits,
+            "snapshot_rebuilds": self.rebuilds,
+        }
+
+
+device_cache = DeviceCache()
@@ -0,0 +1,142 @@
+# controller/device_topics.py
+# Chỉ mục device -> topic MQTT "home/<user>/<device>/cmd" dùng cho scheduler và lệnh hàng loạt.
+# Phần <user> lấy từ topic state mà device đã publish (liveness học được); nếu device chưa
+# từng online thì dùng quy ước "user<user_id>" giống firmware (user1 ứng với users.user_id = 1).
+import threading
+
+from config.logger import get_logger
+from controller.repository import device_topics as fetch_device_topics, device_topic_by_name
+from controller.liveness import liveness
+from controller.auth import get_user_by_id
+
+log = get_logger("cache")
+
+MAX_DEVICE_ID = 2 ** 31 - 1     # cột integer của PostgreSQL
+
+
+def cmd_topic(device_name, user_id):
+    user = liveness.user_of(device_name) or f"user{user_id}"
+    return f"home/{user}/{device_name}/cmd"
+
+
+class DeviceTopicIndex:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_id = {}        # device_id (int) -> (device_name, user_id)
+        self._by_name = {}      # device_name -> device_id
+        self.loaded = False
+
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, device_ids=None):
+        """Nạp toàn bộ (hoặc chỉ các device_ids còn thiếu) từ bảng devices."""
+        try:
+            rows = fetch_device_topics(device_ids)
+        except Exception as e:
+            log.error("Device topics load error: %s", e)
+            return
+        self.load_rows(rows, complete=device_ids is None)
+
+    def load_rows(self, rows, complete=False):
+        """rows: (device_id, device_name, user_id); complete=True khi là toàn bộ bảng devices."""
+        with self._lock:
+            for device_id, device_name, user_id in rows:
+                self._by_id[device_id] = (device_name, user_id)
+                self._by_name[device_name] = device_id
+            if complete:
+                self.loaded = True
+
+    def missing(self, device_ids):
+        """Các device_id chưa có trong chỉ mục (được tính vào misses)."""
+        missing = [d for d in device_ids if d not in self._by_id]
+        self.misses += len(missing)
+        return missing
+
+    def resolve_many(self, device_ids):
+        """
+        Trả về dict device_id -> (device_name, cmd_topic).
+        Device chưa có trong chỉ mục được nạp bằng 1 truy vấn chung.
+        """
+        if not self.loaded:
+            self.load()
+        missing = self.missing(device_ids)
+        if missing:
+            self.load(missing)
+        return self.lookup_many(device_ids)
+
+    def lookup_many(self, device_ids):
+        """Như resolve_many nhưng chỉ đọc chỉ mục, không truy vấn DB."""
+        result = {}
+        for device_id in device_ids:
+            entry = self._by_id.get(device_id)
+            if entry is None:
+                continue
+            device_name, user_id = entry
+            result[device_id] = (device_name, cmd_topic(device_name, user_id))
+        self.hits += len(result)
+        return result
+
+    def resolve(self, device_id):
+        return self.resolve_many((device_id,)).get(device_id)
+
+    def lookup(self, device):
+        """device_name (vd: light1) hoặc device_id dạng số -> (device_id, device_name, user_id); None nếu không có."""
+        if not self.loaded:
+            self.load()
+        device = str(device)
+        device_id = self._by_name.get(device)
+        if device_id is None and device.isdecimal() and 0 < int(device) <= MAX_DEVICE_ID:
+            device_id = int(device)
+        entry = self._by_id.get(device_id)
+        if entry is not None:
+            return (device_id,) + entry
+
+        # Device thêm sau khi nạp chỉ mục: chỉ đọc đúng 1 dòng, không nạp lại cả bảng devices
+        # (tên không tồn tại gửi lặp lại không thành 1 lần đọc toàn bảng mỗi request)
+        try:
+            row = device_topic_by_name(device)
+            if row is None and device_id is not None:
+                row = next(iter(fetch_device_topics((device_id,))), None)
+        except Exception as e:
+            log.error("Device topics lookup error: %s", e)
+            return None
+        if row is None:
+            return None
+        self.load_rows((row,))
+        return tuple(row)
+
+    def owner_of(self, device_name):
+        """users.user_id sở hữu device; chỉ đọc chỉ mục (None nếu chưa nạp / không có)."""
+        device_id = self._by_name.get(device_name)
+        entry = self._by_id.get(device_id)
+        return entry[1] if entry else None
+
+    def invalidate(self):
+        with self._lock:
+            self._by_id = {}
+            self._by_name = {}
+            self.loaded = False
+
+
+device_topics = DeviceTopicIndex()
+
+
+def is_admin(user_id):
+    user = get_user_by_id(user_id)
+    return bool(user) and user.get("role") == "admin"
+
+
+def device_for_user(user_id, device):
+    """
+    device_id nếu user là chủ device hoặc admin; None nếu không có device hoặc không có quyền
+    (route trả 404 cho cả hai, không lộ device của user khác). Có thể truy vấn DB.
+    """
+    entry = device_topics.lookup(device)
+    if entry is None:
+        return None
+    device_id, _, owner = entry
+    if owner == user_id or is_admin(user_id):
+        return device_id
+    return None
@@ -1,95 +1,125 @@
-import json
+import time
 from config.db import get_db_connection
 from config.web_socket import socketio
-import paho.mqtt.client as mqtt
+from controller.state_writer import state_writer, write_rows
+from controller.liveness import liveness
+from controller.offline_detector import offline_detector
+from controller.device_cache import device_cache
+from controller.repository import all_devices, recent_logs, to_dicts
+from controller.device_topics import cmd_topic, is_admin, MAX_DEVICE_ID
+from controller.rooms import state_rooms
+from controller.push import delta_pusher
+from controller.event_log import event_log
+from controller.usage import usage
+from config.mqtt import mqtt_gateway, topic_class
+from config.metrics import MQTT_MESSAGES, MQTT_CALLBACK_SECONDS
+from config.logger import get_logger, Throttle, DEBUG
+from controller.brightness_coalescer import BrightnessCoalescer
+from controller.command_tracker import command_tracker
+from controller.mqtt_decoder import decode, state_event, HeartbeatMessage
 from datetime import datetime, timezone
 
+log = get_logger("devices")
+mqtt_log = get_logger("mqtt")
+# Log theo từng device: tối đa 1 dòng / device / SAMPLE_INTERVAL
+device_throttle = Throttle()
+queue_full_throttle = Throttle()
+
 # ====================
 # MQTT SETUP
 # ====================
-MQTT_BROKER = "broker.hivemq.com"  # hoặc IP của HiveMQ broker
-MQTT_PORT = 1883
-mqtt_client = mqtt.Client()
-mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)
-mqtt_client.loop_start()
+# Dùng chung 1 kết nối với app.py (config.mqtt.mqtt_gateway), không tự connect lúc import
+mqtt_client = mqtt_gateway
 
 
 # ====================
 # UPDATE DATABASE
 # ====================
-def update_device_state(data):
-    device_name = data.get("device_id")
-    state = data.get("state")
-    mode = data.get("mode")
-    brightness = data.get("brightness")
-    is_on = (state == "on")
+def update_device_state(message):
+    """
+    Chuyển StateMessage (đã decode + kiểm tra schema) thành 1 dòng và giao cho state_writer ghi theo batch.
+    Nếu writer chưa chạy (vd: chạy script riêng) thì ghi trực tiếp như cũ.
+    """
+    device_name = message.device_id
+    mode = message.mode
+    brightness = message.brightness
+    is_on = (message.state == "on")
     now = datetime.now(timezone.utc)
 
-    conn = None
-    try:
-        conn = get_db_connection()
-        if conn is None:
-            print(f"❌ Cannot connect to DB for device: {device_name}")
-            return
+    # Nhật ký chỉ ghi trường thật sự đổi so với cache (chỉ append vào buffer, không chạm DB)
+    event_log.record_state(device_name, device_cache.get(device_name), is_on, mode, brightness, at=now)
+    device_cache.update(device_name, is_on, mode, brightness)
+    # Cộng dồn giây bật / độ sáng theo phút cho thống kê sử dụng
+    usage.observe(device_name, is_on, brightness, now)
+    # Dashboard nhận theo batch, chỉ các trường thay đổi
+    delta_pusher.record(device_name, is_on=is_on, mode=mode, brightness=brightness, offline=False)
 
-        cursor = conn.cursor()
-        query = """
-            UPDATE devices
-            SET is_on = %s, mode = %s, brightness = %s, last_online = %s
-            WHERE device_name = %s;
-        """
-        print(f"📝 Executing query: UPDATE devices SET is_on={is_on}, mode={mode}, brightness={brightness}, last_online={now} WHERE device_name={device_name}")
-        cursor.execute(query, (is_on, mode, brightness, now, device_name))
-        affected = cursor.rowcount
-        if affected > 0:
-            conn.commit()
-            print(f"✅ Updated {device_name}: is_on={is_on}, mode={mode}, brightness={brightness}")
-        else:
-            print(f"⚠️ Device not found in DB: {device_name}")
-    except Exception as e:
-        print(f"❌ DB Error: {e}")
-        if conn:
-            conn.rollback()
-    finally:
-        if conn:
-            conn.close()
+    row = (device_name, is_on, mode, brightness, now)
+    if state_writer.running:
+        if not state_writer.submit(row):
+            suppressed = queue_full_throttle.allow()
+            if suppressed is not None:
+                log.warning("State queue full, dropped update", extra={"device": device_name, "suppressed": suppressed})
+        return
+
+    written, _ = write_rows([row])
+    if written:
+        log.debug("Updated %s: is_on=%s, mode=%s, brightness=%s", device_name, is_on, mode, brightness)
+
+
+# ====================
+# HEARTBEAT
+# ====================
+def heartbeat_devices(message):
+    """
+    Danh sách device trong 1 HeartbeatMessage.
+    Firmware mới gửi {"devices": [...]}; bản cũ chỉ gửi timestamp nên
+    dùng các device đã thấy trên topic state của user đó.
+    """
+    if message.devices:
+        return message.devices
+    if message.device_id:
+        return (message.device_id,)
+    return liveness.devices_of(message.user)
 
 
 # ====================
 # MQTT CALLBACK (khi có MQTT message)
 # ====================
 def on_message(client, userdata, msg):
+    start = time.perf_counter()
+    cls = topic_class(msg.topic)
+    MQTT_MESSAGES.inc("in", cls)
     try:
-        payload = msg.payload.decode()
-        print(f"[MQTT] Topic={msg.topic} Payload={payload}")
-        data = json.loads(payload)
-        topic = msg.topic
-
-        # Nếu là heartbeat
-        if topic.endswith("/heartbeat"):
-            device_id = data.get("device_id")
-            now = datetime.now(timezone.utc)
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute(
-                "UPDATE devices SET last_online=%s WHERE 1=1",
-                (now,)
-            )
-            conn.commit()
-            conn.close()
+        if mqtt_log.isEnabledFor(DEBUG) and device_throttle.allow(msg.topic) is not None:
+            mqtt_log.debug("Topic=%s Payload=%r", msg.topic, msg.payload)
+        # Parse 1 lần + kiểm tra schema; message lỗi đã được đếm ở dead letter
+        message = decode(msg.topic, msg.payload)
+        if message is None:
             return
 
-        try:
-            data = json.loads(payload)
-            update_device_state(data)
-            socketio.emit("device_state_update", data) 
-            print("🔥 EMIT TO FRONTEND:", data)
+        # Nếu là heartbeat (home/<user>/heartbeat): chỉ cập nhật bảng liveness trong bộ nhớ
+        if type(message) is HeartbeatMessage:
+            devices = heartbeat_devices(message)
+            liveness.touch(devices)
+            offline_detector.alive(devices)
+            return
 
-        except json.JSONDecodeError:
-            print("❌ Invalid JSON")
+        # home/<user>/<device>/state
+        device_name = message.device_id
+        liveness.register(message.user, device_name)
+        liveness.touch((device_name,))
+        offline_detector.alive((device_name,))
+        # Ack cho lệnh đang chờ của device (cmd_id do firmware gửi lại, nếu có)
+        command_tracker.ack(device_name, message.cmd_id)
+        update_device_state(message)
+        # Chỉ client đang xem device / user sở hữu device nhận cập nhật
+        socketio.emit("device_state_update", state_event(message), to=state_rooms(device_name))
 
     except Exception as e:
-        print(f"❌ MQTT Callback Error: {e}")
+        mqtt_log.error("MQTT callback error: %s", e, extra={"topic": msg.topic})
+    finally:
+        MQTT_CALLBACK_SECONDS.since(start, cls)
 
 
 
@@ -120,66 +150,237 @@ def process_device_command(mqtt_client, data):
     if brightness is not None:
         payload["brightness"] = brightness
 
-    mqtt_client.publish(topic, json.dumps(payload))
-    print("==> MQTT Published:", topic, payload)
+    # cmd_id trong payload: đèn gửi lại trong message state, command_tracker đo độ trễ và gửi lại khi mất
+    cmd_id = command_tracker.send(mqtt_client.publish, topic, payload, "api")
+    if cmd_id is None:
+        return {"error": "MQTT outbound queue full"}, 503
+    log.debug("MQTT published %s %s", topic, payload)
+    event_log.record_command(device_id, payload, "api")
+
+    return {"message": "Command sent", "cmd_id": cmd_id, "mqtt_topic": topic, "mqtt_payload": payload}, 200
 
-    return {"message": "Command sent", "mqtt_topic": topic, "mqtt_payload": payload}, 200
 
+# ====================
+# PROCESS BULK COMMAND (nhiều device / group / scene trong 1 request)
+# ====================
+MAX_BULK_DEVICES = 5000
+
+# Tham số owner cuối mỗi query: NULL = admin (mọi device), ngược lại chỉ device / group / scene của user đó.
+# Tên group / scene chỉ duy nhất trong từng user: tra theo tên luôn lấy group / scene của chính user gửi lệnh
+# (admin muốn dùng group của user khác thì gửi id).
+BULK_DEVICES_QUERY = """
+    SELECT device_id, device_name, user_id, NULL, NULL, NULL
+    FROM devices
+    WHERE (device_name = ANY(%s) OR device_id = ANY(%s))
+      AND (%s::int IS NULL OR user_id = %s)
+"""
+BULK_GROUP_QUERY = """
+    SELECT d.device_id, d.device_name, d.user_id, NULL, NULL, NULL
+    FROM device_groups g
+    JOIN device_group_members m ON m.group_id = g.group_id
+    JOIN devices d ON d.device_id = m.device_id
+    WHERE (g.group_id::text = %s OR (g.name = %s AND g.user_id = %s))
+      AND (%s::int IS NULL OR (g.user_id = %s AND d.user_id = g.user_id))
+"""
+BULK_SCENE_QUERY = """
+    SELECT d.device_id, d.device_name, d.user_id, sd.state, sd.mode, sd.brightness
+    FROM scenes s
+    JOIN scene_devices sd ON sd.scene_id = s.scene_id
+    JOIN devices d ON d.device_id = sd.device_id
+    WHERE (s.scene_id::text = %s OR (s.name = %s AND s.user_id = %s))
+      AND (%s::int IS NULL OR (s.user_id = %s AND d.user_id = s.user_id))
+"""
+
+
+def bulk_owner(user_id):
+    """Admin điều khiển mọi device (None), user thường chỉ device của mình (có truy vấn DB)."""
+    return None if is_admin(user_id) else user_id
+
+
+def _device_ids(devices):
+    """Phần tử là số nguyên (hoặc chuỗi chữ số thập phân) trong danh sách devices -> device_id."""
+    ids = []
+    for d in devices:
+        # isdecimal: "²" là isdigit() nhưng int() không đổi được
+        if type(d) is int or (isinstance(d, str) and d.isdecimal()):
+            value = int(d)
+            if 0 < value <= MAX_DEVICE_ID:
+                ids.append(value)
+    return ids
+
+
+def resolve_bulk_targets(data, user_id):
+    """
+    Kiểm tra toàn bộ đích của lệnh bằng đúng 1 truy vấn, chỉ trong các device mà user_id (session) được điều khiển.
+    Device của user khác được báo như không tìm thấy.
+    Trả về: (rows [(device_id, device_name, user_id, state, mode, brightness)], danh sách không tìm thấy,
+    lỗi (message, status) hoặc None)
+    """
+    devices = data.get("devices")
+    group = data.get("group")
+    scene = data.get("scene")
+
+    if sum(x is not None for x in (devices, group, scene)) != 1:
+        return None, None, ("Cần đúng một trong: devices, group, scene", 400)
+
+    if devices is not None:
+        if not isinstance(devices, list) or not devices:
+            return None, None, ("devices phải là danh sách khác rỗng", 400)
+        if len(devices) > MAX_BULK_DEVICES:
+            return None, None, (f"Tối đa {MAX_BULK_DEVICES} devices mỗi request", 400)
+        names = [str(d) for d in devices]
+        query, params = BULK_DEVICES_QUERY, (names, _device_ids(devices))
+    elif group is not None:
+        query, params = BULK_GROUP_QUERY, (str(group), str(group), user_id)
+    else:
+        query, params = BULK_SCENE_QUERY, (str(scene), str(scene), user_id)
+    owner = bulk_owner(user_id)
+    params += (owner, owner)
+
+    conn = get_db_connection()
+    if conn is None:
+        return None, None, ("Lỗi kết nối database", 500)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+    except Exception as e:
+        log.error("DB error: %s", e)
+        return None, None, ("Lỗi truy vấn database", 500)
+    finally:
+        conn.close()
+
+    missing = []
+    if devices is not None:
+        found = {r[1] for r in rows} | {str(r[0]) for r in rows}
+        missing = [d for d in devices if str(d) not in found]
+    elif not rows:
+        return None, None, ("Không tìm thấy group/scene hoặc group/scene không có device", 400)
+    return rows, missing, None
+
+
+def process_bulk_command(mqtt_client, data, user_id):
+    """
+    Gửi cùng một lệnh (hoặc thiết lập riêng của scene) tới nhiều device của user_id (admin: mọi device).
+    Body: {devices: [...]} | {group: id/tên} | {scene: id/tên}, kèm state/mode/brightness.
+    Trả về tổng kết theo từng device.
+    """
+    data = data or {}
+    rows, missing, error = resolve_bulk_targets(data, user_id)
+    if error:
+        message, status = error
+        return {"error": message}, status
+    return send_bulk_command(mqtt_client, data, rows, missing)
+
+
+def send_bulk_command(mqtt_client, data, rows, missing):
+    """Dựng và đưa vào hàng đợi MQTT các lệnh cho các device đã được resolve_bulk_targets kiểm tra."""
+    timestamp = datetime.utcnow().isoformat() + "Z"
+    messages = []
+    results = []
+    for device_id, device_name, user_id, scene_state, scene_mode, scene_brightness in rows:
+        payload = {
+            "command": "set",
+            "state": scene_state if scene_state is not None else data.get("state"),
+            "mode": scene_mode if scene_mode is not None else data.get("mode"),
+            "timestamp": timestamp
+        }
+        brightness = scene_brightness if scene_brightness is not None else data.get("brightness")
+        if brightness is not None:
+            payload["brightness"] = brightness
+
+        topic = cmd_topic(device_name, user_id)
+        messages.append((topic, payload))
+        results.append({"device_id": device_id, "device_name": device_name, "mqtt_topic": topic, "status": "sent"})
+
+    failed = set(command_tracker.send_many(mqtt_client.publish_many, messages, "bulk"))
+    for result, (_, payload) in zip(results, messages):
+        if result["mqtt_topic"] in failed:
+            result["status"] = "publish_failed"
+        else:
+            result["cmd_id"] = payload["cmd_id"]
+            event_log.record_command(result["device_name"], payload, "bulk")
+    for device in missing:
+        results.append({"device_id": device, "status": "not_found"})
+
+    sent = len(results) - len(failed) - len(missing)
+    log.info("MQTT bulk published: %d sent, %d failed, %d not found", sent, len(failed), len(missing))
+    return {
+        "message": "Bulk command sent",
+        "sent": sent,
+        "failed": len(failed),
+        "not_found": len(missing),
+        "results": results
+    }, 200
 
 
 # ====================
 # WEBSOCKET HANDLER CHO BRIGHTNESS
 # ====================
-@socketio.on("brightness_change")  # đồng bộ với frontend
-def handle_brightness_command(data):
+def brightness_command(brightness):
+    return {
+        "command": "set",
+        "brightness": brightness,
+        "timestamp": datetime.utcnow().isoformat() + "Z"
+    }
+
+
+def publish_brightness(topic, brightness):
+    payload = brightness_command(brightness)
+    if command_tracker.send(mqtt_client.publish, topic, payload, "ws"):
+        event_log.record_command(topic.split("/")[2], {"brightness": brightness}, "ws")
+    log.debug("WS -> MQTT published %s %s", topic, payload)
+
+
+def brightness_topic(data):
+    """Topic lệnh cho sự kiện brightness_change, None nếu payload thiếu trường."""
     device_id = data.get("device_id")
     user_id = data.get("user_id")
-    brightness = data.get("brightness")
+    if device_id and user_id and data.get("brightness") is not None:
+        return f"home/{user_id}/{device_id}/cmd"
+    return None
 
-    if device_id and user_id and brightness is not None:
-        topic = f"home/{user_id}/{device_id}/cmd"
-        payload = {
-            "command": "set",
-            "brightness": brightness,
-            "timestamp": datetime.utcnow().isoformat() + "Z"
-        }
-        mqtt_client.publish(topic, json.dumps(payload))
-        print(f"🌟 WS -> MQTT Published: {topic} {payload}")
 
+# Kéo thanh trượt sinh rất nhiều sự kiện: mỗi device chỉ gửi tối đa 1 lệnh / BRIGHTNESS_WINDOW
+brightness_coalescer = BrightnessCoalescer(publish_brightness)
+
+
+@socketio.on("brightness_change")  # đồng bộ với frontend
+def handle_brightness_command(data):
+    topic = brightness_topic(data)
+    if topic:
+        brightness_coalescer.submit(topic, data["brightness"])
     else:
-        print("⚠ Invalid WS brightness payload:", data)
+        log.warning("Invalid WS brightness payload: %s", data)
 
 # ====================
 # Lấy ds thiết bị từ DB
 # ====================
 
 def get_all_devices():
-    """Lấy danh sách tất cả devices từ database"""
-    conn = None
-    try:
-        conn = get_db_connection()
-        if conn is None:
-            return []
+    """Lấy danh sách tất cả devices (từ cache nếu đã nạp, ngược lại từ database)"""
+    if device_cache.warmed:
+        return device_cache.snapshot().devices
 
-        cursor = conn.cursor()
-        query = "SELECT device_id, device_name, is_on, mode, brightness FROM devices;"
-        cursor.execute(query)
-        devices = cursor.fetchall()
-        
-        result = []
-        for device in devices:
-            result.append({
-                "device_id": device[0],
-                "device_name": device[1],
-                "is_on": device[2],
-                "mode": device[3],
-                "brightness": device[4]
-            })
-        return result
+    try:
+        return to_dicts(all_devices())
     except Exception as e:
-        print(f"❌ DB Error: {e}")
+        log.error("DB error: %s", e)
         return []
-    finally:
-        if conn:
-            conn.close()
+
+
+def get_device_logs(device_id, limit=50):
+    """
+    Các sự kiện gần nhất của 1 device trong bảng logs, mới nhất trước. Trả về (response, status).
+    device_id: đã kiểm tra quyền ở route (device_for_user: chủ device hoặc admin).
+    """
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return {"error": "limit phải là số"}, 400
+    try:
+        return {"device_id": device_id, "logs": to_dicts(recent_logs(device_id, limit))}, 200
+    except Exception as e:
+        log.error("DB error: %s", e)
+        return {"error": "Lỗi truy vấn database"}, 500
 
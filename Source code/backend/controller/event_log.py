@@ -0,0 +1,243 @@
+# controller/event_log.py
+# Nhật ký sự kiện vào bảng logs: đổi trạng thái/mode/brightness, lệnh gửi xuống device,
+# lịch hẹn giờ đã chạy, device offline.
+# Nơi phát sinh sự kiện (kể cả callback MQTT) chỉ append 1 tuple vào buffer trong bộ nhớ;
+# thread riêng ghi cả batch bằng COPY ... FROM STDIN (nhanh hơn INSERT nhiều dòng).
+# Buffer có giới hạn: đầy thì bỏ sự kiện cũ nhất (drop_oldest) hoặc sự kiện mới (drop_newest).
+import io
+import os
+import time
+import threading
+from collections import deque
+from datetime import datetime, timezone
+
+from config.db import get_db_connection
+from config.metrics import timed_query
+from config.logger import get_logger
+from controller.device_cache import device_cache
+
+log = get_logger("events")
+
+FLUSH_MAX_ROWS = 5000       # đủ số sự kiện thì ghi ngay
+FLUSH_INTERVAL = 0.5        # giây, tối đa giữ 1 batch
+BUFFER_MAX_SIZE = 100000    # ~10 giây ở 10k sự kiện/s
+OVERFLOW_POLICIES = ("drop_oldest", "drop_newest")
+OVERFLOW_POLICY = os.environ.get("SMART_LIGHT_EVENT_OVERFLOW", "drop_oldest")
+
+EVENT_COLUMNS = ("device_id", "event_type", "old_value", "new_value", "description", "created_at")
+COPY_QUERY = f"COPY logs ({', '.join(EVENT_COLUMNS)}) FROM STDIN"
+
+# Loại sự kiện (logs.event_type)
+STATE_CHANGE = "state_change"
+MODE_CHANGE = "mode_change"
+BRIGHTNESS_CHANGE = "brightness_change"
+COMMAND = "command"
+SCHEDULE = "schedule"
+OFFLINE = "offline"
+
+
+def _copy_value(value):
+    """1 giá trị ở định dạng text của COPY (NULL = \\N, escape \\ tab xuống dòng)."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+
+def copy_rows(rows):
+    """Ghi các dòng (theo EVENT_COLUMNS) bằng 1 lệnh COPY. Trả về số dòng đã ghi."""
+    buf = io.StringIO()
+    for row in rows:
+        buf.write("\t".join(_copy_value(v) for v in row))
+        buf.write("\n")
+    buf.seek(0)
+
+    conn = get_db_connection()
+    if conn is None:
+        raise ConnectionError("Không kết nối được DB")
+    try:
+        cursor = conn.cursor()
+        timed_query("event_log_copy", cursor.copy_expert, COPY_QUERY, buf)
+        conn.commit()
+        return len(rows)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def _text(value):
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return "on" if value else "off"
+    return str(value)[:100]     # old_value / new_value là varchar(100)
+
+
+def command_summary(payload):
+    """new_value cho sự kiện command, vd: "state=on mode=manual brightness=80"."""
+    return " ".join(f"{k}={payload[k]}" for k in ("state", "mode", "brightness") if payload.get(k) is not None)
+
+
+class _RowEvent(tuple):
+    """Dòng đã ở dạng EVENT_COLUMNS, được trả lại buffer sau khi COPY lỗi."""
+    __slots__ = ()
+
+
+class EventLog:
+
+    def __init__(self, flush_max_rows=FLUSH_MAX_ROWS, flush_interval=FLUSH_INTERVAL,
+                 max_size=BUFFER_MAX_SIZE, policy=OVERFLOW_POLICY, writer=copy_rows):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"policy phải là một trong {OVERFLOW_POLICIES}")
+        self.flush_max_rows = flush_max_rows
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.policy = policy
+        self._writer = writer
+        self._lock = threading.Lock()
+        self._buffer = deque()      # (device_name, event_type, old, new, description, created_at)
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.recorded = 0
+        self.dropped = 0            # bị bỏ vì buffer đầy
+        self.requeued = 0           # trả lại buffer sau khi COPY lỗi
+        self.batches = 0
+        self.rows_written = 0
+        self.rows_failed = 0
+        self.max_depth = 0
+        self.last_flush_ms = 0.0
+
+    # ---------- ghi nhận (mọi luồng) ----------
+    def record(self, device_name, event_type, old_value=None, new_value=None, description=None, at=None):
+        """Chỉ append vào buffer, không chạm DB. Trả về False nếu sự kiện bị bỏ."""
+        event = (device_name, event_type, _text(old_value), _text(new_value), description,
+                 at or datetime.now(timezone.utc))
+        with self._lock:
+            if len(self._buffer) >= self.max_size:
+                self.dropped += 1
+                if self.policy == "drop_newest":
+                    return False
+                self._buffer.popleft()
+            self._buffer.append(event)
+            self.recorded += 1
+            depth = len(self._buffer)
+            if depth > self.max_depth:
+                self.max_depth = depth
+        if depth == self.flush_max_rows:
+            self._wake.set()
+        return True
+
+    def record_state(self, device_name, previous, is_on, mode, brightness, at=None, description="mqtt"):
+        """So với trạng thái trước đó trong device_cache, chỉ ghi các trường thật sự đổi."""
+        if previous is None:
+            return
+        if previous["is_on"] != is_on:
+            self.record(device_name, STATE_CHANGE, previous["is_on"], is_on, description, at)
+        if previous["mode"] != mode:
+            self.record(device_name, MODE_CHANGE, previous["mode"], mode, description, at)
+        if previous["brightness"] != brightness:
+            self.record(device_name, BRIGHTNESS_CHANGE, previous["brightness"], brightness, description, at)
+
+    def record_command(self, device_name, payload, source):
+        self.record(device_name, COMMAND, None, command_summary(payload), source)
+
+    # ---------- lấy batch (dùng chung cho thread và runtime async) ----------
+    def take_batch(self, limit=None):
+        """Lấy tối đa `limit` sự kiện cũ nhất, đã đổi device_name -> device_id theo EVENT_COLUMNS."""
+        limit = limit or self.flush_max_rows
+        with self._lock:
+            count = min(limit, len(self._buffer))
+            events = [self._buffer.popleft() for _ in range(count)]
+        return [self._to_row(event) for event in events]
+
+    @staticmethod
+    def _to_row(event):
+        if isinstance(event, _RowEvent):
+            return tuple(event)
+        device_name, event_type, old_value, new_value, description, created_at = event
+        device = device_cache.get(device_name)
+        if device is None:
+            # Device chưa có trong cache: giữ tên trong description để không mất dấu
+            return (None, event_type, old_value, new_value, f"{device_name}: {description or ''}", created_at)
+        return (device["device_id"], event_type, old_value, new_value, description, created_at)
+
+    def requeue(self, rows):
+        """COPY lỗi: đưa batch về đầu buffer nếu còn chỗ, phần không vừa tính là failed."""
+        with self._lock:
+            room = max(0, self.max_size - len(self._buffer))
+            keep = rows[:room]
+            self._buffer.extendleft(reversed([_RowEvent(row) for row in keep]))
+            self.requeued += len(keep)
+            self.rows_failed += len(rows) - len(keep)
+
+    def mark_written(self, count, elapsed_ms):
+        with self._lock:
+            self.batches += 1
+            self.rows_written += count
+            self.last_flush_ms = elapsed_ms
+
+    # ---------- thread ghi (runtime threaded) ----------
+    def flush(self):
+        """Ghi hết buffer theo từng batch FLUSH_MAX_ROWS."""
+        while True:
+            rows = self.take_batch()
+            if not rows:
+                return
+            start = time.monotonic()
+            try:
+                written = self._writer(rows)
+            except Exception as e:
+                log.error("Event log COPY error (%d rows): %s", len(rows), e)
+                self.requeue(rows)
+                return
+            self.mark_written(written, (time.monotonic() - start) * 1000)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+        # Ghi nốt khi dừng
+        self.flush()
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="event-log-writer", daemon=True)
+        self._thread.start()
+        log.info("Event log writer started")
+
+    def stop(self, timeout=5.0):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout)
+        self._thread = None
+        log.info("Event log writer stopped", extra={"written": self.rows_written, "dropped": self.dropped})
+
+    def stats(self):
+        with self._lock:
+            return {
+                "buffer_depth": len(self._buffer),
+                "buffer_max_size": self.max_size,
+                "overflow_policy": self.policy,
+                "max_depth": self.max_depth,
+                "recorded": self.recorded,
+                "dropped": self.dropped,
+                "requeued": self.requeued,
+                "batches": self.batches,
+                "rows_written": self.rows_written,
+                "rows_failed": self.rows_failed,
+                "last_flush_ms": self.last_flush_ms,
+            }
+
+
+event_log = EventLog()
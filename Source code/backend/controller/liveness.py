@@ -0,0 +1,148 @@
+# controller/liveness.py
+# Bảng liveness trong bộ nhớ: heartbeat chỉ cập nhật dict, còn DB được checkpoint theo batch định kỳ
+# thay vì "UPDATE devices SET last_online ... WHERE 1=1" cho mỗi heartbeat.
+import threading
+from datetime import datetime, timezone
+
+from psycopg2.extras import execute_values
+from config.db import get_db_connection
+from config.metrics import timed_query
+from config.logger import get_logger
+
+log = get_logger("liveness")
+
+CHECKPOINT_INTERVAL = 2     # giây, phải nhỏ hơn OFFLINE_THRESHOLD trong offline_detector.py
+CHECKPOINT_PAGE_SIZE = 1000
+
+CHECKPOINT_QUERY = """
+    UPDATE devices AS d
+    SET last_online = v.last_online
+    FROM (VALUES %s) AS v(device_name, last_online)
+    WHERE d.device_name = v.device_name
+      AND (d.last_online IS NULL OR d.last_online < v.last_online)
+"""
+CHECKPOINT_TEMPLATE = "(%s, %s::timestamptz)"
+
+
+class LivenessTable:
+    """last_seen theo device_name + chỉ mục user -> devices học từ topic home/<user>/<device>/state."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_seen = {}        # device_name -> datetime (UTC)
+        self._dirty = set()         # device_name chưa checkpoint
+        self._user_devices = {}     # user topic -> set(device_name)
+        self._device_user = {}      # device_name -> user topic
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.heartbeats = 0
+        self.checkpoints = 0
+        self.rows_checkpointed = 0
+
+    def register(self, user, device_name):
+        """Ghi nhận device thuộc user nào (lấy từ topic state)."""
+        with self._lock:
+            devices = self._user_devices.get(user)
+            if devices is None:
+                devices = self._user_devices[user] = set()
+            devices.add(device_name)
+            self._device_user[device_name] = user
+
+    def user_of(self, device_name):
+        """Phần <user> trong topic của device (None nếu device chưa từng gửi state)."""
+        return self._device_user.get(device_name)
+
+    def devices_of(self, user):
+        with self._lock:
+            return list(self._user_devices.get(user, ()))
+
+    def touch(self, device_names, when=None):
+        when = when or datetime.now(timezone.utc)
+        with self._lock:
+            self.heartbeats += 1
+            for name in device_names:
+                self._last_seen[name] = when
+                self._dirty.add(name)
+
+    def last_seen(self, device_name):
+        with self._lock:
+            return self._last_seen.get(device_name)
+
+    def take_dirty(self):
+        """Lấy (và xoá) danh sách (device_name, last_seen) chưa checkpoint."""
+        with self._lock:
+            if not self._dirty:
+                return []
+            rows = [(name, self._last_seen[name]) for name in self._dirty]
+            self._dirty = set()
+        return rows
+
+    def mark_checkpointed(self, count):
+        with self._lock:
+            self.checkpoints += 1
+            self.rows_checkpointed += count
+
+    def checkpoint(self):
+        """Ghi các last_seen thay đổi kể từ lần trước bằng 1 câu UPDATE nhiều dòng."""
+        rows = self.take_dirty()
+        if not rows:
+            return 0
+
+        conn = get_db_connection()
+        if conn is None:
+            self.requeue(rows)
+            return 0
+        try:
+            cursor = conn.cursor()
+            timed_query("liveness_checkpoint", execute_values, cursor, CHECKPOINT_QUERY, rows,
+                        CHECKPOINT_TEMPLATE, CHECKPOINT_PAGE_SIZE)
+            conn.commit()
+        except Exception as e:
+            log.error("Heartbeat checkpoint error: %s", e)
+            conn.rollback()
+            self.requeue(rows)
+            return 0
+        finally:
+            conn.close()
+
+        self.mark_checkpointed(len(rows))
+        return len(rows)
+
+    def requeue(self, rows):
+        # Ghi lỗi thì đánh dấu dirty lại để lần checkpoint sau thử tiếp
+        with self._lock:
+            self._dirty.update(name for name, _ in rows)
+
+    def _run(self):
+        while not self._stop.wait(CHECKPOINT_INTERVAL):
+            try:
+                self.checkpoint()
+            except Exception as e:
+                log.exception("Heartbeat checkpoint loop error: %s", e)
+
+    def start(self):
+        self._stop.clear()
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="liveness-checkpoint", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(CHECKPOINT_INTERVAL + 1)
+        self.checkpoint()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "tracked_devices": len(self._last_seen),
+                "dirty": len(self._dirty),
+                "heartbeats": self.heartbeats,
+                "checkpoints": self.checkpoints,
+                "rows_checkpointed": self.rows_checkpointed,
+            }
+
+
+liveness = LivenessTable()
@@ -0,0 +1,223 @@
+# controller/log_partitions.py
+# Bảo trì partition của bảng logs (database/migrations/002_partition_logs.sql):
+# - tạo trước partition cho PARTITION_AHEAD khoảng thời gian tới (theo ngày hoặc tháng, giờ UTC)
+# - retention: partition cũ hơn RETENTION_DAYS bị DROP (hoặc DETACH để lưu trữ) nguyên bảng,
+#   không DELETE từng dòng nên không sinh dead tuple và không cần VACUUM bảng lớn.
+# - dòng ghi trước khi partition của khoảng đó tồn tại rơi vào logs_default: lúc tạo partition, các dòng này
+#   được chuyển sang trong cùng transaction (không thì CREATE ... PARTITION OF lỗi mãi và retention bỏ sót).
+# Mọi worker tạo partition còn thiếu lúc khởi động, trước khi event_log / MQTT ghi; retention và
+# bảo trì định kỳ (mỗi MAINTENANCE_INTERVAL giây) chỉ worker leader chạy.
+import os
+import re
+import threading
+from datetime import date, datetime, timedelta, timezone
+
+from config.db import get_db_connection
+from config.logger import get_logger
+
+log = get_logger("events")
+
+PARTITION_INTERVAL = os.environ.get("SMART_LIGHT_LOG_PARTITION", "day")         # day | month
+PARTITION_AHEAD = 7             # số partition tạo trước (tính cả hiện tại)
+RETENTION_DAYS = int(os.environ.get("SMART_LIGHT_LOG_RETENTION_DAYS", "90"))
+RETENTION_ACTION = os.environ.get("SMART_LIGHT_LOG_RETENTION", "drop")          # drop | detach
+MAINTENANCE_INTERVAL = 3600     # giây
+
+PARTITIONS_QUERY = """
+    SELECT c.relname
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'public.logs'::regclass
+"""
+
+DEFAULT_PARTITION = "logs_default"
+# Các ngày (UTC) còn dòng nằm trong logs_default (bình thường rỗng)
+DEFAULT_DAYS_QUERY = f"SELECT DISTINCT (created_at AT TIME ZONE 'UTC')::date FROM public.{DEFAULT_PARTITION}"
+
+# logs_pYYYYMMDD (ngày) hoặc logs_pYYYYMM (tháng); logs_default không khớp nên không bao giờ bị xoá
+_PARTITION_NAME = re.compile(r"^logs_p(\d{4})(\d{2})(\d{2})?$")
+
+
+def period_start(day, interval):
+    return day if interval == "day" else day.replace(day=1)
+
+
+def next_period(start, interval):
+    if interval == "day":
+        return start + timedelta(days=1)
+    return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+def partition_name(start, interval):
+    return f"logs_p{start:%Y%m%d}" if interval == "day" else f"logs_p{start:%Y%m}"
+
+
+def partition_range(name):
+    """(ngày bắt đầu, ngày kết thúc) theo tên partition, None nếu không theo quy ước."""
+    match = _PARTITION_NAME.match(name)
+    if match is None:
+        return None
+    year, month, day = match.groups()
+    if day is None:
+        start = date(int(year), int(month), 1)
+        return start, next_period(start, "month")
+    start = date(int(year), int(month), int(day))
+    return start, next_period(start, "day")
+
+
+def create_statements(start, interval, move_default=False):
+    """
+    Câu lệnh tạo partition cho [start, next_period), chạy trong 1 transaction.
+    move_default: có logs_default thì khoảng này có thể đã có dòng trong đó, CREATE ... PARTITION OF sẽ lỗi
+    "default partition would be violated"; tạo bảng rời, chuyển các dòng đó sang rồi mới ATTACH.
+    """
+    name = partition_name(start, interval)
+    bounds = f"FROM ('{start} 00:00:00+00') TO ('{next_period(start, interval)} 00:00:00+00')"
+    if not move_default:
+        return (f"CREATE TABLE IF NOT EXISTS public.{name} PARTITION OF public.logs FOR VALUES {bounds}",)
+    return (
+        f"CREATE TABLE public.{name} (LIKE public.logs INCLUDING DEFAULTS INCLUDING CONSTRAINTS)",
+        f"WITH moved AS (DELETE FROM public.{DEFAULT_PARTITION} "
+        f"WHERE created_at >= '{start} 00:00:00+00' AND created_at < '{next_period(start, interval)} 00:00:00+00' "
+        f"RETURNING *) INSERT INTO public.{name} SELECT * FROM moved",
+        f"ALTER TABLE public.logs ATTACH PARTITION public.{name} FOR VALUES {bounds}",
+    )
+
+
+def retention_statements(name, action):
+    if action == "detach":
+        # Bảng tách ra vẫn còn nguyên để pg_dump / chuyển sang kho lưu trữ rồi tự xoá
+        return (f"ALTER TABLE public.logs DETACH PARTITION public.{name}",)
+    return (f"DROP TABLE public.{name}",)
+
+
+class LogPartitionManager:
+
+    def __init__(self, interval=PARTITION_INTERVAL, ahead=PARTITION_AHEAD,
+                 retention_days=RETENTION_DAYS, action=RETENTION_ACTION):
+        if interval not in ("day", "month"):
+            raise ValueError("interval phải là day hoặc month")
+        if action not in ("drop", "detach"):
+            raise ValueError("action phải là drop hoặc detach")
+        self.interval = interval
+        self.ahead = ahead
+        self.retention_days = retention_days
+        self.action = action
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.partitions = 0
+        self.created = 0
+        self.removed = 0
+        self.errors = 0
+        self.last_run = None
+
+    def plan(self, existing, today=None, default_days=(), retention=True):
+        """
+        existing: tên các partition hiện có; default_days: các ngày còn dòng trong logs_default.
+        Trả về [(kind, name, statements)] với kind là "create" hoặc self.action; statements của mỗi mục
+        chạy trong 1 transaction. retention=False: chỉ tạo partition (lúc khởi động, mọi worker).
+        """
+        today = today or datetime.now(timezone.utc).date()
+        ranges = [r for r in map(partition_range, existing) if r is not None]
+        move_default = DEFAULT_PARTITION in existing
+        self.partitions = len(existing)
+
+        starts = set()
+        start = period_start(today, self.interval)
+        for _ in range(self.ahead):
+            starts.add(start)
+            start = next_period(start, self.interval)
+        # Khoảng đã có dòng rơi vào logs_default (kể cả ngày đã qua) cũng cần partition để retention xử lý
+        starts.update(period_start(day, self.interval) for day in default_days)
+
+        statements = []
+        for start in sorted(starts):
+            end = next_period(start, self.interval)
+            # Bỏ qua khoảng đã có partition (kể cả khi đổi day <-> month giữa chừng)
+            if not any(s < end and start < e for s, e in ranges):
+                statements.append(("create", partition_name(start, self.interval),
+                                   create_statements(start, self.interval, move_default)))
+        if not retention:
+            return statements
+
+        cutoff = today - timedelta(days=self.retention_days)
+        for name in sorted(existing):
+            r = partition_range(name)
+            if r is not None and r[1] <= cutoff:
+                statements.append((self.action, name, retention_statements(name, self.action)))
+        return statements
+
+    def record(self, kind, name, error=None):
+        if error is not None:
+            self.errors += 1
+            log.error("Log partition %s %s: %s", kind, name, error)
+            return
+        if kind == "create":
+            self.created += 1
+        else:
+            self.removed += 1
+            log.info("Log partition %s: %s", name, kind)
+
+    def maintain(self, retention=True):
+        """Tạo partition còn thiếu và xoá/tách partition hết hạn; mỗi partition 1 transaction."""
+        conn = get_db_connection()
+        if conn is None:
+            return
+        try:
+            cursor = conn.cursor()
+            cursor.execute(PARTITIONS_QUERY)
+            existing = [row[0] for row in cursor.fetchall()]
+            default_days = []
+            if DEFAULT_PARTITION in existing:
+                cursor.execute(DEFAULT_DAYS_QUERY)
+                default_days = [row[0] for row in cursor.fetchall()]
+            conn.commit()
+            for kind, name, statements in self.plan(existing, default_days=default_days, retention=retention):
+                try:
+                    for sql in statements:
+                        cursor.execute(sql)
+                    conn.commit()
+                    self.record(kind, name)
+                except Exception as e:
+                    conn.rollback()
+                    self.record(kind, name, e)
+            self.last_run = datetime.now(timezone.utc).isoformat()
+        except Exception as e:
+            conn.rollback()
+            self.errors += 1
+            log.error("Log partition maintenance error: %s", e)
+        finally:
+            conn.close()
+
+    def _run(self):
+        while True:
+            self.maintain()
+            if self._stop.wait(MAINTENANCE_INTERVAL):
+                return
+
+    def start(self):
+        self._stop.clear()
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="log-partitions", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        return {
+            "interval": self.interval,
+            "ahead": self.ahead,
+            "retention_days": self.retention_days,
+            "retention_action": self.action,
+            "partitions": self.partitions,
+            "created": self.created,
+            "removed": self.removed,
+            "errors": self.errors,
+            "last_run": self.last_run,
+        }
+
+
+log_partitions = LogPartitionManager()
@@ -0,0 +1,167 @@
+# controller/mqtt_decoder.py
+# Tầng decode cho message MQTT đi vào, dùng chung cho on_message (paho) và handler async (aiomqtt):
+# - Topic khớp 1 regex biên dịch sẵn: home/<user>/<device>/state | home/<user>/heartbeat, lấy luôn user/device.
+# - Payload parse đúng 1 lần (orjson nếu có, nhận thẳng bytes; không thì json của thư viện chuẩn).
+# - Kiểm tra theo schema khai báo cho state / heartbeat rồi dựng record (namedtuple) có kiểu cố định;
+#   phần sau chỉ đọc thuộc tính, không dict.get rải rác.
+# - Message sai topic / JSON / schema vào dead letter: đếm theo lý do ở smart_light_mqtt_dead_letters_total,
+#   giữ DEAD_LETTER_KEEP mẫu gần nhất cho /api/mqtt/stats, log tối đa 1 dòng / lý do / SAMPLE_INTERVAL.
+import re
+import json
+import threading
+from collections import deque, namedtuple
+
+from config.logger import get_logger, Throttle
+from config.metrics import Counter
+
+try:
+    import orjson
+except ImportError:      # orjson là tuỳ chọn
+    orjson = None
+
+
+def _json_loads(payload):
+    # json.loads(bytes) còn dò encoding, decode trước rồi parse str nhanh hơn
+    if isinstance(payload, (bytes, bytearray)):
+        payload = payload.decode()
+    return json.loads(payload)
+
+
+if orjson is not None:
+    loads = orjson.loads
+    DECODE_ERRORS = (orjson.JSONDecodeError,)
+else:
+    loads = _json_loads
+    DECODE_ERRORS = (ValueError, UnicodeDecodeError)
+
+DEAD_LETTER_KEEP = 100
+DEAD_LETTER_PAYLOAD_MAX = 200       # byte payload giữ lại trong mẫu dead letter
+
+# group 1: user, group 2: device (None với heartbeat)
+TOPIC_PATTERN = re.compile(r"home/([^/]+)/(?:heartbeat|([^/]+)/state)")
+
+StateMessage = namedtuple("StateMessage", "user device device_id state mode brightness timestamp cmd_id")
+HeartbeatMessage = namedtuple("HeartbeatMessage", "user devices device_id timestamp")
+
+DEAD_LETTERS = Counter("smart_light_mqtt_dead_letters_total",
+                       "Incoming MQTT messages rejected by the decoder", ("reason",))
+
+log = get_logger("mqtt")
+
+
+class SchemaError(ValueError):
+    pass
+
+
+def _string_list(value):
+    return all(isinstance(item, str) for item in value)
+
+
+class Schema:
+    """
+    Khai báo trường của 1 loại message: (tên, kiểu chấp nhận, bắt buộc, kiểm tra thêm).
+    bool không được nhận vào trường số (isinstance(True, int) là True). Trường thiếu / null -> None,
+    trường lạ bỏ qua. Các trường đầu của record không có trong payload (user, device lấy từ topic)
+    là tham số prefix của build().
+    """
+
+    def __init__(self, record, fields):
+        self.record = record
+        self.fields = tuple(fields)
+
+    def build(self, data, *prefix):
+        if not isinstance(data, dict):
+            raise SchemaError("payload is not an object")
+        values = list(prefix)
+        for name, types, required, check in self.fields:
+            value = data.get(name)
+            if value is None:
+                if required:
+                    raise SchemaError(f"missing {name}")
+            elif (not isinstance(value, types) or isinstance(value, bool)
+                  or (check is not None and not check(value))):
+                raise SchemaError(f"invalid {name}")
+            values.append(value)
+        return self.record._make(values)
+
+
+NUMBER = (int, float)
+
+STATE_SCHEMA = Schema(StateMessage, (
+    ("device_id", (str,), True, None),
+    ("state", (str,), True, ("on", "off").__contains__),
+    ("mode", (str,), False, None),
+    ("brightness", (int,), False, range(101).__contains__),
+    ("timestamp", NUMBER, False, None),
+    ("cmd_id", (str,), False, None),
+))
+
+HEARTBEAT_SCHEMA = Schema(HeartbeatMessage, (
+    ("devices", (list,), False, _string_list),
+    ("device_id", (str,), False, None),
+    ("timestamp", NUMBER, False, None),
+))
+
+
+class DeadLetters:
+
+    def __init__(self, keep=DEAD_LETTER_KEEP):
+        self._lock = threading.Lock()
+        self._recent = deque(maxlen=keep)
+        self._throttle = Throttle()
+
+    def add(self, reason, topic, payload, error):
+        DEAD_LETTERS.inc(reason)
+        sample = payload[:DEAD_LETTER_PAYLOAD_MAX]
+        if isinstance(sample, (bytes, bytearray)):
+            sample = bytes(sample).decode("utf-8", "replace")
+        with self._lock:
+            self._recent.append({"reason": reason, "topic": topic, "error": error, "payload": sample})
+        suppressed = self._throttle.allow(reason)
+        if suppressed is not None:
+            log.warning("Dropped MQTT message: %s", error,
+                        extra={"topic": topic, "reason": reason, "suppressed": suppressed})
+
+    def stats(self):
+        with self._lock:
+            recent = list(self._recent)
+        return {
+            "decoder": "orjson" if orjson is not None else "json",
+            "dead_letters": {reason: DEAD_LETTERS.value(reason) for reason in ("topic", "json", "schema")},
+            "recent_dead_letters": recent,
+        }
+
+
+dead_letters = DeadLetters()
+
+
+def decode(topic, payload):
+    """bytes/str từ broker -> StateMessage | HeartbeatMessage, hoặc None (đã vào dead letter)."""
+    match = TOPIC_PATTERN.fullmatch(topic)
+    if match is None:
+        dead_letters.add("topic", topic, payload, "unexpected topic")
+        return None
+    try:
+        data = loads(payload)
+    except DECODE_ERRORS as e:
+        dead_letters.add("json", topic, payload, f"invalid JSON: {e}")
+        return None
+    user, device = match.groups()
+    try:
+        if device is None:
+            return HEARTBEAT_SCHEMA.build(data, user)
+        message = STATE_SCHEMA.build(data, user, device)
+    except SchemaError as e:
+        dead_letters.add("schema", topic, payload, str(e))
+        return None
+    if message.device_id != device:
+        # Firmware publish state lên đúng topic của device; lệch nhau = message giả / cấu hình sai
+        dead_letters.add("schema", topic, payload, "device_id does not match topic")
+        return None
+    return message
+
+
+def state_event(message):
+    """Payload cho Socket.IO device_state_update (các trường firmware gửi, như trước đây)."""
+    return {"device_id": message.device_id, "state": message.state, "brightness": message.brightness,
+            "mode": message.mode, "timestamp": message.timestamp}
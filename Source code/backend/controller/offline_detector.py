@@ -0,0 +1,201 @@
+# controller/offline_detector.py
+# Phát hiện thiết bị offline theo deadline thay vì quét toàn bảng devices mỗi 5 giây.
+# Mỗi device có đúng 1 entry trong min-heap; heartbeat chỉ dời deadline trong dict (O(1)),
+# khi entry tới hạn mới so lại với deadline thật và đẩy lại nếu device vẫn còn sống.
+import time
+import heapq
+import threading
+from datetime import datetime, timezone
+
+from config.db import get_db_connection
+from config.metrics import timed_query, OFFLINE_TRANSITIONS
+from config.logger import get_logger
+from config.web_socket import socketio
+from controller.device_cache import device_cache
+from controller.rooms import state_rooms
+from controller.push import delta_pusher
+from controller.event_log import event_log, OFFLINE
+from controller.usage import usage
+
+log = get_logger("liveness")
+
+OFFLINE_THRESHOLD = 15      # giây không có heartbeat/state thì coi là offline (~3 heartbeat của ESP32)
+EMIT_COALESCE_WINDOW = 0.1  # giây, gom các device hết hạn gần nhau vào cùng 1 batch
+
+SEED_QUERY = "SELECT device_name, last_online FROM devices WHERE last_online IS NOT NULL AND is_on"
+
+
+class OfflineDetector:
+
+    def __init__(self, threshold=OFFLINE_THRESHOLD, on_offline=None):
+        self.threshold = threshold
+        self._cond = threading.Condition()
+        self._heap = []             # (deadline, device_name), mỗi device tối đa 1 entry
+        self._deadline = {}         # device_name -> deadline (time.monotonic)
+        self._offline = set()
+        self._on_offline = on_offline or mark_offline
+        self._thread = None
+        self._running = False
+
+        self.transitions = 0
+        self.batches = 0
+
+    def alive(self, device_names, seen_at=None):
+        """Gọi khi có heartbeat/state: dời deadline của các device."""
+        now = time.monotonic() if seen_at is None else seen_at
+        deadline = now + self.threshold
+        with self._cond:
+            wake = False
+            back = 0
+            for name in device_names:
+                if name in self._offline:
+                    self._offline.discard(name)
+                    back += 1
+                if name not in self._deadline:
+                    heapq.heappush(self._heap, (deadline, name))
+                    wake = True
+                self._deadline[name] = deadline
+            if wake:
+                self._cond.notify()
+        if back:
+            OFFLINE_TRANSITIONS.inc("online", amount=back)
+
+    def is_offline(self, device_name):
+        with self._cond:
+            return device_name in self._offline
+
+    def seed_from_db(self):
+        """Nạp last_online lúc khởi động để device đã im lặng từ trước vẫn bị đánh dấu offline."""
+        conn = get_db_connection()
+        if conn is None:
+            return
+        try:
+            cursor = conn.cursor()
+            cursor.execute(SEED_QUERY)
+            rows = cursor.fetchall()
+        finally:
+            conn.close()
+        self.seed_rows(rows)
+
+    def seed_rows(self, rows):
+        """rows: (device_name, last_online có timezone)."""
+        now_wall = datetime.now(timezone.utc)
+        now_mono = time.monotonic()
+        for device_name, last_online in rows:
+            if device_name in self._deadline:
+                # Đã có heartbeat mới hơn trong bộ nhớ (vd: worker vừa được bầu làm leader)
+                continue
+            age = (now_wall - last_online).total_seconds()
+            self.alive((device_name,), seen_at=now_mono - age)
+
+    def _pop_expired(self, now):
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            _, name = heapq.heappop(self._heap)
+            real = self._deadline.get(name)
+            if real is None:
+                continue
+            if real > now:
+                # Có heartbeat mới sau khi entry được đẩy vào: đẩy lại với deadline thật
+                heapq.heappush(self._heap, (real, name))
+                continue
+            del self._deadline[name]
+            if name not in self._offline:
+                self._offline.add(name)
+                expired.append(name)
+        if expired:
+            OFFLINE_TRANSITIONS.inc("offline", amount=len(expired))
+        return expired
+
+    def next_deadline(self):
+        with self._cond:
+            return self._heap[0][0] if self._heap else None
+
+    def pop_expired(self, now=None):
+        with self._cond:
+            return self._pop_expired(time.monotonic() if now is None else now)
+
+    def _run(self):
+        while self._running:
+            with self._cond:
+                while self._running:
+                    if self._heap:
+                        wait = self._heap[0][0] - time.monotonic()
+                        if wait <= 0:
+                            break
+                        self._cond.wait(wait)
+                    else:
+                        self._cond.wait()
+                if not self._running:
+                    return
+
+            # Chờ thêm một chút để gom các device hết hạn gần nhau
+            time.sleep(EMIT_COALESCE_WINDOW)
+            with self._cond:
+                expired = self._pop_expired(time.monotonic())
+
+            if expired:
+                try:
+                    self._on_offline(expired)
+                except Exception as e:
+                    log.exception("Error in offline detector: %s", e)
+                self.transitions += len(expired)
+                self.batches += 1
+
+    def start(self):
+        with self._cond:
+            # Đặt trước khi kiểm tra thread: stop() rồi start() ngay thì thread cũ chạy tiếp
+            self._running = True
+            self._cond.notify_all()
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="offline-detector", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "tracked_devices": len(self._deadline),
+                "offline_devices": len(self._offline),
+                "heap_size": len(self._heap),
+                "transitions": self.transitions,
+                "batches": self.batches,
+                "threshold_seconds": self.threshold,
+            }
+
+
+def mark_offline(device_names):
+    """Đánh dấu is_on=FALSE cho cả batch bằng 1 câu UPDATE rồi emit cho frontend."""
+    device_cache.mark_offline(device_names)
+    conn = get_db_connection()
+    if conn is not None:
+        try:
+            cursor = conn.cursor()
+            timed_query("mark_offline", cursor.execute,
+                        "UPDATE devices SET is_on=FALSE WHERE device_name = ANY(%s)",
+                        (list(device_names),))
+            conn.commit()
+        except Exception as e:
+            log.error("Error marking devices offline: %s", e)
+            conn.rollback()
+        finally:
+            conn.close()
+
+    log.warning("%d device(s) offline: %s", len(device_names), ", ".join(device_names[:10]))
+    for name in device_names:
+        delta_pusher.record(name, is_on=False, offline=True)
+        event_log.record(name, OFFLINE, "online", "offline", "offline_detector")
+        usage.observe(name, False, None, datetime.now(timezone.utc))
+        socketio.emit("device_state_update", {
+            "device_id": name,
+            "state": "offline",
+            "brightness": None
+        }, to=state_rooms(name))
+
+
+offline_detector = OfflineDetector()
@@ -0,0 +1,181 @@
+# controller/passwords.py
+# Băm / kiểm tra mật khẩu bằng scrypt (hashlib, không cần thư viện ngoài).
+# Chuỗi lưu trong users.password:  scrypt$<n>$<r>$<p>$<salt base64>$<hash base64>  (~82 ký tự)
+# - Tham số cost đọc từ biến môi trường, đổi cost thì user cũ được băm lại ở lần đăng nhập kế tiếp.
+# - Dòng cũ lưu mật khẩu text thường (không có tiền tố scrypt$) vẫn đăng nhập được và được băm lại ngay.
+# - Băm chạy trong pool thread giới hạn (hashlib nhả GIL khi tính scrypt): thread request / event loop
+#   chỉ chờ kết quả, hàng đợi đầy thì từ chối ngay thay vì dồn hàng trăm lần băm ~70ms vào CPU.
+import os
+import hmac
+import time
+import base64
+import asyncio
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+SCRYPT_N = int(os.environ.get("SMART_LIGHT_SCRYPT_N", str(2 ** 14)))    # lũy thừa của 2; RAM = 128*n*r byte
+SCRYPT_R = int(os.environ.get("SMART_LIGHT_SCRYPT_R", "8"))
+SCRYPT_P = int(os.environ.get("SMART_LIGHT_SCRYPT_P", "1"))
+SALT_BYTES = 16
+HASH_BYTES = 32
+
+HASH_WORKERS = int(os.environ.get("SMART_LIGHT_HASH_WORKERS", str(os.cpu_count() or 2)))
+HASH_MAX_PENDING = HASH_WORKERS * 8     # đang chạy + đang chờ; vượt quá thì PasswordPoolBusy
+HASH_TIMEOUT = 10.0                     # giây chờ kết quả ở runtime threaded
+
+PREFIX = "scrypt$"
+BUSY_MESSAGE = "Máy chủ đang bận, vui lòng thử lại sau"
+
+
+class PasswordPoolBusy(Exception):
+    """Pool băm mật khẩu đã đầy (quá HASH_MAX_PENDING yêu cầu) hoặc chờ kết quả quá HASH_TIMEOUT."""
+
+
+def _b64(data):
+    return base64.b64encode(data).decode("ascii").rstrip("=")
+
+
+def _unb64(text):
+    return base64.b64decode(text + "=" * (-len(text) % 4))
+
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode("utf-8"), salt=salt, n=n, r=r, p=p,
+                          maxmem=256 * n * r * p + 1024 * 1024, dklen=HASH_BYTES)
+
+
+def hash_password(password, n=None, r=None, p=None):
+    n, r, p = n or SCRYPT_N, r or SCRYPT_R, p or SCRYPT_P
+    salt = os.urandom(SALT_BYTES)
+    return f"{PREFIX}{n}${r}${p}${_b64(salt)}${_b64(_scrypt(password, salt, n, r, p))}"
+
+
+def verify_password(password, stored, n=None, r=None, p=None):
+    """
+    So mật khẩu với chuỗi trong DB (so sánh thời gian hằng bằng hmac.compare_digest).
+    Trả về (đúng/sai, cần băm lại): cần băm lại khi dòng còn là text thường hoặc cost khác cấu hình hiện tại.
+    """
+    current = (n or SCRYPT_N, r or SCRYPT_R, p or SCRYPT_P)
+    if not stored.startswith(PREFIX):
+        # Dòng cũ chưa băm
+        return hmac.compare_digest(password.encode("utf-8"), stored.encode("utf-8")), True
+    try:
+        _, n_, r_, p_, salt, digest = stored.split("$")
+        params = (int(n_), int(r_), int(p_))
+        salt, digest = _unb64(salt), _unb64(digest)
+    except ValueError:
+        return False, False
+    ok = hmac.compare_digest(_scrypt(password, salt, *params), digest)
+    return ok, ok and params != current
+
+
+class PasswordPool:
+
+    def __init__(self, workers=HASH_WORKERS, max_pending=HASH_MAX_PENDING, timeout=HASH_TIMEOUT,
+                 n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+        self.cost = (n, r, p)
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._dummy = None          # hash giả cho username không tồn tại
+
+        self.hashes = 0
+        self.verifies = 0
+        self.rehashes = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.max_pending_seen = 0
+        self._hash_ms = 0.0
+
+    def _submit(self, fn, *args):
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.rejected += 1
+                raise PasswordPoolBusy(BUSY_MESSAGE)
+            self._pending += 1
+            if self._pending > self.max_pending_seen:
+                self.max_pending_seen = self._pending
+        return self._executor.submit(self._timed, fn, *args)
+
+    def _timed(self, fn, *args):
+        start = time.monotonic()
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self._pending -= 1
+                self._hash_ms += (time.monotonic() - start) * 1000
+                if fn == self._hash:
+                    self.hashes += 1
+                else:
+                    self.verifies += 1
+
+    def _hash(self, password):
+        return hash_password(password, *self.cost)
+
+    def _check(self, password, stored):
+        """
+        Chạy trong worker. stored=None (username không tồn tại) vẫn tốn 1 lần scrypt với hash giả,
+        để thời gian phản hồi không cho biết username có trong DB hay không.
+        """
+        if stored is not None:
+            return verify_password(password, stored, *self.cost)
+        if self._dummy is None:
+            self._dummy = self._hash(_b64(os.urandom(SALT_BYTES)))
+        verify_password(password, self._dummy, *self.cost)
+        return False, False
+
+    def mark_rehashed(self):
+        with self._lock:
+            self.rehashes += 1
+
+    # ---------- runtime threaded (chặn thread request, không chặn CPU của thread khác) ----------
+    def _wait(self, future):
+        # Hết timeout vẫn là "bận": route trả 503 thay vì lỗi 500 với TimeoutError
+        try:
+            return future.result(self.timeout)
+        except FutureTimeout:
+            with self._lock:
+                self.timeouts += 1
+            raise PasswordPoolBusy(BUSY_MESSAGE) from None
+
+    def hash(self, password):
+        return self._wait(self._submit(self._hash, password))
+
+    def verify(self, password, stored):
+        """stored: users.password, None nếu không có user. Trả về (đúng/sai, cần băm lại)."""
+        return self._wait(self._submit(self._check, password, stored))
+
+    # ---------- runtime async (event loop tiếp tục phục vụ request/Socket.IO khác) ----------
+    async def hash_async(self, password):
+        return await asyncio.wrap_future(self._submit(self._hash, password))
+
+    async def verify_async(self, password, stored):
+        return await asyncio.wrap_future(self._submit(self._check, password, stored))
+
+    def stats(self):
+        with self._lock:
+            done = self.hashes + self.verifies
+            return {
+                "algorithm": "scrypt",
+                "n": self.cost[0],
+                "r": self.cost[1],
+                "p": self.cost[2],
+                "workers": self.workers,
+                "max_pending": self.max_pending,
+                "pending": self._pending,
+                "max_pending_seen": self.max_pending_seen,
+                "hashes": self.hashes,
+                "verifies": self.verifies,
+                "rehashes": self.rehashes,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+                "avg_ms": (self._hash_ms / done) if done else 0.0,
+            }
+
+
+password_pool = PasswordPool()
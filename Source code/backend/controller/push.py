@@ -0,0 +1,254 @@
+# controller/push.py
+# Push cho dashboard: gom thay đổi trong PUSH_TICK, mỗi device chỉ gửi các trường đã đổi,
+# cả tick gửi thành 1 frame "devices_delta" cho mỗi phòng dashboard (JSON hoặc MessagePack).
+# Mỗi frame có seq tăng dần theo phòng; client thấy hụt seq thì emit "dashboard_resync"
+# để nhận "devices_snapshot" dựng từ device_cache. Client có hàng đợi engine.io quá
+# MAX_CLIENT_BACKLOG packet bị bỏ qua các frame delta và nhận snapshot khi đã xả kịp.
+import time
+import threading
+
+from flask import request, session
+from flask_socketio import join_room, leave_room
+
+from config.web_socket import socketio
+from config.cluster import WORKER_ID
+from config.logger import get_logger
+from controller.auth import get_user_by_id
+from controller.device_cache import device_cache
+from controller.device_topics import device_topics
+from controller.rooms import user_room
+
+log = get_logger("push")
+
+try:
+    import msgpack
+except ImportError:      # MessagePack là tuỳ chọn
+    msgpack = None
+
+PUSH_TICK = 0.1                 # giây
+MAX_CLIENT_BACKLOG = 20         # packet chờ gửi tối đa trong hàng đợi engine.io của 1 client
+PUSH_FORMATS = ("json", "msgpack")
+ALL_DEVICES = "all"             # phòng dashboard của admin: mọi device
+
+
+def dashboard_room(scope, fmt):
+    """scope: users.user_id hoặc ALL_DEVICES."""
+    return f"dash:{scope}:{fmt}"
+
+
+def available_formats():
+    return PUSH_FORMATS if msgpack is not None else ("json",)
+
+
+class DeltaPusher:
+
+    def __init__(self, tick=PUSH_TICK, max_backlog=MAX_CLIENT_BACKLOG):
+        self.tick = tick
+        self.max_backlog = max_backlog
+        self._lock = threading.Lock()
+        self._dirty = {}            # device_name -> các trường mới nhất trong tick hiện tại
+        self._pushed = {}           # device_name -> các trường đã gửi (để tính delta)
+        self._seq = {}              # phòng -> seq của frame cuối
+        self._subscribers = {}      # sid -> (scope, fmt)
+        self._needs_snapshot = set()
+        self._thread = None
+
+        self.records = 0
+        self.frames = 0
+        self.fields_sent = 0
+        self.unchanged = 0          # cập nhật không đổi trường nào (không gửi)
+        self.snapshots = 0
+        self.lagging_skips = 0
+
+    # ---------- ghi nhận thay đổi (luồng ingest) ----------
+    def record(self, device_name, **fields):
+        """Chỉ cập nhật dict trong tick hiện tại, không emit."""
+        with self._lock:
+            current = self._dirty.get(device_name)
+            if current is None:
+                self._dirty[device_name] = fields
+            else:
+                current.update(fields)
+            self.records += 1
+
+    # ---------- client ----------
+    def subscribe(self, sid, scope, fmt):
+        with self._lock:
+            self._subscribers[sid] = (scope, fmt)
+            self._needs_snapshot.add(sid)
+
+    def resync(self, sid):
+        with self._lock:
+            if sid in self._subscribers:
+                self._needs_snapshot.add(sid)
+
+    def unsubscribe(self, sid):
+        with self._lock:
+            self._subscribers.pop(sid, None)
+            self._needs_snapshot.discard(sid)
+
+    # ---------- dựng frame ----------
+    def _collect(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+
+        by_scope = {}
+        for name, fields in dirty.items():
+            last = self._pushed.setdefault(name, {})
+            delta = {k: v for k, v in fields.items() if k not in last or last[k] != v}
+            if not delta:
+                self.unchanged += 1
+                continue
+            last.update(delta)
+            self.fields_sent += len(delta)
+            by_scope.setdefault(ALL_DEVICES, {})[name] = delta
+            owner = device_topics.owner_of(name)
+            if owner is not None:
+                by_scope.setdefault(owner, {})[name] = delta
+        return by_scope
+
+    def _next_seq(self, room):
+        seq = self._seq.get(room, 0) + 1
+        self._seq[room] = seq
+        return seq
+
+    def _snapshot(self, scope):
+        devices = {}
+        for device in device_cache.snapshot().devices:
+            name = device["device_name"]
+            if scope != ALL_DEVICES and device_topics.owner_of(name) != scope:
+                continue
+            devices[name] = dict(device, offline=self._pushed.get(name, {}).get("offline", False))
+        return devices
+
+    @staticmethod
+    def _encode(payload, fmt):
+        if fmt == "msgpack":
+            return msgpack.packb(payload, use_bin_type=True)
+        return payload
+
+    @staticmethod
+    def _backlog(server, sid):
+        # Số packet engine.io đang chờ gửi cho client (chỉ thấy được client nối vào worker này)
+        eio_sid = server.manager.eio_sid_from_sid(sid, "/")
+        sock = server.eio.sockets.get(eio_sid) if eio_sid else None
+        return sock.queue.qsize() if sock is not None else 0
+
+    def prepare(self, server):
+        """
+        Dựng danh sách emit của 1 tick: [(event, data, to, skip_sid)].
+        Không gửi gì ở đây để runtime threaded và async dùng chung.
+        """
+        by_scope = self._collect()
+        with self._lock:
+            subscribers = dict(self._subscribers)
+            needs_snapshot = set(self._needs_snapshot)
+
+        # Client tụt lại: ngừng gửi delta, đánh dấu chờ snapshot
+        lagging = set()
+        for sid in subscribers:
+            if self._backlog(server, sid) > self.max_backlog:
+                lagging.add(sid)
+        if lagging:
+            with self._lock:
+                self._needs_snapshot.update(lagging & set(self._subscribers))
+        skip = lagging | needs_snapshot
+
+        emits = []
+        now = int(time.time() * 1000)
+        rooms = {}
+        for sid, (scope, fmt) in subscribers.items():
+            rooms.setdefault((scope, fmt), []).append(sid)
+
+        for (scope, fmt), sids in rooms.items():
+            room = dashboard_room(scope, fmt)
+            changes = by_scope.get(scope)
+            if changes:
+                skipped = [sid for sid in sids if sid in skip]
+                self.lagging_skips += len(skipped)
+                payload = {"src": WORKER_ID, "seq": self._next_seq(room), "t": now, "changes": changes}
+                emits.append(("devices_delta", self._encode(payload, fmt), room, skipped or None))
+                self.frames += 1
+
+            # Snapshot cho client mới / xin resync / đã xả kịp hàng đợi
+            ready = [sid for sid in sids if sid in needs_snapshot and sid not in lagging]
+            if ready:
+                payload = {"src": WORKER_ID, "seq": self._seq.get(room, 0), "t": now,
+                           "devices": self._snapshot(scope)}
+                data = self._encode(payload, fmt)
+                for sid in ready:
+                    emits.append(("devices_snapshot", data, sid, None))
+                self.snapshots += len(ready)
+                with self._lock:
+                    self._needs_snapshot.difference_update(ready)
+        return emits
+
+    # ---------- runtime threaded ----------
+    def _run(self):
+        server = socketio.server
+        while True:
+            socketio.sleep(self.tick)
+            try:
+                for event, data, to, skip_sid in self.prepare(server):
+                    server.emit(event, data, to=to, skip_sid=skip_sid)
+            except Exception as e:
+                log.exception("Dashboard push error: %s", e)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = socketio.start_background_task(self._run)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "tick_ms": self.tick * 1000,
+                "formats": list(available_formats()),
+                "subscribers": len(self._subscribers),
+                "pending_devices": len(self._dirty),
+                "records": self.records,
+                "frames": self.frames,
+                "fields_sent": self.fields_sent,
+                "unchanged": self.unchanged,
+                "snapshots": self.snapshots,
+                "lagging_skips": self.lagging_skips,
+            }
+
+
+delta_pusher = DeltaPusher()
+
+
+def dashboard_scope(user_id):
+    """Admin xem mọi device, user thường chỉ device của mình (có truy vấn DB)."""
+    user = get_user_by_id(user_id)
+    if user and user.get("role") == "admin":
+        return ALL_DEVICES
+    return user_id
+
+
+# ====================
+# SOCKET.IO HANDLERS (runtime threaded)
+# ====================
+@socketio.on("subscribe_dashboard")
+def handle_subscribe_dashboard(data):
+    user_id = session.get("user_id")
+    fmt = (data or {}).get("format", "json")
+    if user_id is None or fmt not in available_formats():
+        return {"ok": False, "formats": list(available_formats())}
+    scope = dashboard_scope(user_id)
+    join_room(dashboard_room(scope, fmt))
+    # Dashboard chỉ dựa vào luồng seq delta/snapshot: rời phòng user:<id> để không nhận thêm
+    # device_state_update cho từng thay đổi (vào lại khi kết nối lại, client subscribe lại khi connect)
+    leave_room(user_room(user_id))
+    delta_pusher.subscribe(request.sid, scope, fmt)
+    return {"ok": True, "format": fmt}
+
+
+@socketio.on("dashboard_resync")
+def handle_dashboard_resync(data=None):
+    delta_pusher.resync(request.sid)
+    return {"ok": True}
+
+
+@socketio.on("disconnect")
+def handle_disconnect(*args):
+    delta_pusher.unsubscribe(request.sid)
@@ -0,0 +1,189 @@
+# controller/repository.py
+# Lớp truy cập dữ liệu dùng chung cho các controller: devices, schedules, users, logs.
+# - Mỗi câu truy vấn là 1 prepared statement: PREPARE 1 lần trên mỗi kết nối của pool (nhớ trong
+#   PooledConnection.state), các lần sau chỉ EXECUTE nên PostgreSQL không parse/plan lại.
+# - Mỗi kết nối giữ sẵn 1 cursor, không tạo cursor mới cho từng truy vấn.
+# - Dòng trả về là namedtuple: vẫn là tuple (code cũ đọc row[0]... vẫn chạy), không cấp phát dict
+#   cho từng dòng; chỉ đổi sang dict (to_dicts) ở chỗ trả JSON.
+# Runtime async không dùng module này: asyncpg đã tự prepare và cache statement theo kết nối.
+import threading
+import time as time_module
+from collections import namedtuple
+from datetime import date, time
+
+from config.db import pool
+from config.metrics import DB_QUERY_SECONDS, DB_QUERY_ERRORS
+
+Device = namedtuple("Device", "device_id device_name is_on mode brightness")
+DeviceTopic = namedtuple("DeviceTopic", "device_id device_name user_id")
+Schedule = namedtuple("Schedule", "schedule_id device_id start_time end_time repeat brightness is_active weekday")
+User = namedtuple("User", "user_id username email role")
+Credentials = namedtuple("Credentials", "user_id username email role password")
+LogEntry = namedtuple("LogEntry", "log_id device_id event_type old_value new_value description created_at")
+
+LOGS_MAX_LIMIT = 500
+
+
+class Statement:
+    """1 câu SQL dùng placeholder $1, $2... như PREPARE của PostgreSQL, kèm kiểu record trả về."""
+    __slots__ = ("name", "record", "prepare_sql", "execute_sql")
+
+    def __init__(self, name, sql, param_types=(), record=None):
+        self.name = name
+        self.record = record
+        types = f" ({', '.join(param_types)})" if param_types else ""
+        self.prepare_sql = f"PREPARE {name}{types} AS {sql}"
+        self.execute_sql = f"EXECUTE {name}" + (f" ({', '.join(['%s'] * len(param_types))})" if param_types else "")
+
+
+_SCHEDULE_SELECT = f"SELECT {', '.join(Schedule._fields)} FROM schedules"
+_LOG_SELECT = f"SELECT {', '.join(LogEntry._fields)} FROM logs"
+
+ALL_DEVICES = Statement("repo_all_devices", f"SELECT {', '.join(Device._fields)} FROM devices",
+                        record=Device)
+ALL_DEVICE_TOPICS = Statement("repo_all_device_topics", "SELECT device_id, device_name, user_id FROM devices",
+                              record=DeviceTopic)
+DEVICE_TOPICS_BY_ID = Statement("repo_device_topics_by_id",
+                                "SELECT device_id, device_name, user_id FROM devices WHERE device_id = ANY($1)",
+                                ("int[]",), DeviceTopic)
+DEVICE_TOPIC_BY_NAME = Statement("repo_device_topic_by_name",
+                                 "SELECT device_id, device_name, user_id FROM devices WHERE device_name=$1",
+                                 ("varchar",), DeviceTopic)
+ACTIVE_SCHEDULES = Statement("repo_active_schedules", f"{_SCHEDULE_SELECT} WHERE is_active=TRUE",
+                             record=Schedule)
+ACTIVE_DEVICE_SCHEDULES = Statement("repo_active_device_schedules",
+                                    f"{_SCHEDULE_SELECT} WHERE is_active=TRUE AND device_id=$1",
+                                    ("int",), Schedule)
+DEVICE_SCHEDULE = Statement("repo_device_schedule", f"{_SCHEDULE_SELECT} WHERE device_id=$1 LIMIT 1",
+                            ("int",), Schedule)
+USER_BY_ID = Statement("repo_user_by_id", "SELECT user_id, username, email, role FROM users WHERE user_id=$1",
+                       ("int",), User)
+CREDENTIALS = Statement("repo_credentials",
+                        "SELECT user_id, username, email, role, password FROM users WHERE username=$1",
+                        ("varchar",), Credentials)
+# Dùng index (device_id, created_at) của logs, chỉ quét partition gần nhất
+RECENT_LOGS = Statement("repo_recent_logs",
+                        f"{_LOG_SELECT} WHERE device_id=$1 ORDER BY created_at DESC LIMIT $2",
+                        ("int", "int"), LogEntry)
+
+
+class _Counters:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.prepares = 0
+        self.executes = 0
+        self.cursors = 0
+
+    def add(self, prepares=0, executes=0, cursors=0):
+        with self._lock:
+            self.prepares += prepares
+            self.executes += executes
+            self.cursors += cursors
+
+    def stats(self):
+        with self._lock:
+            return {
+                "prepares": self.prepares,
+                "executes": self.executes,
+                "cursors_opened": self.cursors,
+                "statement_reuse": (1 - self.prepares / self.executes) if self.executes else 0.0,
+            }
+
+
+counters = _Counters()
+
+
+def execute(conn, statement, args=()):
+    """EXECUTE statement trên conn (PooledConnection), PREPARE trước nếu kết nối này chưa có."""
+    state = conn.state
+    cursor = state.get("cursor")
+    opened = 0
+    if cursor is None or cursor.closed:
+        cursor = state["cursor"] = conn.cursor()
+        opened = 1
+    prepared = state.setdefault("prepared", set())
+    prepares = 0
+    start = time_module.perf_counter()
+    try:
+        if statement.name not in prepared:
+            # PREPARE không bị huỷ theo transaction, sống tới khi kết nối đóng
+            cursor.execute(statement.prepare_sql)
+            prepared.add(statement.name)
+            prepares = 1
+        cursor.execute(statement.execute_sql, args)
+    except Exception:
+        DB_QUERY_ERRORS.inc(statement.name)
+        raise
+    finally:
+        DB_QUERY_SECONDS.since(start, statement.name)
+    counters.add(prepares, 1, opened)
+    return cursor
+
+
+def fetch_all(statement, *args):
+    # pool.connection() ném lỗi thật (PoolTimeout, OperationalError) thay vì trả None
+    with pool.connection() as conn:
+        rows = execute(conn, statement, args).fetchall()
+    return list(map(statement.record._make, rows))
+
+
+def fetch_one(statement, *args):
+    with pool.connection() as conn:
+        row = execute(conn, statement, args).fetchone()
+    return statement.record._make(row) if row is not None else None
+
+
+def _json_value(value):
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    return value
+
+
+def to_dicts(records):
+    """Record -> dict cho jsonify / JSONResponse (ngày giờ đổi sang chuỗi ISO)."""
+    return [{k: _json_value(v) for k, v in zip(r._fields, r)} for r in records]
+
+
+# ==================== DEVICES ====================
+def all_devices():
+    return fetch_all(ALL_DEVICES)
+
+
+def device_topics(device_ids=None):
+    if device_ids is None:
+        return fetch_all(ALL_DEVICE_TOPICS)
+    return fetch_all(DEVICE_TOPICS_BY_ID, list(device_ids))
+
+
+def device_topic_by_name(device_name):
+    return fetch_one(DEVICE_TOPIC_BY_NAME, device_name)
+
+
+# ==================== SCHEDULES ====================
+def active_schedules(device_id=None):
+    if device_id is None:
+        return fetch_all(ACTIVE_SCHEDULES)
+    return fetch_all(ACTIVE_DEVICE_SCHEDULES, device_id)
+
+
+def device_schedule(device_id):
+    return fetch_one(DEVICE_SCHEDULE, device_id)
+
+
+# ==================== USERS ====================
+def user_by_id(user_id):
+    return fetch_one(USER_BY_ID, user_id)
+
+
+def credentials(username):
+    return fetch_one(CREDENTIALS, username)
+
+
+# ==================== LOGS ====================
+def recent_logs(device_id, limit=50):
+    return fetch_all(RECENT_LOGS, device_id, max(1, min(int(limit), LOGS_MAX_LIMIT)))
+
+
+def stats():
+    return counters.stats()
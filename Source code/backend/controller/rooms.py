@@ -0,0 +1,66 @@
+# controller/rooms.py
+# Phòng Socket.IO: mỗi client vào phòng của user (theo session) và phòng của device đang xem,
+# cập nhật trạng thái chỉ emit tới 2 phòng đó thay vì tới mọi client.
+#   user:<users.user_id>       - mọi device của user (dashboard)
+#   device:<device_name>       - trang /control/<device_id>
+from flask import request, session
+from flask_socketio import join_room, leave_room
+
+from config.web_socket import socketio
+from controller.device_topics import device_topics, device_for_user
+
+
+def user_room(user_id):
+    return f"user:{user_id}"
+
+
+def device_room(device_name):
+    return f"device:{device_name}"
+
+
+def state_rooms(device_name):
+    """Các phòng nhận cập nhật của device: phòng device + phòng user sở hữu (nếu biết)."""
+    rooms = [device_room(device_name)]
+    owner = device_topics.owner_of(device_name)
+    if owner is not None:
+        rooms.append(user_room(owner))
+    return rooms
+
+
+def can_watch(user_id, device_name):
+    """Chủ device hoặc admin mới được vào phòng device (có thể truy vấn DB, không gọi trên luồng ingest)."""
+    return device_for_user(user_id, device_name) is not None
+
+
+# ====================
+# SOCKET.IO HANDLERS (runtime threaded)
+# ====================
+@socketio.on("connect")
+def handle_connect(auth=None):
+    user_id = session.get("user_id")
+    if user_id is None:
+        # Chưa đăng nhập: từ chối kết nối
+        return False
+    join_room(user_room(user_id))
+
+    device_name = request.args.get("device_id") or (auth or {}).get("device_id")
+    if device_name and can_watch(user_id, device_name):
+        join_room(device_room(device_name))
+
+
+@socketio.on("subscribe_device")
+def handle_subscribe_device(data):
+    user_id = session.get("user_id")
+    device_name = (data or {}).get("device_id")
+    if user_id is None or not device_name or not can_watch(user_id, device_name):
+        return {"ok": False}
+    join_room(device_room(device_name))
+    return {"ok": True}
+
+
+@socketio.on("unsubscribe_device")
+def handle_unsubscribe_device(data):
+    device_name = (data or {}).get("device_id")
+    if device_name:
+        leave_room(device_room(device_name))
+    return {"ok": True}
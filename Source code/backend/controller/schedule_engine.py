@@ -0,0 +1,257 @@
+# controller/schedule_engine.py
+# Lõi scheduler: giữ các mốc bật/tắt sắp tới trong priority queue và ngủ tới mốc gần nhất,
+# thay vì mỗi 3 giây SELECT toàn bộ schedules rồi so chuỗi "HH:MM".
+# Chỉ nạp lại schedule của device vừa thay đổi (save_schedule/delete_schedule gọi reload_device).
+import heapq
+import itertools
+import threading
+from datetime import datetime, timedelta, time
+
+from config.db import get_db_connection
+from config.logger import get_logger
+from config.metrics import SCHEDULER_FIRES, SCHEDULER_MISSED, SCHEDULER_LAG_SECONDS
+from controller.repository import Schedule, active_schedules
+
+MISFIRE_GRACE = 300         # giây, mốc trễ quá ngưỡng này (server treo, sleep máy...) thì bỏ qua
+MAX_SLEEP = 30              # giây, thức dậy định kỳ để bắt kịp khi đồng hồ hệ thống bị chỉnh
+
+SCHEDULE_COLUMNS = ", ".join(Schedule._fields)
+DEACTIVATE_QUERY = "UPDATE schedules SET is_active=FALSE WHERE schedule_id = ANY(%s)"
+
+log = get_logger("scheduler")
+
+
+def next_occurrence(at_time, after, repeat="daily", weekday=None):
+    """
+    Lần xảy ra kế tiếp (sau `after`) của mốc giờ `at_time`.
+    weekly: chỉ rơi vào thứ `weekday` (0 = thứ Hai).
+    """
+    candidate = datetime.combine(after.date(), at_time)
+    if repeat == "weekly" and weekday is not None:
+        candidate += timedelta(days=(weekday - after.weekday()) % 7)
+        if candidate <= after:
+            candidate += timedelta(days=7)
+    elif candidate <= after:
+        candidate += timedelta(days=1)
+    return candidate
+
+
+def anchor_weekday(start_time, now=None):
+    """Thứ neo của schedule weekly: thứ của lần bật đầu tiên tính từ lúc lưu (start_time: time hoặc "HH:MM")."""
+    if isinstance(start_time, str):
+        start_time = time.fromisoformat(start_time)
+    return next_occurrence(start_time, now or datetime.now()).weekday()
+
+
+class ScheduleEngine:
+    """
+    Mỗi sự kiện trong heap: (fire_at, seq, schedule_id, generation, action).
+    Khi schedule bị sửa/xoá thì tăng generation, các entry cũ bị bỏ qua lúc pop (lazy delete).
+    """
+
+    def __init__(self, on_fire, grace=MISFIRE_GRACE):
+        self._on_fire = on_fire
+        self.grace = grace
+        self._cond = threading.Condition()
+        self._heap = []
+        self._seq = itertools.count()
+        self._schedules = {}        # schedule_id -> dict (row schedules + end_weekday cho weekly)
+        self._generation = {}       # schedule_id -> int
+        self._by_device = {}        # device_id -> set(schedule_id)
+        self._finished = []         # schedule một lần đã tắt xong, chờ is_active=FALSE
+        self._running = True        # stop() trước cả khi run() bắt đầu cũng có hiệu lực
+
+        self.fired = 0
+        self.missed = 0
+        self.max_lag = 0.0
+
+    # ---------- nạp schedule ----------
+    def _fetch(self, device_id=None):
+        return active_schedules(device_id)
+
+    def load_all(self):
+        self.load_rows(self._fetch())
+
+    def load_rows(self, rows):
+        with self._cond:
+            for schedule_id in list(self._schedules):
+                self._drop(schedule_id)
+            for row in rows:
+                self._add(dict(zip(Schedule._fields, row)))
+            self._cond.notify()
+        log.info("Nạp %d schedule đang hoạt động", len(rows))
+
+    def reload_device(self, device_id):
+        """Gọi sau khi lưu/xoá schedule của 1 device: chỉ nạp lại các dòng của device đó."""
+        self.reload_rows(device_id, self._fetch(device_id))
+
+    def reload_rows(self, device_id, rows):
+        with self._cond:
+            for schedule_id in list(self._by_device.get(device_id, ())):
+                self._drop(schedule_id)
+            for row in rows:
+                self._add(dict(zip(Schedule._fields, row)))
+            self._compact()
+            self._cond.notify()
+
+    def _compact(self):
+        # Entry của schedule đã sửa/xoá chỉ bị loại khi tới hạn; dọn bớt nếu heap phình quá
+        if len(self._heap) > 4 * len(self._schedules) + 64:
+            self._heap = [e for e in self._heap if e[3] == self._generation.get(e[2]) and e[2] in self._schedules]
+            heapq.heapify(self._heap)
+
+    def _drop(self, schedule_id):
+        schedule = self._schedules.pop(schedule_id, None)
+        self._generation[schedule_id] = self._generation.get(schedule_id, 0) + 1
+        if schedule is not None:
+            ids = self._by_device.get(schedule["device_id"])
+            if ids is not None:
+                ids.discard(schedule_id)
+
+    def _add(self, schedule, now=None):
+        now = now or datetime.now()
+        schedule_id = schedule["schedule_id"]
+        repeat = schedule.get("repeat") or "none"
+        schedule["repeat"] = repeat
+        if repeat == "weekly":
+            # Thứ neo lưu ở cột schedules.weekday lúc save_schedule, không tính lại khi nạp (restart / sửa lịch).
+            # Dòng cũ chưa chạy migrations/004_schedule_weekday.sql thì mới tạm tính theo lần bật kế tiếp.
+            if schedule.get("weekday") is None:
+                schedule["weekday"] = anchor_weekday(schedule["start_time"], now)
+            # Lịch qua đêm (end < start): tắt vào sáng thứ kế tiếp, không phải cùng thứ với lúc bật
+            overnight = schedule["end_time"] < schedule["start_time"]
+            schedule["end_weekday"] = (schedule["weekday"] + overnight) % 7
+        else:
+            schedule["end_weekday"] = None
+
+        self._schedules[schedule_id] = schedule
+        self._generation.setdefault(schedule_id, 0)
+        self._by_device.setdefault(schedule["device_id"], set()).add(schedule_id)
+
+        start_at = next_occurrence(schedule["start_time"], now, repeat, schedule.get("weekday"))
+        if repeat == "none":
+            # Một lần: bật ở mốc start kế tiếp, tắt ở mốc end ngay sau đó
+            end_at = next_occurrence(schedule["end_time"], start_at)
+        else:
+            # Mốc tắt kế tiếp theo thứ của mốc tắt: nếu đang trong khoảng bật thì là mốc tắt của lần bật này
+            end_at = next_occurrence(schedule["end_time"], now, repeat, schedule["end_weekday"])
+        self._push(start_at, schedule_id, "on")
+        self._push(end_at, schedule_id, "off")
+
+    def _push(self, fire_at, schedule_id, action):
+        heapq.heappush(self._heap, (fire_at, next(self._seq), schedule_id, self._generation[schedule_id], action))
+
+    # ---------- vòng lặp chính ----------
+    def _pop_due(self, now):
+        """Lấy các sự kiện đã tới hạn; với mỗi schedule chỉ giữ sự kiện mới nhất."""
+        due = {}
+        while self._heap and self._heap[0][0] <= now:
+            fire_at, _, schedule_id, generation, action = heapq.heappop(self._heap)
+            schedule = self._schedules.get(schedule_id)
+            if schedule is None or generation != self._generation.get(schedule_id):
+                continue
+
+            # Lập lịch lần kế tiếp ngay (trừ schedule một lần)
+            if schedule["repeat"] != "none":
+                if action == "on":
+                    at_time, weekday = schedule["start_time"], schedule.get("weekday")
+                else:
+                    at_time, weekday = schedule["end_time"], schedule["end_weekday"]
+                self._push(next_occurrence(at_time, now, schedule["repeat"], weekday), schedule_id, action)
+            elif action == "off":
+                # Schedule một lần đã tới mốc tắt (kể cả bị bỏ vì trễ): kết thúc, chờ is_active=FALSE.
+                # Không làm vậy thì dòng vẫn active và mỗi lần restart lại được hẹn sang ngày hôm sau.
+                self._drop(schedule_id)
+                self._finished.append(schedule_id)
+
+            lag = (now - fire_at).total_seconds()
+            if lag > self.grace:
+                # Trễ quá lâu (server bị treo): không bật/tắt bù, chỉ ghi nhận
+                self.missed += 1
+                SCHEDULER_MISSED.inc()
+                log.warning("Bỏ qua schedule %s (%s) trễ %.0fs", schedule_id, action, lag)
+                continue
+
+            # Sau khi bị treo có thể cả "on" và "off" cùng tới hạn: chỉ trạng thái cuối cùng có ý nghĩa
+            previous = due.get(schedule_id)
+            if previous is None or previous[0] <= fire_at:
+                due[schedule_id] = (fire_at, action, schedule)
+        return list(due.values())
+
+    def take_finished(self):
+        with self._cond:
+            finished, self._finished = self._finished, []
+        return finished
+
+    def next_fire(self):
+        with self._cond:
+            return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        with self._cond:
+            return self._pop_due(now)
+
+    def record_fired(self, due, now):
+        for fire_at, action, _ in due:
+            lag = (now - fire_at).total_seconds()
+            if lag > self.max_lag:
+                self.max_lag = lag
+            SCHEDULER_LAG_SECONDS.observe(lag)
+            SCHEDULER_FIRES.inc(action)
+        self.fired += len(due)
+
+    def _deactivate_finished(self):
+        # Schedule một lần đã chạy xong: is_active=FALSE (gọi ngoài lock vì có truy vấn DB)
+        finished = self.take_finished()
+        if not finished:
+            return
+        try:
+            with get_db_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(DEACTIVATE_QUERY, (finished,))
+                cursor.close()
+        except Exception as e:
+            log.error("Lỗi tắt schedule một lần %s: %s", finished, e)
+
+    def run(self):
+        while self._running:
+            with self._cond:
+                if self._heap:
+                    wait = (self._heap[0][0] - datetime.now()).total_seconds()
+                else:
+                    wait = MAX_SLEEP
+                if wait > 0:
+                    self._cond.wait(min(wait, MAX_SLEEP))
+                now = datetime.now()
+                due = self._pop_due(now)
+
+            self._deactivate_finished()
+            if not due:
+                continue
+
+            try:
+                self._on_fire(due, now)
+                self.record_fired(due, now)
+            except Exception as e:
+                log.exception("Lỗi khi thực thi lịch: %s", e)
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+
+    @property
+    def running(self):
+        return self._running
+
+    def stats(self):
+        with self._cond:
+            next_fire = self._heap[0][0].isoformat() if self._heap else None
+            return {
+                "schedules": len(self._schedules),
+                "pending_events": len(self._heap),
+                "next_fire": next_fire,
+                "fired": self.fired,
+                "missed": self.missed,
+                "max_lag_seconds": self.max_lag,
+            }
@@ -2,33 +2,38 @@
 import time
 from datetime import datetime
 from config.db import get_db_connection
-from psycopg2.extras import RealDictCursor
+from config.logger import get_logger
+from controller.schedule_engine import ScheduleEngine, anchor_weekday
+from controller.repository import device_schedule
+from controller.device_topics import device_topics
+from controller.rooms import state_rooms
+from controller.event_log import event_log, SCHEDULE
+from controller.command_tracker import command_tracker
+
+log = get_logger("scheduler")
 
 
 # THÊM: Lấy lịch hẹn giờ từ database theo device_id
 def get_schedule(device_id):
     """
     Lấy lịch hẹn giờ hiện tại của thiết bị từ database
+    Args:
+        device_id: devices.device_id đã kiểm tra quyền (device_for_user)
     Return: dict với start_time, end_time, is_active, hoặc default values
     """
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        device_id = 1
-        cursor.execute(
-            "SELECT schedule_id, start_time, end_time, is_active FROM schedules WHERE device_id=%s LIMIT 1",
-            (device_id,)
-        )
-        schedule = cursor.fetchone()
-        cursor.close()
-        conn.close()
+        # Prepared statement qua repository, trả về namedtuple Schedule
+        schedule = device_schedule(device_id)
         
         if schedule:
             return {
-                "schedule_id": schedule["schedule_id"],
-                "start_time": str(schedule["start_time"]) if schedule["start_time"] else "07:00",
-                "end_time": str(schedule["end_time"]) if schedule["end_time"] else "22:00",
-                "is_active": schedule["is_active"]
+                "schedule_id": schedule.schedule_id,
+                "start_time": str(schedule.start_time) if schedule.start_time else "07:00",
+                "end_time": str(schedule.end_time) if schedule.end_time else "22:00",
+                "repeat": schedule.repeat,
+                "brightness": schedule.brightness,
+                "is_active": schedule.is_active,
+                "weekday": schedule.weekday
             }
         else:
             # Trả về giá trị mặc định nếu chưa có schedule
@@ -38,7 +43,7 @@ def get_schedule(device_id):
                 "is_active": False
             }
     except Exception as e:
-        print(f"[SCHEDULER] Lỗi lấy schedule: {e}")
+        log.error("Lỗi lấy schedule: %s", e)
         return {
             "start_time": "07:00",
             "end_time": "22:00",
@@ -47,53 +52,52 @@ def get_schedule(device_id):
 
 
 # THÊM: Lưu lịch hẹn giờ vào database
-def save_schedule(device_id, start_time, end_time):
+def save_schedule(device_id, start_time, end_time, repeat="daily"):
     """
     Lưu hoặc cập nhật lịch hẹn giờ cho thiết bị
     Args:
-        device_id: ID của thiết bị
+        device_id: devices.device_id đã kiểm tra quyền (device_for_user)
         start_time: Giờ bật (format "HH:MM")
         end_time: Giờ tắt (format "HH:MM")
+        repeat: "none" (một lần), "daily" hoặc "weekly"
     """
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        # tach so cuoi trong device_id vidu light1 thanh so 1
-        device_num = int(''.join(filter(str.isdigit, device_id)))
-        # THÊM: Kiểm tra xem schedule đã tồn tại chưa
-        cursor.execute(
-            "SELECT schedule_id FROM schedules WHERE device_id=%s",
-            (device_num,)
-        )
-        existing = cursor.fetchone()
-        
-        if existing:
-            # THÊM: Cập nhật schedule hiện có
-            device_id = device_num
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            # THÊM: Kiểm tra xem schedule đã tồn tại chưa
             cursor.execute(
-                """UPDATE schedules 
-                   SET start_time=%s, end_time=%s, is_active=TRUE 
-                   WHERE device_id=%s""",
-                (start_time, end_time, device_id)
+                "SELECT schedule_id FROM schedules WHERE device_id=%s",
+                (device_id,)
             )
-            print(f"[SCHEDULER] Cập nhật schedule device {device_id}: {start_time} - {end_time}")
-        else:
-            # THÊM: Tạo schedule mới
-            device_id = device_num
-            cursor.execute(
-                """INSERT INTO schedules (device_id, start_time, end_time, repeat, brightness, is_active)
-                   VALUES (%s, %s, %s, 'none', 100, TRUE)""",
-                (device_id, start_time, end_time)
-            )
-            print(f"[SCHEDULER] Tạo schedule mới device {device_id}: {start_time} - {end_time}")
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
-        
+            existing = cursor.fetchone()
+            # weekly: neo thứ của lần bật đầu tiên; sửa lịch giữ thứ neo cũ (COALESCE), không trôi theo ngày sửa
+            weekday = anchor_weekday(start_time) if repeat == "weekly" else None
+
+            if existing:
+                # THÊM: Cập nhật schedule hiện có
+                cursor.execute(
+                    """UPDATE schedules 
+                       SET start_time=%s, end_time=%s, repeat=%s, is_active=TRUE,
+                           weekday=CASE WHEN %s = 'weekly' THEN COALESCE(weekday, %s) END
+                       WHERE device_id=%s""",
+                    (start_time, end_time, repeat, repeat, weekday, device_id)
+                )
+                log.info("Cập nhật schedule device %s: %s - %s", device_id, start_time, end_time)
+            else:
+                # THÊM: Tạo schedule mới
+                cursor.execute(
+                    """INSERT INTO schedules (device_id, start_time, end_time, repeat, brightness, is_active, weekday)
+                       VALUES (%s, %s, %s, %s, 100, TRUE, %s)""",
+                    (device_id, start_time, end_time, repeat, weekday)
+                )
+                log.info("Tạo schedule mới device %s: %s - %s", device_id, start_time, end_time)
+
+            cursor.close()
+
+        _reload_engine(device_id)
         return True
     except Exception as e:
-        print(f"[SCHEDULER] Lỗi lưu schedule: {e}")
+        log.error("Lỗi lưu schedule: %s", e)
         return False
 
 
@@ -103,98 +107,96 @@ def delete_schedule(device_id):
     Xóa lịch hẹn giờ của thiết bị
     """
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("DELETE FROM schedules WHERE device_id=%s", (device_id,))
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM schedules WHERE device_id=%s", (device_id,))
+            cursor.close()
         
-        print(f"[SCHEDULER] Xóa schedule device {device_id}")
+        log.info("Xóa schedule device %s", device_id)
+        _reload_engine(device_id)
         return True
     except Exception as e:
-        print(f"[SCHEDULER] Lỗi xóa schedule: {e}")
+        log.error("Lỗi xóa schedule: %s", e)
         return False
 
 
+# Engine dùng chung, được tạo khi schedule_executor chạy
+schedule_engine = None
+
+
+def _reload_engine(device_num):
+    # Hook sau save/delete: chỉ nạp lại schedule của device vừa đổi
+    if schedule_engine is not None:
+        try:
+            schedule_engine.reload_device(device_num)
+        except Exception as e:
+            log.error("Lỗi nạp lại schedule device %s: %s", device_num, e)
+
+
+def create_schedule_engine(socketio, mqtt_client):
+    """
+    Tạo engine dùng chung (gán schedule_engine) ngay trên thread gọi, trước khi thread executor chạy:
+    stop_leader_duties tới sớm vẫn thấy engine để stop, không để lại scheduler trên worker không còn là leader.
+    """
+    global schedule_engine
+
+    def fire(events, now):
+        current_time = now.strftime("%H:%M")
+        start = time.monotonic()
+
+        # Tra topic thật của từng device bằng chỉ mục cache (1 truy vấn cho các device chưa biết)
+        topics = device_topics.resolve_many({schedule["device_id"] for _, _, schedule in events})
+        timestamp = datetime.utcnow().isoformat() + "Z"
+
+        messages = []
+        executed = []
+        for fire_at, action, schedule in events:
+            target = topics.get(schedule["device_id"])
+            if target is None:
+                log.warning("Không tìm thấy device %s cho schedule %s", schedule["device_id"], schedule["schedule_id"])
+                continue
+            device_name, topic = target
+
+            payload = {"command": "set", "state": action, "mode": "manual", "timestamp": timestamp}
+            if action == "on" and schedule.get("brightness") is not None:
+                payload["brightness"] = schedule["brightness"]
+            messages.append((topic, payload))
+            executed.append((device_name, action, topic, schedule["schedule_id"]))
+
+        # THÊM: Gửi MQTT command để bật/tắt đèn (cả đợt cùng lúc)
+        failed = command_tracker.send_many(mqtt_client.publish_many, messages, "schedule")
+        log.info("%s: gửi %d lệnh trong %.1fms, lỗi %d",
+                 current_time, len(messages), (time.monotonic() - start) * 1000, len(failed))
+
+        failed = set(failed)
+        for device_name, action, topic, schedule_id in executed:
+            if topic not in failed:
+                event_log.record(device_name, SCHEDULE, None, action, f"schedule {schedule_id}")
+            if action == "on":
+                # THÊM: Thông báo cho frontend qua Socket.IO
+                socketio.emit("schedule_executed", {
+                    "device_id": device_name,
+                    "action": "on",
+                    "time": current_time
+                }, to=state_rooms(device_name))
+
+    schedule_engine = ScheduleEngine(on_fire=fire)
+    return schedule_engine
+
+
 # THÊM: Background thread thực thi lịch hẹn giờ
-def schedule_executor(socketio, mqtt_client):
+def schedule_executor(engine):
     """
-    Background thread kiểm tra và thực thi lịch hẹn giờ
-    Chạy mỗi 30 giây để kiểm tra xem có giờ nào cần thực thi không
+    Background thread thực thi lịch hẹn giờ.
+    Ngủ tới mốc bật/tắt gần nhất trong ScheduleEngine thay vì quét DB định kỳ.
     """
-    print("[SCHEDULER] ▶️ Scheduler executor bắt đầu chạy...")
-    
-    last_executed_on = {}
-    last_executed_off = {}
-    
-    while True:
+    log.info("Scheduler executor bắt đầu chạy")
+    # engine.stop() trước khi thread kịp chạy: run() trả về ngay, không nạp / bắn lịch nào
+    while engine.running:
         try:
-            time.sleep(3)  # Kiểm tra mỗi 30 giây
-            
-            current_time = datetime.now().strftime("%H:%M")
-            print(f"[SCHEDULER] ⏰ Kiểm tra lịch lúc {current_time}")
-            
-            # THÊM: Lấy tất cả các schedule từ database
-            try:
-                conn = get_db_connection()
-                cursor = conn.cursor(cursor_factory=RealDictCursor)
-                
-                cursor.execute(
-                    "SELECT device_id, start_time, end_time, is_active FROM schedules WHERE is_active=TRUE"
-                )
-                schedules = cursor.fetchall()
-                cursor.close()
-                conn.close()
-                
-                # THÊM: Duyệt qua tất cả các schedule hoạt động
-                for schedule in schedules:
-                    device_id = str(schedule["device_id"])
-                    start_time = str(schedule["start_time"])[:5]  # Lấy HH:MM
-                    end_time = str(schedule["end_time"])[:5]      # Lấy HH:MM
-                    
-                    # THÊM: Kiểm tra nếu giờ hiện tại khớp với giờ bật
-                    if current_time == start_time:
-                        # THÊM: Chỉ thực thi 1 lần khi lần đầu bằng giờ
-                        if device_id not in last_executed_on or last_executed_on[device_id] != current_time:
-                            print(f"[SCHEDULER] 🟢 Device {device_id}: BẬT đèn lúc {current_time}")
-                            
-                            # THÊM: Gửi MQTT command để bật đèn
-                            topic = f"home/user1/light1/cmd"
-                            mqtt_client.publish(topic, '{"state": "on", "mode": "manual"}')
-                            
-                            # THÊM: Thông báo cho frontend qua Socket.IO
-                            socketio.emit("schedule_executed", {
-                                "device_id": "light" + device_id,
-                                "action": "on",
-                                "time": current_time
-                            })
-                            
-                            last_executed_on[device_id] = current_time
-                    
-                    # THÊM: Kiểm tra nếu giờ hiện tại khớp với giờ tắt
-                    elif current_time == end_time:
-                        # THÊM: Chỉ thực thi 1 lần khi lần đầu bằng giờ
-                        if device_id not in last_executed_off or last_executed_off[device_id] != current_time:
-                            print(f"[SCHEDULER] 🔴 Device {device_id}: TẮT đèn lúc {current_time}")
-                            
-                            # THÊM: Gửi MQTT command để tắt đèn
-                            topic = f"home/user1/light1/cmd"
-                            mqtt_client.publish(topic, '{"state": "off", "mode": "manual"}')
-                            
-                            # # THÊM: Thông báo cho frontend qua Socket.IO
-                            # socketio.emit("schedule_executed", {
-                            #     "device_id": "light" + device_id,
-                            #     "action": "off",
-                            #     "time": current_time
-                            # })
-                            
-                            last_executed_off[device_id] = current_time
-            
-            except Exception as db_error:
-                print(f"[SCHEDULER] Lỗi query database: {db_error}")
-        
+            engine.load_all()
+            engine.run()
+            return
         except Exception as e:
-            print(f"[SCHEDULER] ⚠️ Lỗi trong schedule_executor: {e}")
+            log.exception("Lỗi trong schedule_executor: %s", e)
             time.sleep(30)
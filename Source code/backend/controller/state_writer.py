@@ -0,0 +1,211 @@
+# controller/state_writer.py
+# Write-behind cho trạng thái thiết bị: callback MQTT chỉ đẩy vào hàng đợi,
+# thread riêng gộp theo device_name (bản mới nhất thắng) rồi ghi 1 câu UPDATE nhiều dòng.
+import time
+import queue
+import threading
+
+from psycopg2.extras import execute_values
+from config.db import get_db_connection
+from config.metrics import timed_query
+from config.logger import get_logger
+
+log = get_logger("db")
+
+FLUSH_MAX_ROWS = 500        # đủ số dòng thì ghi ngay
+FLUSH_INTERVAL = 0.05       # giây, tối đa giữ 1 batch
+QUEUE_MAX_SIZE = 10000      # giới hạn hàng đợi
+ENQUEUE_TIMEOUT = 0.01      # giây, thời gian tối đa callback MQTT bị chặn khi hàng đợi đầy
+
+BATCH_UPDATE_QUERY = """
+    UPDATE devices AS d
+    SET is_on = v.is_on, mode = v.mode, brightness = v.brightness, last_online = v.last_online
+    FROM (VALUES %s) AS v(device_name, is_on, mode, brightness, last_online)
+    WHERE d.device_name = v.device_name
+"""
+BATCH_UPDATE_TEMPLATE = "(%s, %s::boolean, %s::varchar, %s::integer, %s::timestamptz)"
+
+SINGLE_UPDATE_QUERY = """
+    UPDATE devices
+    SET is_on = %s, mode = %s, brightness = %s, last_online = %s
+    WHERE device_name = %s;
+"""
+
+_STOP = object()
+
+
+def write_rows(rows):
+    """
+    Ghi danh sách (device_name, is_on, mode, brightness, last_online) bằng một câu UPDATE ... FROM (VALUES ...).
+    Nếu cả batch lỗi (vd: 1 dòng vi phạm CHECK), ghi lại từng dòng để không mất các dòng hợp lệ.
+    Trả về: (số dòng ghi được, số dòng lỗi)
+    """
+    if not rows:
+        return 0, 0
+
+    conn = get_db_connection()
+    if conn is None:
+        log.error("Cannot connect to DB, dropped %d state rows", len(rows))
+        return 0, len(rows)
+
+    try:
+        try:
+            cursor = conn.cursor()
+            timed_query("state_batch_update", execute_values, cursor, BATCH_UPDATE_QUERY, rows,
+                        BATCH_UPDATE_TEMPLATE, FLUSH_MAX_ROWS)
+            conn.commit()
+            return len(rows), 0
+        except Exception as e:
+            log.error("Batch update error (%d rows), retry từng dòng: %s", len(rows), e)
+            conn.rollback()
+
+        written, failed = 0, 0
+        for device_name, is_on, mode, brightness, last_online in rows:
+            try:
+                cursor = conn.cursor()
+                cursor.execute(SINGLE_UPDATE_QUERY, (is_on, mode, brightness, last_online, device_name))
+                conn.commit()
+                written += 1
+            except Exception as e:
+                log.error("DB error for device %s: %s", device_name, e)
+                conn.rollback()
+                failed += 1
+        return written, failed
+    finally:
+        conn.close()
+
+
+class DeviceStateWriter:
+    """Thread ghi trạng thái thiết bị theo batch (write-behind)."""
+
+    def __init__(self, flush_max_rows=FLUSH_MAX_ROWS, flush_interval=FLUSH_INTERVAL,
+                 queue_max_size=QUEUE_MAX_SIZE, writer=write_rows):
+        self.flush_max_rows = flush_max_rows
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=queue_max_size)
+        self._writer = writer
+        self._thread = None
+        self._lock = threading.Lock()
+
+        # Thống kê
+        self.enqueued = 0
+        self.blocked = 0          # số lần callback phải chờ vì hàng đợi đầy
+        self.dropped = 0          # số bản ghi bị bỏ vì hàng đợi đầy quá ENQUEUE_TIMEOUT
+        self.coalesced = 0        # số bản ghi bị bản mới hơn của cùng thiết bị ghi đè
+        self.batches = 0
+        self.rows_written = 0
+        self.rows_failed = 0
+        self.max_depth = 0
+        self.last_flush_ms = 0.0
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._thread = threading.Thread(target=self._run, name="device-state-writer", daemon=True)
+        self._thread.start()
+        log.info("Device state writer started")
+
+    def submit(self, row):
+        """Đưa 1 dòng trạng thái vào hàng đợi. Trả về False nếu bị bỏ do hàng đợi đầy."""
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            with self._lock:
+                self.blocked += 1
+            try:
+                self._queue.put(row, timeout=ENQUEUE_TIMEOUT)
+            except queue.Full:
+                with self._lock:
+                    self.dropped += 1
+                return False
+
+        with self._lock:
+            self.enqueued += 1
+            depth = self._queue.qsize()
+            if depth > self.max_depth:
+                self.max_depth = depth
+        return True
+
+    def _run(self):
+        pending = {}
+        deadline = None
+        stopping = False
+
+        while not stopping:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                stopping = True
+                # Rút hết những gì còn trong hàng đợi trước khi thoát
+                while True:
+                    try:
+                        rest = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if rest is not _STOP:
+                        self._merge(pending, rest)
+            elif item is not None:
+                self._merge(pending, item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+
+            if pending and (stopping or len(pending) >= self.flush_max_rows
+                            or time.monotonic() >= deadline):
+                self._flush(pending)
+                pending = {}
+                deadline = None
+
+    def _merge(self, pending, row):
+        device_name = row[0]
+        if device_name in pending:
+            self.coalesced += 1
+        pending[device_name] = row
+
+    def _flush(self, pending):
+        rows = list(pending.values())
+        start = time.monotonic()
+        try:
+            written, failed = self._writer(rows)
+        except Exception as e:
+            log.exception("State writer flush error: %s", e)
+            written, failed = 0, len(rows)
+        with self._lock:
+            self.batches += 1
+            self.rows_written += written
+            self.rows_failed += failed
+            self.last_flush_ms = (time.monotonic() - start) * 1000
+
+    def stop(self, timeout=5.0):
+        """Dừng thread sau khi ghi hết dữ liệu còn trong hàng đợi."""
+        if not self.running:
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        log.info("Device state writer stopped", extra={"written": self.rows_written, "failed": self.rows_failed})
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "queue_max_size": self._queue.maxsize,
+                "max_depth": self.max_depth,
+                "enqueued": self.enqueued,
+                "blocked": self.blocked,
+                "dropped": self.dropped,
+                "coalesced": self.coalesced,
+                "batches": self.batches,
+                "rows_written": self.rows_written,
+                "rows_failed": self.rows_failed,
+                "last_flush_ms": self.last_flush_ms,
+            }
+
+
+state_writer = DeviceStateWriter()
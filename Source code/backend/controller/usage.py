@@ -0,0 +1,500 @@
+# controller/usage.py
+# Thống kê sử dụng / điện năng theo device, trả lời từ các bảng rollup dựng sẵn:
+#   usage_minute -> usage_hourly -> usage_daily  (on_seconds, brightness_seconds = Σ độ sáng % × giây bật)
+# Điện năng ước lượng lúc đọc: brightness_seconds / 100 × LAMP_WATTS / 3600 (Wh).
+#
+# - Chạy 1 worker: UsageAccumulator nhận đúng luồng state mà update_device_state thấy,
+#   cộng dồn giây bật vào từng phút trong bộ nhớ; leader ghi mỗi ROLLUP_INTERVAL rồi cộng lên giờ/ngày.
+# - Nhiều worker (mỗi worker chỉ thấy 1 phần luồng state) và khi nạp lại lịch sử:
+#   backfill tính lại các phút từ bảng logs bằng NumPy (vector hoá theo từng device).
+#     cd "Source code/backend" && python -m controller.usage --backfill-days 30
+import os
+import time
+import argparse
+import threading
+from datetime import datetime, timedelta, timezone
+
+from psycopg2.extras import execute_values
+
+from config.db import get_db_connection
+from config.metrics import timed_query
+from config.logger import get_logger
+from config.cluster import CLUSTER_MODE
+from controller.device_cache import device_cache
+
+log = get_logger("usage")
+
+try:
+    import numpy as np
+except ImportError:      # chỉ cần cho backfill
+    np = None
+
+LAMP_WATTS = float(os.environ.get("SMART_LIGHT_LAMP_WATTS", "9"))      # công suất ở 100% độ sáng
+USAGE_TIMEZONE = os.environ.get("SMART_LIGHT_TIMEZONE", "UTC")         # ranh giới ngày của usage_daily
+ROLLUP_INTERVAL = 60            # giây
+MINUTE_RETENTION_DAYS = 7       # usage_minute chỉ giữ 7 ngày, giờ/ngày giữ lâu dài
+BACKFILL_LOOKBACK_DAYS = 30     # tìm trạng thái ban đầu của device trong logs tối đa bấy nhiêu ngày
+
+# range -> (bảng rollup, khoảng thời gian)
+USAGE_RANGES = {
+    "1h": ("usage_minute", timedelta(hours=1)),
+    "24h": ("usage_hourly", timedelta(hours=24)),
+    "7d": ("usage_hourly", timedelta(days=7)),
+    "30d": ("usage_daily", timedelta(days=30)),
+    "365d": ("usage_daily", timedelta(days=365)),
+}
+DEFAULT_RANGE = "24h"
+
+MINUTE_UPSERT_QUERY = """
+    INSERT INTO usage_minute (device_id, bucket, on_seconds, brightness_seconds) VALUES %s
+    ON CONFLICT (device_id, bucket) DO UPDATE
+    SET on_seconds = usage_minute.on_seconds + EXCLUDED.on_seconds,
+        brightness_seconds = usage_minute.brightness_seconds + EXCLUDED.brightness_seconds
+"""
+MINUTE_INSERT_QUERY = """
+    INSERT INTO usage_minute (device_id, bucket, on_seconds, brightness_seconds) VALUES %s
+"""
+MINUTE_DELETE_QUERY = "DELETE FROM usage_minute WHERE bucket >= %s AND bucket < %s"
+# Tính lại các giờ / ngày bị ảnh hưởng từ bảng cấp dưới (ghi đè, nên chạy lại bao nhiêu lần cũng đúng)
+HOURLY_ROLLUP_QUERY = """
+    INSERT INTO usage_hourly (device_id, bucket, on_seconds, brightness_seconds)
+    SELECT device_id, date_trunc('hour', bucket, 'UTC'), sum(on_seconds), sum(brightness_seconds)
+    FROM usage_minute
+    WHERE bucket >= date_trunc('hour', %(start)s::timestamptz, 'UTC')
+      AND bucket < date_trunc('hour', %(end)s::timestamptz, 'UTC') + interval '1 hour'
+    GROUP BY 1, 2
+    ON CONFLICT (device_id, bucket) DO UPDATE
+    SET on_seconds = EXCLUDED.on_seconds, brightness_seconds = EXCLUDED.brightness_seconds
+"""
+DAILY_ROLLUP_QUERY = """
+    INSERT INTO usage_daily (device_id, bucket, on_seconds, brightness_seconds)
+    SELECT device_id, date_trunc('day', bucket, %(tz)s), sum(on_seconds), sum(brightness_seconds)
+    FROM usage_hourly
+    WHERE bucket >= date_trunc('day', %(start)s::timestamptz, %(tz)s)
+      AND bucket < date_trunc('day', %(end)s::timestamptz, %(tz)s) + interval '1 day'
+    GROUP BY 1, 2
+    ON CONFLICT (device_id, bucket) DO UPDATE
+    SET on_seconds = EXCLUDED.on_seconds, brightness_seconds = EXCLUDED.brightness_seconds
+"""
+MINUTE_RETENTION_QUERY = "DELETE FROM usage_minute WHERE bucket < %s"
+LAST_MINUTE_QUERY = "SELECT max(bucket) FROM usage_minute"
+USAGE_QUERY = """
+    SELECT bucket, on_seconds, brightness_seconds FROM {table}
+    WHERE device_id = %s AND bucket >= %s
+    ORDER BY bucket
+"""
+
+# Các sự kiện trong logs (controller/event_log.py) làm đổi trạng thái bật/tắt hoặc độ sáng
+BACKFILL_EVENTS_QUERY = """
+    SELECT device_id, extract(epoch FROM created_at), event_type, new_value
+    FROM logs
+    WHERE created_at >= %s AND created_at < %s AND device_id IS NOT NULL
+      AND event_type IN ('state_change', 'brightness_change', 'offline')
+    ORDER BY device_id, created_at
+"""
+BACKFILL_INITIAL_QUERY = """
+    SELECT DISTINCT ON (device_id, event_type = 'brightness_change')
+           device_id, event_type, new_value
+    FROM logs
+    WHERE created_at < %s AND created_at >= %s AND device_id IS NOT NULL
+      AND event_type IN ('state_change', 'brightness_change', 'offline')
+    ORDER BY device_id, event_type = 'brightness_change', created_at DESC
+"""
+
+
+def floor_minute(at):
+    return at.replace(second=0, microsecond=0)
+
+
+def energy_wh(brightness_seconds):
+    return brightness_seconds / 100.0 * LAMP_WATTS / 3600.0
+
+
+# ====================
+# CỘNG DỒN TỪ LUỒNG STATE
+# ====================
+class UsageAccumulator:
+    """
+    Mỗi device giữ (is_on, brightness, since); mỗi state mới đóng khoảng [since, now)
+    và cộng vào các phút nó phủ. take_rows() cũng đóng khoảng của device đang bật
+    để đèn bật lâu không gửi state vẫn được tính đều từng phút.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._current = {}          # device_name -> (is_on, brightness, since)
+        self._minutes = {}          # (device_name, phút) -> [on_seconds, brightness_seconds]
+        self.live = not CLUSTER_MODE
+
+        self.observed = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self.last_flush_ms = 0.0
+        self.backfilled_minutes = 0
+
+    def observe(self, device_name, is_on, brightness, at):
+        if not self.live:
+            return
+        with self._lock:
+            previous = self._current.get(device_name)
+            if previous is not None:
+                self._add(device_name, previous, at)
+            self._current[device_name] = (is_on, brightness, at)
+            self.observed += 1
+
+    def _add(self, device_name, state, until):
+        is_on, brightness, since = state
+        if not is_on or until <= since:
+            return
+        level = 100 if brightness is None else brightness
+        t = since
+        while t < until:
+            minute = floor_minute(t)
+            end = min(minute + timedelta(minutes=1), until)
+            seconds = (end - t).total_seconds()
+            bucket = self._minutes.get((device_name, minute))
+            if bucket is None:
+                bucket = self._minutes[(device_name, minute)] = [0.0, 0.0]
+            bucket[0] += seconds
+            bucket[1] += seconds * level
+            t = end
+
+    def take_rows(self, now=None):
+        """Các dòng (device_id, phút, on_seconds, brightness_seconds) chưa ghi, cộng dồn được vào usage_minute."""
+        now = now or datetime.now(timezone.utc)
+        with self._lock:
+            for name, state in self._current.items():
+                if state[0] and state[2] < now:
+                    self._add(name, state, now)
+                    self._current[name] = (state[0], state[1], now)
+            minutes, self._minutes = self._minutes, {}
+
+        rows = []
+        for (name, minute), (on_seconds, brightness_seconds) in minutes.items():
+            device = device_cache.get(name)
+            if device is not None:
+                rows.append((device["device_id"], minute, on_seconds, brightness_seconds))
+        return rows
+
+    def requeue(self, rows):
+        # Ghi lỗi: cộng lại vào bộ nhớ để lần sau ghi tiếp
+        names = {d["device_id"]: d["device_name"] for d in device_cache.snapshot().devices}
+        with self._lock:
+            for device_id, minute, on_seconds, brightness_seconds in rows:
+                key = (names.get(device_id), minute)
+                bucket = self._minutes.setdefault(key, [0.0, 0.0])
+                bucket[0] += on_seconds
+                bucket[1] += brightness_seconds
+
+    def mark_written(self, count, elapsed_ms):
+        self.flushes += 1
+        self.rows_written += count
+        self.last_flush_ms = elapsed_ms
+
+    def stats(self):
+        with self._lock:
+            return {
+                "live": self.live,
+                "tracked_devices": len(self._current),
+                "pending_minutes": len(self._minutes),
+                "observed": self.observed,
+                "flushes": self.flushes,
+                "rows_written": self.rows_written,
+                "last_flush_ms": self.last_flush_ms,
+                "backfilled_minutes": self.backfilled_minutes,
+                "lamp_watts": LAMP_WATTS,
+            }
+
+
+usage = UsageAccumulator()
+
+
+# ====================
+# BACKFILL TỪ LOGS (NumPy)
+# ====================
+def _state_value(event_type, new_value):
+    if event_type == "brightness_change":
+        try:
+            return float(new_value)
+        except (TypeError, ValueError):
+            return 100.0
+    return 1.0 if event_type == "state_change" and new_value == "on" else 0.0
+
+
+def minute_usage(change_times, is_on, brightness, start, end):
+    """
+    Giây bật và Σ độ sáng × giây cho từng phút trong [start, end) (giây epoch, bội của 60).
+    change_times tăng dần, phần tử đầu = start; is_on/brightness là trạng thái kể từ mốc tương ứng.
+    Tích phân F(t) tuyến tính từng đoạn, lấy giá trị tại các mốc phút rồi np.diff.
+    """
+    edges = np.arange(start, end + 1, 60.0)
+    on_rate = is_on.astype(np.float64)
+    brightness_rate = on_rate * brightness
+    dt = np.diff(change_times)
+    on_cum = np.concatenate(([0.0], np.cumsum(on_rate[:-1] * dt)))
+    brightness_cum = np.concatenate(([0.0], np.cumsum(brightness_rate[:-1] * dt)))
+
+    idx = np.searchsorted(change_times, edges, side="right") - 1
+    offset = edges - change_times[idx]
+    on_total = on_cum[idx] + on_rate[idx] * offset
+    brightness_total = brightness_cum[idx] + brightness_rate[idx] * offset
+    return edges[:-1], np.diff(on_total), np.diff(brightness_total)
+
+
+def compute_backfill(events, initial, start, end):
+    """
+    events: (device_id, epoch, event_type, new_value) trong [start, end), xếp theo device rồi thời gian.
+    initial: (device_id, event_type, new_value) - sự kiện cuối trước start cho bật/tắt và cho độ sáng.
+    Trả về các dòng usage_minute (device_id, phút, on_seconds, brightness_seconds) có on_seconds > 0.
+    """
+    if np is None:
+        raise RuntimeError("Backfill cần numpy: pip install numpy")
+    start_s, end_s = start.timestamp(), end.timestamp()
+
+    per_device = {}
+    for device_id, event_type, new_value in initial:
+        state = per_device.setdefault(device_id, ([start_s], [0.0], [start_s], [100.0]))
+        if event_type == "brightness_change":
+            state[3][0] = _state_value(event_type, new_value)
+        else:
+            state[1][0] = _state_value(event_type, new_value)
+    for device_id, epoch, event_type, new_value in events:
+        state = per_device.setdefault(device_id, ([start_s], [0.0], [start_s], [100.0]))
+        if event_type == "brightness_change":
+            state[2].append(float(epoch))
+            state[3].append(_state_value(event_type, new_value))
+        else:
+            state[0].append(float(epoch))
+            state[1].append(_state_value(event_type, new_value))
+
+    rows = []
+    for device_id, (on_times, on_values, b_times, b_values) in per_device.items():
+        on_times, b_times = np.asarray(on_times), np.asarray(b_times)
+        # Gộp mốc thay đổi của 2 trường, điền tiếp giá trị cuối cùng (forward fill)
+        times = np.union1d(on_times, b_times)
+        is_on = np.asarray(on_values)[np.searchsorted(on_times, times, side="right") - 1]
+        brightness = np.asarray(b_values)[np.searchsorted(b_times, times, side="right") - 1]
+
+        minutes, on_seconds, brightness_seconds = minute_usage(times, is_on, brightness, start_s, end_s)
+        for i in np.flatnonzero(on_seconds > 1e-9):
+            rows.append((device_id, datetime.fromtimestamp(minutes[i], timezone.utc),
+                         float(on_seconds[i]), float(brightness_seconds[i])))
+    return rows
+
+
+# ====================
+# GHI ROLLUP (runtime threaded)
+# ====================
+def _rollup(cursor, start, end):
+    params = {"start": start, "end": end, "tz": USAGE_TIMEZONE}
+    cursor.execute(HOURLY_ROLLUP_QUERY, params)
+    cursor.execute(DAILY_ROLLUP_QUERY, params)
+
+
+def _flush_minutes(cursor, rows, first, last):
+    execute_values(cursor, MINUTE_UPSERT_QUERY, rows, page_size=1000)
+    _rollup(cursor, first, last)
+
+
+def flush_usage(now=None):
+    """Ghi các phút đã cộng dồn (cộng thêm vào usage_minute) rồi tính lại giờ/ngày bị ảnh hưởng."""
+    rows = usage.take_rows(now)
+    if not rows:
+        return 0
+    start = time.monotonic()
+    conn = get_db_connection()
+    if conn is None:
+        usage.requeue(rows)
+        return 0
+    try:
+        cursor = conn.cursor()
+        minutes = [row[1] for row in rows]
+        timed_query("usage_flush", _flush_minutes, cursor, rows, min(minutes), max(minutes))
+        conn.commit()
+    except Exception as e:
+        log.error("Usage rollup error: %s", e)
+        conn.rollback()
+        usage.requeue(rows)
+        return 0
+    finally:
+        conn.close()
+    usage.mark_written(len(rows), (time.monotonic() - start) * 1000)
+    return len(rows)
+
+
+def backfill(start, end):
+    """Tính lại usage_minute trong [start, end) từ logs (ghi đè), rồi cộng lên giờ/ngày."""
+    start, end = floor_minute(start), floor_minute(end)
+    if end <= start:
+        return 0
+    conn = get_db_connection()
+    if conn is None:
+        return 0
+    try:
+        cursor = conn.cursor()
+        cursor.execute(BACKFILL_EVENTS_QUERY, (start, end))
+        events = cursor.fetchall()
+        cursor.execute(BACKFILL_INITIAL_QUERY, (start, start - timedelta(days=BACKFILL_LOOKBACK_DAYS)))
+        initial = cursor.fetchall()
+        rows = compute_backfill(events, initial, start, end)
+
+        cursor.execute(MINUTE_DELETE_QUERY, (start, end))
+        if rows:
+            execute_values(cursor, MINUTE_INSERT_QUERY, rows, page_size=1000)
+        _rollup(cursor, start, end - timedelta(minutes=1))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    usage.backfilled_minutes += len(rows)
+    return len(rows)
+
+
+def expire_minutes(now=None):
+    now = now or datetime.now(timezone.utc)
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(MINUTE_RETENTION_QUERY, (now - timedelta(days=MINUTE_RETENTION_DAYS),))
+        cursor.close()
+
+
+class UsageRollup:
+    """Thread của leader: chạy 1 worker thì ghi phần cộng dồn, nhiều worker thì backfill các phút vừa xong."""
+
+    def __init__(self, interval=ROLLUP_INTERVAL):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._watermark = None      # chế độ backfill: phút đầu tiên chưa tính
+        self._expired_hour = None
+
+    def tick(self, now=None):
+        now = now or datetime.now(timezone.utc)
+        if usage.live:
+            flush_usage(now)
+        else:
+            if self._watermark is None:
+                self._watermark = self._resume_point(now)
+            end = floor_minute(now)
+            if end > self._watermark:
+                backfill(self._watermark, end)
+                self._watermark = end
+        hour = now.replace(minute=0, second=0, microsecond=0)
+        if hour != self._expired_hour:
+            expire_minutes(now)
+            self._expired_hour = hour
+
+    @staticmethod
+    def _resume_point(now):
+        # Leader mới: tính tiếp từ phút cuối cùng đã có (tính lại phút đó cho chắc)
+        conn = get_db_connection()
+        last = None
+        if conn is not None:
+            try:
+                cursor = conn.cursor()
+                cursor.execute(LAST_MINUTE_QUERY)
+                last = cursor.fetchone()[0]
+            finally:
+                conn.close()
+        return last or floor_minute(now) - timedelta(hours=1)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.tick()
+            except Exception as e:
+                log.exception("Usage rollup loop error: %s", e)
+
+    def start(self):
+        self._stop.clear()
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="usage-rollup", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._watermark = None
+        if usage.live:
+            flush_usage()
+
+
+usage_rollup = UsageRollup()
+
+
+# ====================
+# API
+# ====================
+def usage_query(range_key):
+    """(câu SQL, mốc bắt đầu) cho range; None nếu range không hợp lệ."""
+    entry = USAGE_RANGES.get(range_key)
+    if entry is None:
+        return None
+    table, span = entry
+    return USAGE_QUERY.format(table=table), datetime.now(timezone.utc) - span
+
+
+def usage_response(device, range_key, rows):
+    """rows: (bucket, on_seconds, brightness_seconds) từ bảng rollup."""
+    buckets = []
+    total_on = total_brightness = 0.0
+    for bucket, on_seconds, brightness_seconds in rows:
+        total_on += on_seconds
+        total_brightness += brightness_seconds
+        buckets.append({
+            "t": bucket.isoformat(),
+            "on_seconds": round(on_seconds, 1),
+            "energy_wh": round(energy_wh(brightness_seconds), 3),
+            "avg_brightness": round(brightness_seconds / on_seconds, 1) if on_seconds else None,
+        })
+    return {
+        "device_id": device,
+        "range": range_key,
+        "granularity": USAGE_RANGES[range_key][0].split("_")[1],
+        "lamp_watts": LAMP_WATTS,
+        "totals": {
+            "on_seconds": round(total_on, 1),
+            "energy_wh": round(energy_wh(total_brightness), 3),
+        },
+        "buckets": buckets,
+    }
+
+
+def get_usage(device, device_id, range_key=DEFAULT_RANGE):
+    """
+    Trả về (body, status) cho GET /api/devices/<id>/usage?range=...
+    device_id: đã kiểm tra quyền ở route (device_for_user: chủ device hoặc admin).
+    """
+    query = usage_query(range_key)
+    if query is None:
+        return {"error": f"range phải là một trong {list(USAGE_RANGES)}"}, 400
+
+    sql, since = query
+    conn = get_db_connection()
+    if conn is None:
+        return {"error": "Lỗi kết nối database"}, 500
+    try:
+        cursor = conn.cursor()
+        cursor.execute(sql, (device_id, since))
+        rows = cursor.fetchall()
+    finally:
+        conn.close()
+    return usage_response(device, range_key, rows), 200
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tính lại rollup sử dụng từ bảng logs")
+    parser.add_argument("--backfill-days", type=float, default=1.0)
+    args = parser.parse_args()
+
+    device_cache.warm()
+    end = datetime.now(timezone.utc)
+    start = end - timedelta(days=args.backfill_days)
+    # Từng ngày một để giữ bộ nhớ và transaction nhỏ
+    day = floor_minute(start)
+    while day < end:
+        chunk_end = min(day + timedelta(days=1), end)
+        print(f"==> Backfill {day:%Y-%m-%d %H:%M} -> {chunk_end:%Y-%m-%d %H:%M}: {backfill(day, chunk_end)} phút")
+        day = chunk_end
@@ -0,0 +1,79 @@
+# controller/user_cache.py
+# Cache hồ sơ user (user_id, username, email, role) cho /api/current-user, kiểm tra quyền phòng Socket.IO...
+# LRU giới hạn USER_CACHE_MAX_SIZE phần tử, mỗi phần tử sống tối đa USER_CACHE_TTL giây.
+# Đăng kí / đổi role xoá (invalidate) ngay; TTL chỉ giới hạn độ trễ khi worker khác đổi dữ liệu.
+import time
+import threading
+from collections import OrderedDict
+
+USER_CACHE_TTL = 60             # giây
+USER_CACHE_MAX_SIZE = 10000
+
+
+class UserCache:
+
+    def __init__(self, ttl=USER_CACHE_TTL, max_size=USER_CACHE_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()       # user_id -> (hết hạn lúc (monotonic), profile)
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, user_id):
+        """Hồ sơ đã cache (bản sao), None nếu chưa có hoặc đã hết hạn."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, profile = entry
+            if expires_at <= now:
+                del self._entries[user_id]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+        return dict(profile)
+
+    def put(self, profile):
+        with self._lock:
+            self._entries[profile["user_id"]] = (time.monotonic() + self.ttl, dict(profile))
+            self._entries.move_to_end(profile["user_id"])
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, user_id):
+        with self._lock:
+            if self._entries.pop(user_id, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+user_cache = UserCache()
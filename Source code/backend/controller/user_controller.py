@@ -1,6 +1,7 @@
 from flask import jsonify, request, session, redirect, url_for, render_template
 from functools import wraps
 from controller.auth import register_user, login_user, get_user_by_id
+from controller.passwords import PasswordPoolBusy
 
 # ==================== CHECK LOGIN ====================
 def require_login(f):
@@ -24,18 +25,38 @@ def handle_login():
     if not username or not password:
         return jsonify({"error": "Vui lòng nhập tên đăng nhập và mật khẩu"}), 400
 
-    user_id, error = login_user(username, password)
+    try:
+        user, error = login_user(username, password)
+    except PasswordPoolBusy as e:
+        return jsonify({"error": str(e)}), 503
     if error:
         return jsonify({"error": error}), 401
 
-    session["user_id"] = user_id
+    session["user_id"] = user["user_id"]
     return jsonify({
         "message": "Đăng nhập thành công",
-        "user": get_user_by_id(user_id)
+        "user": user
     }), 200
 
 
 # ==================== REGISTER HANDLER ====================
+def validate_registration(username, password, password_confirm):
+    """Trả về thông báo lỗi, hoặc None nếu hợp lệ (dùng chung cho cả runtime async)."""
+    if not username or not password:
+        return "Vui lòng nhập tên đăng nhập và mật khẩu"
+
+    if len(username) < 3:
+        return "Tên đăng nhập phải ít nhất 3 ký tự"
+
+    if len(password) < 6:
+        return "Mật khẩu phải ít nhất 6 ký tự"
+
+    if password != password_confirm:
+        return "Mật khẩu xác nhận không trùng"
+    return None
+
+
+
 def handle_register():
     if request.method == "GET":
         return render_template("login.html")
@@ -46,26 +67,18 @@ def handle_register():
     password_confirm = data.get("password_confirm", "").strip()
     email = data.get("email", "").strip() or None
 
-    if not username or not password:
-        return jsonify({"error": "Vui lòng nhập tên đăng nhập và mật khẩu"}), 400
-
-    if len(username) < 3:
-        return jsonify({"error": "Tên đăng nhập phải ít nhất 3 ký tự"}), 400
-
-    if len(password) < 6:
-        return jsonify({"error": "Mật khẩu phải ít nhất 6 ký tự"}), 400
-
-    if password != password_confirm:
-        return jsonify({"error": "Mật khẩu xác nhận không trùng"}), 400
+    error = validate_registration(username, password, password_confirm)
+    if error:
+        return jsonify({"error": error}), 400
 
-    user_id, error = register_user(username, password, email)
+    user, error = register_user(username, password, email)
     if error:
         return jsonify({"error": error}), 400
 
-    session["user_id"] = user_id
+    session["user_id"] = user["user_id"]
     return jsonify({
         "message": "Đăng kí thành công",
-        "user": get_user_by_id(user_id)
+        "user": user
     }), 201
 
 
@@ -0,0 +1,36 @@
+# main.py
+# Chọn runtime khi khởi động:
+#   python main.py                    -> threaded: Flask + Flask-SocketIO + paho + psycopg2 (app.py)
+#   python main.py --runtime async    -> async: Starlette + python-socketio + aiomqtt + asyncpg (asgi_app.py)
+# Có thể đặt mặc định bằng biến môi trường SMART_LIGHT_RUNTIME=threaded|async.
+# Nhiều worker: python main.py --cluster --port 5001 (xem config/cluster.py)
+import os
+import argparse
+
+RUNTIMES = ("threaded", "async")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Smart light backend")
+    parser.add_argument("--runtime", choices=RUNTIMES,
+                        default=os.environ.get("SMART_LIGHT_RUNTIME", "threaded"))
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--cluster", action="store_true",
+                        help="chạy như 1 worker trong cụm (shared subscription, leader election)")
+    args = parser.parse_args()
+    if args.cluster:
+        # config/cluster.py đọc biến môi trường lúc import nên phải đặt trước khi import runtime
+        os.environ["SMART_LIGHT_CLUSTER"] = "1"
+
+    print(f"==> Runtime: {args.runtime}{' (cluster worker)' if args.cluster else ''}")
+    # Chỉ import runtime được chọn: app.py kết nối MQTT/DB ngay lúc import
+    if args.runtime == "async":
+        from asgi_app import run
+    else:
+        from app import run
+    run(host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
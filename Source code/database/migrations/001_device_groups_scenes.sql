@@ -0,0 +1,39 @@
+-- Migration 001: nhóm thiết bị và scene cho POST /api/device/bulk-command
+-- Chạy trên database đã tạo từ schema.sql cũ:  psql -d smart_light_db -f 001_device_groups_scenes.sql
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS public.device_groups (
+    group_id serial PRIMARY KEY,
+    user_id integer REFERENCES public.users(user_id),
+    name character varying(100) NOT NULL,
+    -- Tên group/scene riêng theo từng user
+    UNIQUE (user_id, name)
+);
+
+CREATE TABLE IF NOT EXISTS public.device_group_members (
+    group_id integer NOT NULL REFERENCES public.device_groups(group_id) ON DELETE CASCADE,
+    device_id integer NOT NULL REFERENCES public.devices(device_id) ON DELETE CASCADE,
+    PRIMARY KEY (group_id, device_id)
+);
+
+-- Scene: mỗi device có thể có state/mode/brightness riêng (NULL = lấy từ request)
+CREATE TABLE IF NOT EXISTS public.scenes (
+    scene_id serial PRIMARY KEY,
+    user_id integer REFERENCES public.users(user_id),
+    name character varying(100) NOT NULL,
+    UNIQUE (user_id, name)
+);
+
+CREATE TABLE IF NOT EXISTS public.scene_devices (
+    scene_id integer NOT NULL REFERENCES public.scenes(scene_id) ON DELETE CASCADE,
+    device_id integer NOT NULL REFERENCES public.devices(device_id) ON DELETE CASCADE,
+    state character varying(10),
+    mode character varying(10),
+    brightness integer,
+    PRIMARY KEY (scene_id, device_id)
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS devices_device_name_key ON public.devices (device_name);
+
+COMMIT;
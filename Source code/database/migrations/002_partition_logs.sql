@@ -0,0 +1,61 @@
+-- Migration 002: chuyển bảng logs sang partition theo ngày (RANGE created_at)
+-- Chạy trên database đã tạo từ schema.sql cũ:  psql -d smart_light_db -f 002_partition_logs.sql
+-- Dữ liệu cũ được chép sang partition tương ứng; partition cho các ngày tới do backend tự tạo
+-- (controller/log_partitions.py), retention xoá cả partition thay vì DELETE từng dòng.
+
+BEGIN;
+
+-- Ranh giới partition tính theo ngày UTC (giống backend)
+SET LOCAL timezone = 'UTC';
+
+-- Giữ sequence log_id khi xoá bảng cũ
+ALTER SEQUENCE public.logs_log_id_seq OWNED BY NONE;
+ALTER TABLE public.logs RENAME TO logs_legacy;
+ALTER TABLE public.logs_legacy RENAME CONSTRAINT logs_pkey TO logs_legacy_pkey;
+ALTER TABLE public.logs_legacy RENAME CONSTRAINT logs_device_id_fkey TO logs_legacy_device_id_fkey;
+
+CREATE TABLE public.logs (
+    log_id integer NOT NULL DEFAULT nextval('public.logs_log_id_seq'::regclass),
+    device_id integer REFERENCES public.devices(device_id),
+    event_type character varying(50),
+    old_value character varying(100),
+    new_value character varying(100),
+    description text,
+    created_at timestamp with time zone DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    CONSTRAINT logs_pkey PRIMARY KEY (log_id, created_at)
+) PARTITION BY RANGE (created_at);
+
+ALTER TABLE public.logs OWNER TO postgres;
+ALTER SEQUENCE public.logs_log_id_seq OWNED BY public.logs.log_id;
+
+CREATE TABLE public.logs_default PARTITION OF public.logs DEFAULT;
+
+-- Tạo trên bảng cha, PostgreSQL tự tạo cho từng partition
+CREATE INDEX logs_device_id_created_at_idx ON public.logs USING btree (device_id, created_at);
+CREATE INDEX logs_created_at_brin_idx ON public.logs USING brin (created_at);
+
+-- Partition theo ngày cho dữ liệu cũ và 7 ngày tới (cùng quy ước tên logs_pYYYYMMDD với backend)
+DO $$
+DECLARE
+    first_day date;
+    day date;
+BEGIN
+    SELECT COALESCE(min(created_at)::date, CURRENT_DATE) INTO first_day FROM public.logs_legacy;
+    day := first_day;
+    WHILE day <= CURRENT_DATE + 7 LOOP
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS public.%I PARTITION OF public.logs FOR VALUES FROM (%L) TO (%L)',
+            'logs_p' || to_char(day, 'YYYYMMDD'), day, day + 1
+        );
+        day := day + 1;
+    END LOOP;
+END $$;
+
+-- created_at NULL (không có ở dữ liệu do backend ghi) lấy thời điểm migrate
+INSERT INTO public.logs (log_id, device_id, event_type, old_value, new_value, description, created_at)
+SELECT log_id, device_id, event_type, old_value, new_value, description, COALESCE(created_at, CURRENT_TIMESTAMP)
+FROM public.logs_legacy;
+
+DROP TABLE public.logs_legacy;
+
+COMMIT;
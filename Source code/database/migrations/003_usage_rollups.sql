@@ -0,0 +1,35 @@
+-- Migration 003: bảng rollup thống kê sử dụng cho GET /api/devices/<id>/usage
+-- Chạy trên database đã tạo từ schema.sql cũ:  psql -d smart_light_db -f 003_usage_rollups.sql
+-- Lịch sử cũ trong logs có thể tính lại bằng:  python -m controller.usage --backfill-days 30
+
+BEGIN;
+
+-- on_seconds: số giây đèn bật trong bucket; brightness_seconds: Σ độ sáng (%) × giây bật
+CREATE TABLE IF NOT EXISTS public.usage_minute (
+    device_id integer NOT NULL REFERENCES public.devices(device_id) ON DELETE CASCADE,
+    bucket timestamp with time zone NOT NULL,
+    on_seconds double precision NOT NULL DEFAULT 0,
+    brightness_seconds double precision NOT NULL DEFAULT 0,
+    PRIMARY KEY (device_id, bucket)
+);
+
+CREATE TABLE IF NOT EXISTS public.usage_hourly (
+    device_id integer NOT NULL REFERENCES public.devices(device_id) ON DELETE CASCADE,
+    bucket timestamp with time zone NOT NULL,
+    on_seconds double precision NOT NULL DEFAULT 0,
+    brightness_seconds double precision NOT NULL DEFAULT 0,
+    PRIMARY KEY (device_id, bucket)
+);
+
+CREATE TABLE IF NOT EXISTS public.usage_daily (
+    device_id integer NOT NULL REFERENCES public.devices(device_id) ON DELETE CASCADE,
+    bucket timestamp with time zone NOT NULL,
+    on_seconds double precision NOT NULL DEFAULT 0,
+    brightness_seconds double precision NOT NULL DEFAULT 0,
+    PRIMARY KEY (device_id, bucket)
+);
+
+-- usage_minute chỉ giữ vài ngày (backend xoá), bucket cũ dọn theo chỉ mục này
+CREATE INDEX IF NOT EXISTS usage_minute_bucket_idx ON public.usage_minute (bucket);
+
+COMMIT;
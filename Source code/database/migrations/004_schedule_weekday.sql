@@ -0,0 +1,22 @@
+-- Migration 004: lưu thứ neo (0 = thứ Hai) của schedule weekly, để thứ không bị tính lại mỗi lần restart / sửa lịch
+-- Chạy trên database đã tạo từ schema.sql cũ:  psql -d smart_light_db -f 004_schedule_weekday.sql
+
+BEGIN;
+
+ALTER TABLE public.schedules ADD COLUMN IF NOT EXISTS weekday smallint;
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'schedules_weekday_check') THEN
+        ALTER TABLE public.schedules
+            ADD CONSTRAINT schedules_weekday_check CHECK (weekday >= 0 AND weekday <= 6);
+    END IF;
+END $$;
+
+-- Schedule weekly đang có: neo theo lần bật kế tiếp tính từ lúc chạy migration (như backend cũ tính lúc khởi động)
+UPDATE public.schedules
+SET weekday = EXTRACT(ISODOW FROM CASE WHEN start_time > LOCALTIME THEN CURRENT_DATE
+                                       ELSE CURRENT_DATE + 1 END)::int - 1
+WHERE repeat = 'weekly' AND weekday IS NULL;
+
+COMMIT;
@@ -0,0 +1,21 @@
+-- Migration 005: tên group / scene chỉ cần duy nhất trong từng user (lệnh hàng loạt đã giới hạn theo user)
+-- Chạy trên database đã chạy 001_device_groups_scenes.sql cũ:  psql -d smart_light_db -f 005_group_scene_name_per_user.sql
+
+BEGIN;
+
+ALTER TABLE public.device_groups DROP CONSTRAINT IF EXISTS device_groups_name_key;
+ALTER TABLE public.scenes DROP CONSTRAINT IF EXISTS scenes_name_key;
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'device_groups_user_id_name_key') THEN
+        ALTER TABLE public.device_groups
+            ADD CONSTRAINT device_groups_user_id_name_key UNIQUE (user_id, name);
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'scenes_user_id_name_key') THEN
+        ALTER TABLE public.scenes
+            ADD CONSTRAINT scenes_user_id_name_key UNIQUE (user_id, name);
+    END IF;
+END $$;
+
+COMMIT;
@@ -81,8 +81,9 @@ CREATE TABLE public.logs (
     old_value character varying(100),
     new_value character varying(100),
     description text,
-    created_at timestamp with time zone DEFAULT CURRENT_TIMESTAMP
-);
+    created_at timestamp with time zone DEFAULT CURRENT_TIMESTAMP NOT NULL
+)
+PARTITION BY RANGE (created_at);
 
 
 ALTER TABLE public.logs OWNER TO postgres;
@@ -125,6 +126,8 @@ CREATE TABLE public.schedules (
     repeat character varying(10),
     brightness integer DEFAULT 100,
     is_active boolean DEFAULT true,
+    weekday smallint,
+    CONSTRAINT schedules_weekday_check CHECK (((weekday >= 0) AND (weekday <= 6))),
     CONSTRAINT schedules_repeat_check CHECK (((repeat)::text = ANY ((ARRAY['none'::character varying, 'daily'::character varying, 'weekly'::character varying])::text[])))
 );
 
@@ -212,7 +215,7 @@ ALTER TABLE ONLY public.devices ALTER COLUMN device_id SET DEFAULT nextval('publ
 -- Name: logs log_id; Type: DEFAULT; Schema: public; Owner: postgres
 --
 
-ALTER TABLE ONLY public.logs ALTER COLUMN log_id SET DEFAULT nextval('public.logs_log_id_seq'::regclass);
+ALTER TABLE public.logs ALTER COLUMN log_id SET DEFAULT nextval('public.logs_log_id_seq'::regclass);
 
 
 --
@@ -323,8 +326,8 @@ ALTER TABLE ONLY public.devices
 -- Name: logs logs_pkey; Type: CONSTRAINT; Schema: public; Owner: postgres
 --
 
-ALTER TABLE ONLY public.logs
-    ADD CONSTRAINT logs_pkey PRIMARY KEY (log_id);
+ALTER TABLE public.logs
+    ADD CONSTRAINT logs_pkey PRIMARY KEY (log_id, created_at);
 
 
 --
@@ -359,7 +362,7 @@ ALTER TABLE ONLY public.devices
 -- Name: logs logs_device_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: postgres
 --
 
-ALTER TABLE ONLY public.logs
+ALTER TABLE public.logs
     ADD CONSTRAINT logs_device_id_fkey FOREIGN KEY (device_id) REFERENCES public.devices(device_id);
 
 
@@ -372,6 +375,100 @@ ALTER TABLE ONLY public.schedules
     ADD CONSTRAINT schedules_device_id_fkey FOREIGN KEY (device_id) REFERENCES public.devices(device_id);
 
 
+--
+-- Nhóm thiết bị / scene cho lệnh hàng loạt (giống migrations/001_device_groups_scenes.sql)
+--
+
+CREATE TABLE public.device_groups (
+    group_id serial PRIMARY KEY,
+    user_id integer REFERENCES public.users(user_id),
+    name character varying(100) NOT NULL,
+    -- Tên group/scene riêng theo từng user
+    UNIQUE (user_id, name)
+);
+
+ALTER TABLE public.device_groups OWNER TO postgres;
+
+CREATE TABLE public.device_group_members (
+    group_id integer NOT NULL REFERENCES public.device_groups(group_id) ON DELETE CASCADE,
+    device_id integer NOT NULL REFERENCES public.devices(device_id) ON DELETE CASCADE,
+    PRIMARY KEY (group_id, device_id)
+);
+
+ALTER TABLE public.device_group_members OWNER TO postgres;
+
+CREATE TABLE public.scenes (
+    scene_id serial PRIMARY KEY,
+    user_id integer REFERENCES public.users(user_id),
+    name character varying(100) NOT NULL,
+    UNIQUE (user_id, name)
+);
+
+ALTER TABLE public.scenes OWNER TO postgres;
+
+CREATE TABLE public.scene_devices (
+    scene_id integer NOT NULL REFERENCES public.scenes(scene_id) ON DELETE CASCADE,
+    device_id integer NOT NULL REFERENCES public.devices(device_id) ON DELETE CASCADE,
+    state character varying(10),
+    mode character varying(10),
+    brightness integer,
+    PRIMARY KEY (scene_id, device_id)
+);
+
+ALTER TABLE public.scene_devices OWNER TO postgres;
+
+-- device_name là khoá tra cứu của MQTT (UPDATE ... WHERE device_name = ...)
+CREATE UNIQUE INDEX devices_device_name_key ON public.devices USING btree (device_name);
+
+--
+-- logs chia partition theo ngày (giống migrations/002_partition_logs.sql).
+-- Partition logs_pYYYYMMDD do backend tạo trước (controller/log_partitions.py),
+-- logs_default chỉ hứng dòng lệch giờ ngoài các partition đã tạo.
+--
+
+CREATE TABLE public.logs_default PARTITION OF public.logs DEFAULT;
+
+CREATE INDEX logs_device_id_created_at_idx ON public.logs USING btree (device_id, created_at);
+CREATE INDEX logs_created_at_brin_idx ON public.logs USING brin (created_at);
+
+--
+-- Rollup thống kê sử dụng (giống migrations/003_usage_rollups.sql)
+-- on_seconds: số giây đèn bật trong bucket; brightness_seconds: Σ độ sáng (%) × giây bật
+--
+
+CREATE TABLE public.usage_minute (
+    device_id integer NOT NULL REFERENCES public.devices(device_id) ON DELETE CASCADE,
+    bucket timestamp with time zone NOT NULL,
+    on_seconds double precision NOT NULL DEFAULT 0,
+    brightness_seconds double precision NOT NULL DEFAULT 0,
+    PRIMARY KEY (device_id, bucket)
+);
+
+ALTER TABLE public.usage_minute OWNER TO postgres;
+
+CREATE INDEX usage_minute_bucket_idx ON public.usage_minute USING btree (bucket);
+
+CREATE TABLE public.usage_hourly (
+    device_id integer NOT NULL REFERENCES public.devices(device_id) ON DELETE CASCADE,
+    bucket timestamp with time zone NOT NULL,
+    on_seconds double precision NOT NULL DEFAULT 0,
+    brightness_seconds double precision NOT NULL DEFAULT 0,
+    PRIMARY KEY (device_id, bucket)
+);
+
+ALTER TABLE public.usage_hourly OWNER TO postgres;
+
+CREATE TABLE public.usage_daily (
+    device_id integer NOT NULL REFERENCES public.devices(device_id) ON DELETE CASCADE,
+    bucket timestamp with time zone NOT NULL,
+    on_seconds double precision NOT NULL DEFAULT 0,
+    brightness_seconds double precision NOT NULL DEFAULT 0,
+    PRIMARY KEY (device_id, bucket)
+);
+
+ALTER TABLE public.usage_daily OWNER TO postgres;
+
+
 -- Completed on 2025-11-26 17:53:49
 
 --
@@ -58,7 +58,8 @@ PubSubClient client(espClient);
 // ============================
 // Publish STATE
 // ============================
-void publishState(Light &l, String topic, String device_id) {
+// cmd_id: gửi lại cmd_id của lệnh vừa xử lý để backend xác nhận (ack) đúng lệnh
+void publishState(Light &l, String topic, String device_id, String cmd_id) {
     StaticJsonDocument<256> doc;
 
     doc["device_id"]  = device_id;
@@ -66,6 +67,7 @@ void publishState(Light &l, String topic, String device_id) {
     doc["brightness"] = l.brightness;
     doc["mode"]       = l.mode;
     doc["timestamp"]  = millis() / 1000;
+    if (cmd_id != "") doc["cmd_id"] = cmd_id;
 
     char buffer[256];
     size_t n = serializeJson(doc, buffer);
@@ -115,6 +117,7 @@ void callback(char* topic, byte* payload, unsigned int length) {
     String state_cmd      = doc["state"] | "";
     int brightness_cmd    = doc["brightness"] | -1;
     String mode_cmd       = doc["mode"] | "";
+    String cmd_id         = doc["cmd_id"] | "";
 
     String topicStr = String(topic);
 
@@ -135,7 +138,7 @@ void callback(char* topic, byte* payload, unsigned int length) {
             if (brightness_cmd >= 0) setLight(light1, LED1_PIN, "", brightness_cmd, "auto_brt");
         }
 
-        publishState(light1, topic_state_1, device1_id);
+        publishState(light1, topic_state_1, device1_id, cmd_id);
     }
 
     // ---------- ĐÈN 2 ----------
@@ -155,7 +158,7 @@ void callback(char* topic, byte* payload, unsigned int length) {
             if (brightness_cmd >= 0) setLight(light2, LED2_PIN, "", brightness_cmd, "auto_brt2");
         }
 
-        publishState(light2, topic_state_2, device2_id);
+        publishState(light2, topic_state_2, device2_id, cmd_id);
     }
 }
 
@@ -188,8 +191,8 @@ void reconnectMQTT() {
             client.subscribe(topic_cmd_1.c_str());
             client.subscribe(topic_cmd_2.c_str());
 
-            publishState(light1, topic_state_1, device1_id);
-            publishState(light2, topic_state_2, device2_id);
+            publishState(light1, topic_state_1, device1_id, "");
+            publishState(light2, topic_state_2, device2_id, "");
         } else {
             Serial.print("MQTT connect failed, rc=");
             Serial.print(client.state());
@@ -203,10 +206,15 @@ void reconnectMQTT() {
 // Heartbeat
 // ============================
 void publishHeartbeat() {
-    StaticJsonDocument<128> doc;
+    StaticJsonDocument<192> doc;
     doc["timestamp"] = millis() / 1000;
 
-    char buffer[128];
+    // Danh sách đèn của board này để backend cập nhật đúng từng device
+    JsonArray devices = doc.createNestedArray("devices");
+    devices.add(device1_id);
+    devices.add(device2_id);
+
+    char buffer[192];
     size_t n = serializeJson(doc, buffer);
     client.publish(topic_heartbeat.c_str(), buffer, n);
 